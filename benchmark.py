@@ -0,0 +1,1393 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the GMail Auto-Archiver.
+
+Usage:
+    python benchmark.py [suite ...]
+
+Runs the given suites, or all of them. Every case runs in a forked
+child process so the peak memory reported is that of the case alone.
+
+Suites:
+    msgset      command bytes, commands and peak memory for FETCH/STORE
+                message sets of 10k, 100k and 1M ids, one comma joined
+                set versus range compressed batches.
+    dates       Date header parsing speed on 1M synthetic headers, the
+                original strptime based parser versus lib.dates. Also
+                fuzzes lib.dates with odd but legal headers, checked
+                against email.utils, and with garbage.
+    fetch       bytes received, fetch and parse time and peak memory
+                for the dates of 50k messages served by lib.fakeimap:
+                Date/Subject headers parsed with email.message (the
+                old path), the Date header parsed directly, and
+                INTERNALDATE.
+    e2e         the client side engine run phase by phase against
+                lib.fakeimap over a simulated link, for synthetic
+                mailboxes of 1k to 1M messages: wall time, IMAP
+                commands (round trips), bytes sent and received,
+                messages and peak memory per phase.
+    engines     --accounts with a thread per worker versus --async, for
+                1, 10 and 100 mailboxes on a server with injected
+                latency: wall time, peak memory and threads.
+    pipeline    a run with and without --pipeline, client and server
+                side, on links with 20 to 300ms round trips: wall time
+                and IMAP commands.
+    compress    a client side run with and without COMPRESS=DEFLATE on
+                links of 256 kB/s, 2 MB/s and unlimited bandwidth: wall
+                time and bytes before and after compression.
+    index       the cache of 100k and 1M labeled messages as dicts of
+                strs and tuples (the old way) versus lib.msgindex:
+                memory, build time, the scan for old messages and
+                saving and loading.
+    condstore   a cached run on an unchanged mailbox of 10k to 1M
+                messages, with and without CONDSTORE on the server:
+                wall time, IMAP commands, bytes and peak memory.
+    threads     a first run on 100k messages in threads of 1 to 20
+                messages on average, per message and with --threads
+                newest and oldest: wall time, IMAP commands, bytes
+                received and messages archived.
+    ratelimit   a run against a server enforcing a per account quota,
+                without a limiter (only retries), with the adaptive
+                limiter and with rates set just under the quota, with
+                and without --pipeline: wall time, reconnects,
+                throttled commands and time spent waiting.
+    replay      a run without the cache recorded against lib.fakeimap
+                on a simulated link, then replayed from its transcript
+                at full speed and with the recorded timing: wall time,
+                IMAP commands, bytes received and messages archived.
+    queue       --accounts with --queue split between 1 to 8 worker
+                processes on a server with injected latency: wall time,
+                speedup and whether every account was archived exactly
+                once, also with one of the processes killed midway.
+    startup     the cost of starting the script, as for every cron run:
+                wall time of 'gmail-autoarchive.py --help' over a bare
+                interpreter and the time each module takes to import,
+                self and cumulative like python 3's -X importtime.
+                Fails if it is over STARTUP_BUDGET_MS or any of
+                STARTUP_LAZY_MODULES gets imported.
+    labels      an account with 400 labels, 150 of them matched by
+                LABEL_RULES with ages in hours, days and weeks: parsing
+                the LIST by trying rule after rule versus
+                lib.labelrules, then runs with one SEARCH per label (as
+                before) and per age limit, client and server side, on
+                a simulated link: wall time, IMAP commands and messages
+                archived.
+    folders     --folders on four folders of 800 to 8k messages, one
+                after the other on a single connection versus 2 and 4
+                connections, client and server side, on a simulated
+                link, next to the largest folder alone: wall time, IMAP
+                commands and messages archived.
+'''
+
+from datetime import datetime, tzinfo, timedelta
+import calendar
+import email
+import email.utils
+import imaplib
+import json
+import multiprocessing
+import os.path
+import random
+import re
+import resource
+import shutil
+import signal
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from lib import autoarchive, dates, fakeimap, jobqueue, labelrules, xoauth
+from lib.msgindex import MessageIndex
+from lib.oauthsetup import write_oauth_identity
+from lib.imapstream import run_session
+from lib.msgset import message_sets
+from lib.ratelimit import Limiter
+from lib.transcript import Recorder, Replay
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'gmail-autoarchive.py')
+
+SUITES = {}
+
+def suite(func):
+    '''Registers a benchmark suite under its function name minus the
+    bench_ prefix.'''
+    SUITES[func.__name__[len('bench_'):]] = func
+    return func
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _run_child(queue, func, args):
+    try:
+        before = peak_rss_kb()
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        queue.put((True, (result, elapsed, peak_rss_kb() - before)))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+def run_isolated(func, *args):
+    '''Runs func(*args) in a child process. Returns a tuple (result,
+    elapsed seconds, peak memory growth in kB).'''
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_child,
+                                    args=(queue, func, args))
+    child.start()
+    ok, ret = queue.get()
+    child.join()
+    if not ok:
+        raise RuntimeError('Benchmark case failed:\n' + ret)
+    return ret
+
+def print_table(headers, rows):
+    widths = [max(len(str(row[i])) for row in [headers] + rows)
+              for i in range(len(headers))]
+    for row in [headers] + rows:
+        print '  '.join(str(col).rjust(width)
+                        for col, width in zip(row, widths))
+    print
+
+## msgset -------------------------------------------------------------
+
+def make_ids(count, shape):
+    '''Returns count uids as strs, the way the searches return them.'''
+    if shape == 'contiguous':
+        ids = range(1, count + 1)
+    else:
+        # roughly what an inbox looks like after some manual archiving
+        rand = random.Random(count)
+        ids = [i for i in xrange(1, int(count * 1.25) + 1)
+               if rand.random() < 0.8][:count]
+    return [str(i) for i in ids]
+
+def joined_set(count, shape):
+    msg_ids = make_ids(count, shape)
+    msg_str = ','.join(msg_ids)
+    return len(msg_str), 1
+
+def batched_sets(count, shape):
+    msg_ids = make_ids(count, shape)
+    total, commands = 0, 0
+    for msg_str in message_sets(msg_ids):
+        total += len(msg_str)
+        commands += 1
+    return total, commands
+
+@suite
+def bench_msgset():
+    rows = []
+    for count in (10000, 100000, 1000000):
+        for shape in ('contiguous', 'sparse'):
+            for name, func in (('joined', joined_set),
+                               ('batched', batched_sets)):
+                (size, commands), elapsed, peak = run_isolated(
+                    func, count, shape)
+                rows.append((count, shape, name, size, commands,
+                             '%.3f' % elapsed, peak))
+    print_table(('ids', 'shape', 'method', 'set bytes', 'commands',
+                 'seconds', 'peak kB'), rows)
+
+## dates --------------------------------------------------------------
+
+# The parser the script used before lib.dates, kept as the baseline
+class FixedOffset(tzinfo):
+    def __init__(self, offset, name):
+        self.__offset = timedelta(minutes = offset)
+        self.__name = name
+
+    def utcoffset(self, dt):
+        return self.__offset
+
+    def tzname(self, dt):
+        return self.__name
+
+    def dst(self, dt):
+        return timedelta(0)
+
+def build_tz(tzstring):
+    parts = tzstring.split()
+    offset = parts[0]
+    name = 'UNKNOWN'
+    if len(parts) > 1:
+        name = parts[1].strip('()')
+    sign = offset[0]
+    hours = int(offset[1:3])
+    minutes = int(offset[3:5])
+    offset_minutes = hours * 60 + minutes
+    if sign == '-':
+        offset_minutes *= -1
+    return FixedOffset(offset_minutes, name)
+
+def original_parse_date(datestr):
+    parts = datestr.strip().split(' ', 5)
+    datetimestr = ' '.join(parts[:5])
+    dt_naive = datetime.strptime(datetimestr, r'%a, %d %b %Y %H:%M:%S')
+    dt = dt_naive.replace(tzinfo=build_tz(parts[5]))
+    return calendar.timegm(dt.utctimetuple())
+
+ZONES = ['+0000', '-0400 (EDT)', '-0500 (EST)', '-0700 (PDT)', '+0100 (CET)',
+         '+0200', '+0530 (IST)', '+0900 (JST)', '-0300', '+1000 (AEST)']
+
+def make_headers(count, seed=0):
+    '''Returns count Date headers in the common format, spread over
+    a few years and the usual zones.'''
+    rand = random.Random(seed)
+    start = 1262304000 # 2010-01-01
+    headers = []
+    for _ in xrange(count):
+        date = start + rand.randint(0, 3 * 365 * 86400)
+        zone = rand.choice(ZONES)
+        headers.append(email.utils.formatdate(date)[:-5] + zone)
+    return headers
+
+def time_parser(parse, count):
+    headers = make_headers(count)
+    start = time.time()
+    for header in headers:
+        parse(header)
+    return time.time() - start
+
+def fuzz_header(rand):
+    '''Returns a legal but unusual Date header.'''
+    date = rand.randint(0, 2000000000)
+    parts = email.utils.formatdate(date).split()
+    # parts = ['Thu,', '07', 'Apr', '2011', '08:34:04', '-0000']
+    if rand.random() < 0.3:
+        parts.pop(0)
+    if rand.random() < 0.3:
+        parts[-5] = parts[-5].lstrip('0')
+    time_of_day = parts[-2]
+    if rand.random() < 0.3 and time_of_day.startswith('0'):
+        time_of_day = time_of_day[1:]
+    if rand.random() < 0.2:
+        time_of_day = time_of_day[:time_of_day.rindex(':')]
+    parts[-2] = time_of_day
+    zone = rand.choice(['+0000', '-0000', 'GMT', 'UT', 'EST', 'EDT', 'CST',
+                        'PDT', '+0545', '-1100', '-0400 (EDT)'])
+    parts[-1] = zone
+    if rand.random() < 0.2:
+        parts[-3] = parts[-3][2:]
+    sep = rand.choice([' ', '  ', ' \t'])
+    return sep.join(parts)
+
+# Legal shapes with a time of day out of range, which must fail with
+# ValueError
+BAD_TIMES = ['Thu, 7 Apr 2011 08:75:04 -0400', 'Thu, 7 Apr 2011 8:75 EST',
+             'Thu, 7 Apr 2011 24:00:00 +0000', '7 Apr 2011 59:10 GMT',
+             'Thu, 07 Apr 2011 08:34:61 -0400', 'Thu, 7 Apr 2011 08:60 UT']
+
+def bad_time_header(rand):
+    '''Returns a fuzz_header with the hours, minutes or seconds out of
+    range.'''
+    header = fuzz_header(rand)
+    field = rand.randint(0, 2)
+    value = rand.randint((24, 60, 61)[field], 99)
+    def replace(match):
+        parts = match.group(0).split(':')
+        if field < len(parts):
+            parts[field] = '%02d' % value
+        else:
+            parts[0] = '%02d' % value
+        return ':'.join(parts)
+    return re.sub(r'\d{1,2}:\d\d(?::\d\d)?', replace, header, 1)
+
+def fuzz(count):
+    '''Returns a tuple (mismatches against email.utils, unexpected
+    exceptions on garbage and on times out of range, which count too
+    when they parse).'''
+    rand = random.Random(1)
+    mismatches = 0
+    for _ in xrange(count):
+        header = fuzz_header(rand)
+        if dates.parse_date(header) != dates.parse_date_slow(header):
+            mismatches += 1
+    errors = 0
+    for header in BAD_TIMES + [bad_time_header(rand)
+                               for _ in xrange(count / 10)]:
+        try:
+            dates.parse_date(header)
+            errors += 1
+        except ValueError:
+            pass
+        except Exception:
+            errors += 1
+    chars = string.printable
+    for _ in xrange(count):
+        header = ''.join(rand.choice(chars)
+                         for _ in xrange(rand.randint(0, 40)))
+        try:
+            dates.parse_date(header)
+        except ValueError:
+            pass
+        except Exception:
+            errors += 1
+    return mismatches, errors
+
+@suite
+def bench_dates():
+    count = 1000000
+    rows = []
+    for name, parse in (('original', original_parse_date),
+                        ('lib.dates', dates.parse_date)):
+        seconds, _, peak = run_isolated(time_parser, parse, count)
+        rows.append((name, count, '%.2f' % seconds,
+                     '%.2f' % (seconds * 1e6 / count), peak))
+    print_table(('parser', 'headers', 'seconds', 'us/header', 'peak kB'),
+                rows)
+    print 'speedup: %.1fx' % (float(rows[0][2]) / float(rows[1][2]))
+
+    (mismatches, errors), _, _ = run_isolated(fuzz, 100000)
+    print 'fuzz: %d mismatches with email.utils, %d unexpected errors' % (
+        mismatches, errors)
+    print
+
+## fetch --------------------------------------------------------------
+
+class CountingIMAP4(imaplib.IMAP4):
+    '''IMAP4 that counts the commands it sends and the bytes it sends
+    and receives. The counts are kept on the class so they include
+    what happens inside the constructor, each benchmark case runs in
+    its own process with a single connection.'''
+
+    commands = 0
+    bytes_sent = 0
+    bytes_received = 0
+
+    def _new_tag(self):
+        CountingIMAP4.commands += 1
+        return imaplib.IMAP4._new_tag(self)
+
+    def send(self, data):
+        CountingIMAP4.bytes_sent += len(data)
+        imaplib.IMAP4.send(self, data)
+
+    def read(self, size):
+        data = imaplib.IMAP4.read(self, size)
+        CountingIMAP4.bytes_received += len(data)
+        return data
+
+    def readline(self):
+        line = imaplib.IMAP4.readline(self)
+        CountingIMAP4.bytes_received += len(line)
+        return line
+
+def parse_email_objects(response, literal):
+    mail = email.message_from_string(literal)
+    return mail, dates.parse_date(mail.get('Date'))
+
+def parse_date_header(response, literal):
+    return dates.parse_date(autoarchive.parse_headers(literal)['date'])
+
+def parse_internaldate(response, literal):
+    return dates.parse_internaldate(response)
+
+FETCH_PATHS = [
+    ('email.message', '(body.peek[header.fields (date subject)])',
+     parse_email_objects),
+    ('date header', '(body.peek[header.fields (date)])',
+     parse_date_header),
+    ('internaldate', '(INTERNALDATE)', parse_internaldate),
+]
+
+def fetch_path(port, items, parse):
+    s = CountingIMAP4('localhost', port)
+    s.login('bench@gmail.com', 'bench')
+    s.select('INBOX')
+    _, data = s.uid('search', None, 'ALL')
+    msg_ids = data[0].split()
+    received = s.bytes_received
+
+    start = time.time()
+    responses = []
+    run_session(s, autoarchive.fetch_responses(
+        s, msg_ids, items, lambda *response: responses.append(response)))
+    fetched = time.time()
+    records = {}
+    for response, literal in responses:
+        records[autoarchive.parse_uid(response)] = parse(response, literal)
+    parsed = time.time()
+
+    s.logout()
+    return (len(records), s.bytes_received - received,
+            fetched - start, parsed - fetched)
+
+@suite
+def bench_fetch():
+    count = 50000
+    server = fakeimap.FakeGmailServer(fakeimap.make_mailbox(count))
+    server.start()
+    rows = []
+    for name, items, parse in FETCH_PATHS:
+        (records, received, fetch_seconds, parse_seconds), _, peak = \
+            run_isolated(fetch_path, server.port, items, parse)
+        rows.append((name, records, received, '%.2f' % fetch_seconds,
+                     '%.2f' % parse_seconds, peak))
+    server.shutdown()
+    print_table(('path', 'messages', 'bytes received', 'fetch s',
+                 'parse s', 'peak kB'), rows)
+
+## e2e ----------------------------------------------------------------
+
+E2E_COUNTS = (1000, 10000, 100000, 1000000)
+# The simulated link: seconds per command, about a round trip to gmail,
+# and bytes per second from the server
+E2E_LATENCY = 0.02
+E2E_BANDWIDTH = 5 * 1024 * 1024
+
+class Phases(object):
+    '''Runs the phases of an archiving pass one after the other and
+    records what each one cost.'''
+
+    def __init__(self):
+        self.rows = []
+        self.base_rss = peak_rss_kb()
+
+    def run(self, name, count, func, *args):
+        '''Returns func(*args). count takes the result and returns the
+        number of messages the phase dealt with.'''
+        commands = CountingIMAP4.commands
+        sent = CountingIMAP4.bytes_sent
+        received = CountingIMAP4.bytes_received
+        start = time.time()
+        result = func(*args)
+        self.rows.append((name, time.time() - start,
+                          CountingIMAP4.commands - commands,
+                          CountingIMAP4.bytes_sent - sent,
+                          CountingIMAP4.bytes_received - received,
+                          count(result), peak_rss_kb() - self.base_rss))
+        return result
+
+def e2e_pass(port):
+    '''Archives the mailbox served on port the way the client side
+    engine does, without the cache, and returns the Phases rows.'''
+    phases = Phases()
+    # The phases print their progress
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        s = phases.run('connect', lambda s: 0, autoarchive.connect,
+                       xoauth.OAuthEntity('token', 'secret'),
+                       'bench@gmail.com', 'localhost', port, CountingIMAP4)
+        phases.run('select', lambda r: int(r[1][0]), s.select, 'INBOX')
+        label_ages = phases.run('get_autoarchive_labels', len, run_session,
+                                s, autoarchive.get_autoarchive_labels(
+                                    s, autoarchive.LABEL_PATTERN))
+        ages = phases.run('get_message_ids', len, run_session, s,
+                          autoarchive.get_message_ages(s, label_ages))
+        index = MessageIndex()
+        phases.run('fetch_emails', lambda r: len(index), run_session, s,
+                   autoarchive.fetch_dates(
+                       s, ages.keys(), lambda msg_id, date: index.add(
+                           msg_id, ages[msg_id], date)))
+        old_msgs = phases.run('get_messages_to_archive', len,
+                              autoarchive.get_messages_to_archive, index)
+        phases.run('archive_messages', lambda r: len(old_msgs), run_session,
+                   s, autoarchive.archive_messages(s, old_msgs))
+        phases.run('close', lambda r: 0, s.close)
+        s.logout()
+    finally:
+        sys.stdout = stdout
+    return phases.rows
+
+@suite
+def bench_e2e():
+    print 'link: %dms round trip, %d kB/s' % (E2E_LATENCY * 1000,
+                                              E2E_BANDWIDTH / 1024)
+    print
+    for count in E2E_COUNTS:
+        server = fakeimap.FakeGmailServer(fakeimap.make_mailbox(count),
+                                          latency=E2E_LATENCY,
+                                          bandwidth=E2E_BANDWIDTH)
+        server.start()
+        phases, elapsed, peak = run_isolated(e2e_pass, server.port)
+        server.shutdown()
+        server.server_close()
+
+        rows = [(name, '%.2f' % seconds, commands, sent, received,
+                 messages, rss)
+                for name, seconds, commands, sent, received, messages, rss
+                in phases]
+        rows.append(('total', '%.2f' % elapsed,
+                     sum(row[2] for row in phases),
+                     sum(row[3] for row in phases),
+                     sum(row[4] for row in phases), count, peak))
+        print '%d messages' % count
+        print_table(('phase', 'seconds', 'commands', 'bytes sent',
+                     'bytes received', 'messages', 'peak kB'), rows)
+
+## engines ------------------------------------------------------------
+
+ENGINE_MAILBOXES = (1, 10, 100)
+ENGINE_MESSAGES = 1000
+ENGINE_LATENCY = 0.05
+
+def archive_with_engine(port, count, use_async):
+    '''Archives count accounts served on port with --workers count.
+    Returns a tuple (messages archived, errors, peak threads).'''
+    autoarchive.IMAP_HOST = 'localhost'
+    autoarchive.IMAP_PORT = port
+    autoarchive.IMAP_SSL = False
+    autoarchive.STATE_PATH = ''
+    args = ['--workers', str(count), '--timeout', '600']
+    if use_async:
+        args.append('--async')
+    options, _ = autoarchive.setup_option_parser().parse_args(args)
+
+    tmp = tempfile.mkdtemp()
+    accounts = []
+    for i in xrange(count):
+        path = os.path.join(tmp, 'identity%d' % i)
+        write_oauth_identity(path, xoauth.OAuthEntity('token', 'secret'))
+        accounts.append(('bench%d@gmail.com' % i, path))
+
+    # Sample the number of threads while the accounts are archived
+    peak_threads = [threading.active_count()]
+    done = threading.Event()
+    def sample():
+        while not done.wait(0.05):
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        if use_async:
+            results = autoarchive.archive_accounts_async(accounts, options)
+        else:
+            results = autoarchive.archive_accounts(accounts, options)
+    finally:
+        sys.stdout = stdout
+        done.set()
+        sampler.join()
+        shutil.rmtree(tmp)
+    # Not counting the sampler
+    return (sum(r.archived for r in results),
+            len([r for r in results if r.error]), peak_threads[0] - 1)
+
+@suite
+def bench_engines():
+    print 'latency: %dms round trip, %d messages per mailbox' % (
+        ENGINE_LATENCY * 1000, ENGINE_MESSAGES)
+    print
+    rows = []
+    for count in ENGINE_MAILBOXES:
+        for name, use_async in (('threads', False), ('async', True)):
+            mailboxes = dict(('bench%d@gmail.com' % i,
+                              fakeimap.make_mailbox(ENGINE_MESSAGES, seed=i))
+                             for i in xrange(count))
+            server = fakeimap.FakeGmailServer(mailboxes,
+                                              latency=ENGINE_LATENCY)
+            server.start()
+            (archived, errors, threads), elapsed, peak = run_isolated(
+                archive_with_engine, server.port, count, use_async)
+            server.shutdown()
+            server.server_close()
+            rows.append((count, name, '%.2f' % elapsed, archived, errors,
+                         threads, peak))
+    print_table(('mailboxes', 'engine', 'seconds', 'archived', 'errors',
+                 'threads', 'peak kB'), rows)
+
+## pipeline -----------------------------------------------------------
+
+PIPELINE_LATENCIES = (0.02, 0.1, 0.3)
+PIPELINE_MESSAGES = 10000
+PIPELINE_LABELS = ['aa:%d' % days for days in range(1, 31)]
+
+def archive_pipelined(port, args):
+    '''Runs archive_mailbox with the command line args on the mailbox
+    served on port. Returns a tuple (messages archived, commands).'''
+    options, _ = autoarchive.setup_option_parser().parse_args(args)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        s = autoarchive.connect(xoauth.OAuthEntity('token', 'secret'),
+                                'bench@gmail.com', 'localhost', port,
+                                imaplib.IMAP4, options.pipeline)
+        archived = run_session(s, autoarchive.archive_mailbox(
+            s, options, ''))
+        autoarchive.close_mailbox(s)
+        s.logout()
+    finally:
+        sys.stdout = stdout
+    return archived, s.metrics.record(archived)['commands']
+
+@suite
+def bench_pipeline():
+    print '%d messages, %d aa: labels' % (PIPELINE_MESSAGES,
+                                          len(PIPELINE_LABELS))
+    print
+    rows = []
+    for latency in PIPELINE_LATENCIES:
+        for engine in ([], ['--server-side', '-v']):
+            for args in (engine, engine + ['--pipeline']):
+                server = fakeimap.FakeGmailServer(
+                    fakeimap.make_mailbox(PIPELINE_MESSAGES,
+                                          labels=PIPELINE_LABELS),
+                    latency=latency)
+                server.start()
+                (archived, commands), elapsed, peak = run_isolated(
+                    archive_pipelined, server.port, args)
+                server.shutdown()
+                server.server_close()
+                rows.append(('%dms' % (latency * 1000),
+                             ' '.join(args) or '(client side)',
+                             '%.2f' % elapsed, commands, archived))
+    print_table(('round trip', 'options', 'seconds', 'commands',
+                 'archived'), rows)
+
+## compress -----------------------------------------------------------
+
+COMPRESS_BANDWIDTHS = (256 * 1024, 2 * 1024 * 1024, 0)
+COMPRESS_MESSAGES = 50000
+COMPRESS_LATENCY = 0.02
+
+def archive_compressed(port, compress):
+    '''Runs archive_mailbox without the cache on the mailbox served on
+    port. Returns the metrics record of the run.'''
+    options, _ = autoarchive.setup_option_parser().parse_args([])
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        s = autoarchive.connect(xoauth.OAuthEntity('token', 'secret'),
+                                'bench@gmail.com', 'localhost', port,
+                                imaplib.IMAP4, compress=compress)
+        archived = run_session(s, autoarchive.archive_mailbox(
+            s, options, ''))
+        autoarchive.close_mailbox(s)
+        s.logout()
+    finally:
+        sys.stdout = stdout
+    return s.metrics.record(archived)
+
+@suite
+def bench_compress():
+    print '%d messages, %dms round trip' % (COMPRESS_MESSAGES,
+                                            COMPRESS_LATENCY * 1000)
+    print
+    rows = []
+    for bandwidth in COMPRESS_BANDWIDTHS:
+        for compress in (False, True):
+            server = fakeimap.FakeGmailServer(
+                fakeimap.make_mailbox(COMPRESS_MESSAGES),
+                latency=COMPRESS_LATENCY, bandwidth=bandwidth,
+                compress=True)
+            server.start()
+            record, elapsed, peak = run_isolated(archive_compressed,
+                                                 server.port, compress)
+            server.shutdown()
+            server.server_close()
+            rows.append((bandwidth and '%d kB/s' % (bandwidth / 1024)
+                         or 'unlimited', compress and 'deflate' or 'off',
+                         '%.2f' % elapsed, record['bytes_received'],
+                         record['wire_bytes_received'],
+                         '%.1f' % (float(record['bytes_received'])
+                                   / record['wire_bytes_received']),
+                         record['bytes_sent'], record['wire_bytes_sent'],
+                         record['archived']))
+    print_table(('link', 'compress', 'seconds', 'received', 'on the wire',
+                 'ratio', 'sent', 'on the wire', 'archived'), rows)
+
+## index -------------------------------------------------------------
+
+INDEX_COUNTS = (100000, 1000000)
+INDEX_AGES = tuple(days * 86400 for days in (1, 3, 7, 30, 90))
+
+def make_messages(count):
+    '''Yields count tuples (uid, (age, date)) in uid order, dated over
+    the last year.'''
+    rand = random.Random(count)
+    now = time.time()
+    for uid in xrange(1, count + 1):
+        yield str(uid), (rand.choice(INDEX_AGES),
+                         now - rand.randint(0, 365 * 86400))
+
+def original_get_messages_to_archive(ages, dates):
+    '''Returns a list of msg ids to be archived.'''
+    # ages = {msg_id: age, ... }
+    # dates = {msg_id: seconds_since_epoch, ... }
+    now = time.time()
+
+    old_msgs = []
+    for msg_id, date in dates.items():
+        assert msg_id in ages, 'No age limit for message %s' % msg_id
+        if autoarchive.is_old(date, ages[msg_id], now):
+            old_msgs.append(msg_id)
+
+    return old_msgs
+
+def index_case(count, compact):
+    '''Builds, scans, saves and loads the cache of count messages, as a
+    MessageIndex if compact, else as the dicts it replaced. Returns a
+    tuple (memory of the cache in kB, seconds to build, to scan, to
+    save and to load, bytes saved, old messages).'''
+    before = peak_rss_kb()
+    start = time.time()
+    if compact:
+        messages = MessageIndex()
+        for uid, (age, date) in make_messages(count):
+            messages.add(uid, age, date)
+    else:
+        messages = {}
+        for uid, (age, date) in make_messages(count):
+            messages[uid] = (age, date)
+    built = time.time()
+    memory = peak_rss_kb() - before
+
+    if compact:
+        old_msgs = autoarchive.get_messages_to_archive(messages)
+    else:
+        # What find_old_messages did
+        ages = dict((uid, age) for uid, (age, _) in messages.items())
+        dates = dict((uid, date) for uid, (_, date) in messages.items())
+        old_msgs = original_get_messages_to_archive(ages, dates)
+        del ages, dates
+    scanned = time.time()
+
+    if compact:
+        data = json.dumps({'index': messages.to_dict()})
+    else:
+        data = json.dumps({'messages': dict(
+            (uid, list(v)) for uid, v in messages.items())})
+    saved = time.time()
+    if compact:
+        MessageIndex.from_dict(json.loads(data)['index'])
+    else:
+        dict((str(uid), tuple(v))
+             for uid, v in json.loads(data)['messages'].items())
+    loaded = time.time()
+    return (memory, built - start, scanned - built, saved - scanned,
+            loaded - saved, len(data), len(old_msgs))
+
+@suite
+def bench_index():
+    rows = []
+    for count in INDEX_COUNTS:
+        for compact in (False, True):
+            (memory, build, scan, save, load, size, old), _, peak = \
+                run_isolated(index_case, count, compact)
+            rows.append((count, compact and 'MessageIndex' or 'dicts',
+                         memory, peak, '%.2f' % build, '%.3f' % scan,
+                         '%.2f' % save, '%.2f' % load, size, old))
+    print_table(('messages', 'cache', 'cache kB', 'peak kB', 'build s',
+                 'scan s', 'save s', 'load s', 'bytes saved', 'old'), rows)
+
+## condstore ----------------------------------------------------------
+
+CONDSTORE_MESSAGES = (10000, 100000, 1000000)
+CONDSTORE_LATENCY = 0.02
+
+def archive_cached(port, state_path):
+    '''Runs archive_mailbox with the cache at state_path on the mailbox
+    served on port. Returns the metrics record of the run.'''
+    options, _ = autoarchive.setup_option_parser().parse_args([])
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        s = autoarchive.connect(xoauth.OAuthEntity('token', 'secret'),
+                                'bench@gmail.com', 'localhost', port,
+                                imaplib.IMAP4)
+        archived = run_session(s, autoarchive.archive_mailbox(
+            s, options, state_path))
+        autoarchive.close_mailbox(s)
+        s.logout()
+    finally:
+        sys.stdout = stdout
+    return s.metrics.record(archived)
+
+@suite
+def bench_condstore():
+    print '%dms round trip, the third run on the same mailbox' % (
+        CONDSTORE_LATENCY * 1000)
+    print
+    rows = []
+    for count in CONDSTORE_MESSAGES:
+        for condstore in (False, True):
+            server = fakeimap.FakeGmailServer(
+                fakeimap.make_mailbox(count), latency=CONDSTORE_LATENCY,
+                condstore=condstore)
+            server.start()
+            state_path = tempfile.mktemp()
+            # The first run archives what is due and fills the cache,
+            # the second catches up with the HIGHESTMODSEQ its own STORE
+            # moved on, the third is the one measured
+            for _ in range(3):
+                record, elapsed, peak = run_isolated(
+                    archive_cached, server.port, state_path)
+            os.remove(state_path)
+            server.shutdown()
+            server.server_close()
+            rows.append((count, condstore and 'on' or 'off',
+                         '%.2f' % elapsed, record['commands'],
+                         record['bytes_sent'], record['bytes_received'],
+                         '%d kB' % peak))
+    print_table(('messages', 'condstore', 'seconds', 'commands', 'sent',
+                 'received', 'peak memory'), rows)
+
+## threads ------------------------------------------------------------
+
+THREADS_MESSAGES = 100000
+THREADS_LENGTHS = (1, 5, 20)
+THREADS_LATENCY = 0.02
+
+def archive_threads(port, args):
+    '''Runs archive_mailbox with the command line args and a new cache
+    on the mailbox served on port. Returns the metrics record of the
+    run.'''
+    options, _ = autoarchive.setup_option_parser().parse_args(args)
+    state_path = tempfile.mktemp()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        s = autoarchive.connect(xoauth.OAuthEntity('token', 'secret'),
+                                'bench@gmail.com', 'localhost', port,
+                                imaplib.IMAP4)
+        archived = run_session(s, autoarchive.archive_mailbox(
+            s, options, state_path))
+        autoarchive.close_mailbox(s)
+        s.logout()
+    finally:
+        sys.stdout = stdout
+        if os.path.exists(state_path):
+            os.remove(state_path)
+    return s.metrics.record(archived)
+
+@suite
+def bench_threads():
+    print '%d messages, %dms round trip' % (THREADS_MESSAGES,
+                                            THREADS_LATENCY * 1000)
+    print
+    rows = []
+    for length in THREADS_LENGTHS:
+        for args in ([], ['--threads', 'newest'], ['--threads', 'oldest']):
+            server = fakeimap.FakeGmailServer(
+                fakeimap.make_mailbox(THREADS_MESSAGES,
+                                      thread_length=length),
+                latency=THREADS_LATENCY)
+            server.start()
+            record, elapsed, peak = run_isolated(archive_threads,
+                                                 server.port, args)
+            server.shutdown()
+            server.server_close()
+            rows.append((length, ' '.join(args) or '(per message)',
+                         '%.2f' % elapsed, record['commands'],
+                         record['bytes_received'], record['archived']))
+    print_table(('thread length', 'options', 'seconds', 'commands',
+                 'received', 'archived'), rows)
+
+## ratelimit ----------------------------------------------------------
+
+RATELIMIT_MESSAGES = 20000
+# Commands and bytes per second the server allows each account
+RATELIMIT_QUOTA = (20, 400 * 1024)
+RATELIMIT_LIMITERS = (
+    ('none', None),
+    ('adaptive', ()),
+    ('under quota', (18, 380 * 1024)),
+)
+
+def archive_limited(port, args, limits):
+    '''Runs archive_with_retries with the command line args and a new
+    cache on the mailbox served on port, with a Limiter(*limits) unless limits is
+    None. Returns a tuple (messages archived or 'gave up', reconnects,
+    throttled, seconds waited).'''
+    options, _ = autoarchive.setup_option_parser().parse_args(args)
+    autoarchive.IMAP_HOST, autoarchive.IMAP_PORT = 'localhost', port
+    autoarchive.IMAP_SSL = False
+    limiter = limits is not None and Limiter(*limits) or None
+    # Retries resume from the checkpoints saved here
+    state_path = tempfile.mktemp()
+    output = tempfile.TemporaryFile()
+    stdout, sys.stdout = sys.stdout, output
+    try:
+        archived, _ = autoarchive.archive_with_retries(
+            xoauth.OAuthEntity('token', 'secret'), 'bench@gmail.com',
+            options, state_path, limiter=limiter)
+    except Exception, e:
+        archived = 'gave up'
+    finally:
+        sys.stdout = stdout
+        if os.path.exists(state_path):
+            os.remove(state_path)
+    output.seek(0)
+    reconnects = sum(1 for line in output
+                     if line.startswith('Run failed'))
+    return (archived, reconnects, limiter and limiter.throttles or 0,
+            limiter and limiter.waited or 0.0)
+
+@suite
+def bench_ratelimit():
+    print '%d messages, quota %d commands and %d kB per second' % (
+        RATELIMIT_MESSAGES, RATELIMIT_QUOTA[0], RATELIMIT_QUOTA[1] / 1024)
+    print
+    rows = []
+    for args in ([], ['--pipeline']):
+        for name, limits in RATELIMIT_LIMITERS:
+            server = fakeimap.FakeGmailServer(
+                fakeimap.make_mailbox(RATELIMIT_MESSAGES),
+                quota=RATELIMIT_QUOTA)
+            server.start()
+            (archived, reconnects, throttled, waited), elapsed, peak = \
+                run_isolated(archive_limited, server.port, args, limits)
+            server.shutdown()
+            server.server_close()
+            rows.append((' '.join(args) or '(client side)', name,
+                         '%.2f' % elapsed, reconnects, throttled,
+                         '%.1f' % waited, archived))
+    print_table(('options', 'limiter', 'seconds', 'reconnects',
+                 'throttled', 'waited s', 'archived'), rows)
+
+## replay -------------------------------------------------------------
+
+REPLAY_MESSAGES = 20000
+REPLAY_LATENCY = 0.02
+
+def archive_transcript(port, transcript):
+    '''Runs archive_with_retries without the cache on the mailbox served
+    on port, recording or replaying with transcript. Returns the
+    metrics record of the run.'''
+    options, _ = autoarchive.setup_option_parser().parse_args([])
+    autoarchive.IMAP_HOST, autoarchive.IMAP_PORT = 'localhost', port
+    autoarchive.IMAP_SSL = False
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        archived, s = autoarchive.archive_with_retries(
+            xoauth.OAuthEntity('token', 'secret'), 'bench@gmail.com',
+            options, '', transcript=transcript)
+    finally:
+        sys.stdout = stdout
+    return s.metrics.record(archived)
+
+@suite
+def bench_replay():
+    print '%d messages, %dms round trip' % (REPLAY_MESSAGES,
+                                            REPLAY_LATENCY * 1000)
+    print
+    fn = tempfile.mktemp()
+    server = fakeimap.FakeGmailServer(
+        fakeimap.make_mailbox(REPLAY_MESSAGES), latency=REPLAY_LATENCY)
+    server.start()
+    try:
+        rows = []
+        for name, timed in (('recorded', None), ('replayed', False),
+                            ('replayed, timed', True)):
+            if timed is None:
+                transcript = Recorder(fn)
+            else:
+                transcript = Replay(fn, timed)
+            record, elapsed, peak = run_isolated(
+                archive_transcript, server.port, transcript)
+            rows.append((name, '%.2f' % elapsed, record['commands'],
+                         record['bytes_received'], record['archived']))
+    finally:
+        server.shutdown()
+        server.server_close()
+        size = os.path.exists(fn) and os.path.getsize(fn) or 0
+        if size:
+            os.remove(fn)
+    print_table(('run', 'seconds', 'commands', 'received', 'archived'),
+                rows)
+    print
+    print 'transcript: %d bytes' % size
+
+## queue --------------------------------------------------------------
+
+QUEUE_ACCOUNTS = 32
+QUEUE_MESSAGES = 500
+QUEUE_LATENCY = 0.1
+QUEUE_PROCESSES = (1, 2, 4, 8)
+QUEUE_WORKERS = 1
+# Short leases, so that the accounts of the killed process are taken
+# over quickly, and when it is killed
+QUEUE_LEASE_SECONDS = 2
+QUEUE_KILL_AFTER = 1.0
+
+def queue_worker(port, accounts_fn, queue_fn):
+    '''A worker process: runs the script with --accounts accounts_fn
+    --queue queue_fn against the server on port.'''
+    autoarchive.IMAP_HOST = 'localhost'
+    autoarchive.IMAP_PORT = port
+    autoarchive.IMAP_SSL = False
+    autoarchive.STATE_PATH = ''
+    jobqueue.LEASE_SECONDS = QUEUE_LEASE_SECONDS
+    jobqueue.HEARTBEAT_SECONDS = QUEUE_LEASE_SECONDS / 4.0
+    jobqueue.POLL_SECONDS = 0.1
+    sys.stdout = open(os.devnull, 'w')
+    autoarchive.main(['--accounts', accounts_fn, '--queue', queue_fn,
+                      '--workers', str(QUEUE_WORKERS), '--timeout', '600'])
+
+def run_queue(processes, kill):
+    '''Archives QUEUE_ACCOUNTS mailboxes with processes worker processes
+    sharing a new job table, killing the first one after
+    QUEUE_KILL_AFTER seconds if kill. Returns a tuple (seconds, messages
+    left in the inboxes, the rows of the job table).'''
+    mailboxes = dict(('bench%d@gmail.com' % i,
+                      fakeimap.make_mailbox(QUEUE_MESSAGES, seed=i))
+                     for i in xrange(QUEUE_ACCOUNTS))
+    server = fakeimap.FakeGmailServer(mailboxes, latency=QUEUE_LATENCY)
+    server.start()
+    tmp = tempfile.mkdtemp()
+    accounts_fn = os.path.join(tmp, 'accounts')
+    queue_fn = os.path.join(tmp, 'queue')
+    try:
+        with open(accounts_fn, 'w') as f:
+            for email in sorted(mailboxes):
+                f.write('%s identity\n' % email)
+        write_oauth_identity(os.path.join(tmp, 'identity'),
+                             xoauth.OAuthEntity('token', 'secret'))
+        start = time.time()
+        workers = [multiprocessing.Process(
+                       target=queue_worker,
+                       args=(server.port, accounts_fn, queue_fn))
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        if kill:
+            time.sleep(QUEUE_KILL_AFTER)
+            os.kill(workers[0].pid, signal.SIGKILL)
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+        rows = jobqueue.JobQueue(queue_fn).accounts()
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp)
+    left = sum(len(mailbox.folder('INBOX'))
+               for mailbox in mailboxes.values())
+    return elapsed, left, rows
+
+@suite
+def bench_queue():
+    print '%d accounts of %d messages, %dms round trip, --workers %d ' \
+        'per process' % (QUEUE_ACCOUNTS, QUEUE_MESSAGES, QUEUE_LATENCY * 1000,
+                     QUEUE_WORKERS)
+    print
+    rows = []
+    single = None
+    cases = [(processes, False) for processes in QUEUE_PROCESSES]
+    cases.append((QUEUE_PROCESSES[-1], True))
+    for processes, kill in cases:
+        elapsed, left, accounts = run_queue(processes, kill)
+        single = single or elapsed
+        runs = [account['runs'] for account in accounts]
+        rows.append(('%d%s' % (processes, kill and ', 1 killed' or ''),
+                     '%.2f' % elapsed, '%.1fx' % (single / elapsed), left,
+                     '%d-%d' % (min(runs), max(runs)),
+                     len([a for a in accounts if a['error']])))
+    print_table(('processes', 'seconds', 'speedup', 'left in inbox',
+                 'runs per account', 'errors'), rows)
+
+## startup ------------------------------------------------------------
+
+STARTUP_RUNS = 20
+# Most milliseconds the script may take to start over a bare
+# interpreter, and the modules a plain run must not import: they are
+# only needed for --accounts, --queue, --record and --replay, the
+# profiling options, generating oauth tokens or parsing odd Date headers
+STARTUP_BUDGET_MS = 60
+STARTUP_LAZY_MODULES = ('cProfile', 'email', 'multiprocessing', 'smtplib',
+                        'sqlite3', 'lib.jobqueue', 'lib.profiling',
+                        'lib.transcript', 'lib.fakeimap')
+STARTUP_SHOWN = 15
+
+# Run by a fresh interpreter: runs the script given as argv[1] with
+# --help, which imports everything a run does, and prints its total
+# time, the modules it loaded and (self, cumulative, name) for each
+# import that loaded something, in seconds
+STARTUP_PROBE = '''
+import __builtin__, json, os, runpy, sys, time
+real_import = __builtin__.__import__
+# Time spent in the nested imports of each running import
+nested = [0.0]
+timings = []
+def timed_import(name, *args, **kwargs):
+    loaded = len(sys.modules)
+    nested.append(0.0)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        inner = nested.pop()
+        nested[-1] += elapsed
+        if len(sys.modules) > loaded:
+            timings.append((elapsed - inner, elapsed, name))
+before = set(sys.modules)
+script = sys.argv[1]
+sys.argv = [script, '--help']
+sys.path.insert(0, os.path.dirname(script))
+stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+__builtin__.__import__ = timed_import
+start = time.time()
+try:
+    runpy.run_path(script, run_name='__main__')
+except SystemExit:
+    pass
+total = time.time() - start
+__builtin__.__import__ = real_import
+sys.stdout = stdout
+print json.dumps({'total': total, 'timings': timings,
+                  'modules': sorted(name for name in set(sys.modules) - before
+                                    if sys.modules[name] is not None)})
+'''
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def process_seconds(args):
+    '''Returns the median wall time of STARTUP_RUNS runs of the
+    interpreter with args.'''
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(STARTUP_RUNS):
+            start = time.time()
+            subprocess.call([sys.executable] + args, stdout=devnull)
+            times.append(time.time() - start)
+    return median(times)
+
+def probe_imports():
+    '''Returns the STARTUP_PROBE output of the run with the median
+    total import time.'''
+    runs = [json.loads(subprocess.check_output(
+                [sys.executable, '-c', STARTUP_PROBE, SCRIPT_PATH]))
+            for _ in range(STARTUP_RUNS)]
+    return sorted(runs, key=lambda run: run['total'])[len(runs) / 2]
+
+@suite
+def bench_startup():
+    bare = process_seconds(['-c', 'pass'])
+    script = process_seconds([SCRIPT_PATH, '--help'])
+    probe = probe_imports()
+    print 'median of %d runs: bare interpreter %.1fms, script %.1fms, ' \
+        'in the script %.1fms' % (STARTUP_RUNS, bare * 1000, script * 1000,
+                            probe['total'] * 1000)
+    print
+    rows = [('%.1f' % (own * 1000), '%.1f' % (cumulative * 1000), name)
+            for own, cumulative, name in sorted(probe['timings'],
+                                                reverse=True)]
+    print_table(('self ms', 'cumulative ms', 'module'),
+                rows[:STARTUP_SHOWN])
+    print
+    failed = False
+    cost = (script - bare) * 1000
+    print 'startup cost %.1fms, budget %dms' % (cost, STARTUP_BUDGET_MS)
+    if cost > STARTUP_BUDGET_MS:
+        print 'OVER BUDGET'
+        failed = True
+    eager = [name for name in probe['modules']
+             if name.split('.')[0] in STARTUP_LAZY_MODULES
+             or name in STARTUP_LAZY_MODULES]
+    if eager:
+        print 'Imported by a plain run: %s' % ', '.join(eager)
+        failed = True
+    return failed
+
+## labels -------------------------------------------------------------
+
+LABELS_MESSAGES = 20000
+LABELS_LATENCY = 0.05
+LABELS_RULES = [r'aa:{age}', r'archive/.+/{age}']
+LABELS_TEAMS = ['team%02d' % i for i in range(20)]
+LABELS_MATCHED = (['aa:%d' % days for days in range(1, 31)]
+                  + ['aa:%dh' % hours for hours in (6, 12, 18)]
+                  + ['aa:%dw' % weeks for weeks in range(1, 18)]
+                  + ['archive/%s/%dd' % (team, days)
+                     for team in LABELS_TEAMS for days in (7, 14, 30, 60, 90)])
+LABELS_OTHER = ['projects/p%03d' % i
+                for i in range(400 - len(LABELS_MATCHED))]
+LABELS_PARSES = 1000
+
+def make_labels_mailbox():
+    '''Returns a FakeMailbox of LABELS_MESSAGES messages dated over the
+    last 120 days. Most carry one of LABELS_MATCHED, a few two, and all
+    up to three of LABELS_OTHER.'''
+    rand = random.Random(0)
+    mailbox = fakeimap.FakeMailbox()
+    now = time.time()
+    for i in xrange(LABELS_MESSAGES):
+        labels = rand.sample(LABELS_OTHER, rand.randint(0, 3))
+        if rand.random() < 0.6:
+            labels.append(rand.choice(LABELS_MATCHED))
+            if rand.random() < 0.05:
+                labels.append(rand.choice(LABELS_MATCHED))
+        mailbox.add_message('Message #%d' % i,
+                            now - rand.randint(0, 120 * 86400), labels)
+    return mailbox
+
+def parse_rule_by_rule(rules, list_of_labels):
+    '''parse_label_list with every rule tried in turn on every label.'''
+    expressions = [re.compile(rule.replace('{age}', labelrules.AGE) + r'\Z')
+                   for rule in rules]
+    found = []
+    for item in list_of_labels:
+        label = item.split('"')[-2]
+        for expression in expressions:
+            match = expression.match(label)
+            if match:
+                found.append((label, labelrules.parse_age(
+                    *match.groups()[-2:])))
+                break
+    return sorted(found, key=lambda (label, age): (age, label))
+
+def time_parses(parse):
+    start = time.time()
+    for _ in xrange(LABELS_PARSES):
+        result = parse()
+    return (time.time() - start) / LABELS_PARSES, result
+
+def archive_labels(port, args, per_search):
+    '''archive_pipelined with at most per_search labels per SEARCH.'''
+    autoarchive.LABELS_PER_SEARCH = per_search
+    return archive_pipelined(port, args)
+
+@suite
+def bench_labels():
+    print '%d labels, %d matched by %s, %d messages, %dms round trip' % (
+        len(LABELS_MATCHED) + len(LABELS_OTHER), len(LABELS_MATCHED),
+        ' '.join(LABELS_RULES), LABELS_MESSAGES, LABELS_LATENCY * 1000)
+    print
+    listed = ['(\\HasNoChildren) "/" %s' % fakeimap.quote(label)
+              for label in LABELS_MATCHED + LABELS_OTHER]
+    rules = labelrules.LabelRules(LABELS_RULES)
+    rows = []
+    for name, parse in (
+            ('rule by rule', lambda: parse_rule_by_rule(LABELS_RULES, listed)),
+            ('LabelRules, first LIST',
+             lambda: labelrules.LabelRules(LABELS_RULES).parse_list(listed)),
+            ('LabelRules, later LISTs', lambda: rules.parse_list(listed))):
+        seconds, result = time_parses(parse)
+        rows.append((name, '%.3f' % (seconds * 1000), len(result)))
+    print_table(('LIST parsed', 'ms', 'labels matched'), rows)
+    print
+
+    saved = autoarchive.LABEL_PATTERN, autoarchive.LABEL_RULES
+    autoarchive.LABEL_PATTERN, autoarchive.LABEL_RULES = '*', LABELS_RULES
+    rows = []
+    try:
+        for args, per_search in (
+                ([], 1), ([], autoarchive.LABELS_PER_SEARCH),
+                (['--fetch-labels'], autoarchive.LABELS_PER_SEARCH),
+                (['--server-side'], 1),
+                (['--server-side'], autoarchive.LABELS_PER_SEARCH)):
+            server = fakeimap.FakeGmailServer(make_labels_mailbox(),
+                                              latency=LABELS_LATENCY)
+            server.start()
+            (archived, commands), elapsed, peak = run_isolated(
+                archive_labels, server.port, args, per_search)
+            server.shutdown()
+            server.server_close()
+            if args == ['--fetch-labels']:
+                search = '-'
+            else:
+                search = per_search == 1 and 'per label' or 'per age limit'
+            rows.append((' '.join(args) or '(client side)', search,
+                         '%.2f' % elapsed, commands, archived))
+    finally:
+        autoarchive.LABEL_PATTERN, autoarchive.LABEL_RULES = saved
+    print_table(('options', 'SEARCH', 'seconds', 'commands', 'archived'),
+                rows)
+
+## folders ------------------------------------------------------------
+
+# The fake server answers every connection from one interpreter, kept
+# small enough for the link to take most of the time, as it does with
+# gmail
+FOLDERS_SIZES = [('INBOX', 8000), ('Newsletters', 4000), ('Receipts', 2000),
+                 ('Lists/python', 800)]
+FOLDERS_LATENCY = 0.1
+FOLDERS_BANDWIDTH = 256 * 1024
+FOLDERS_CONNECTIONS = [1, 2, 4]
+
+def make_folders_mailbox():
+    '''Returns a FakeMailbox with the folders of FOLDERS_SIZES, each of
+    messages only in it, half of them with an aa: label.'''
+    rand = random.Random(0)
+    mailbox = fakeimap.FakeMailbox()
+    now = time.time()
+    for folder, size in FOLDERS_SIZES:
+        for i in xrange(size):
+            labels = []
+            if folder != fakeimap.INBOX:
+                labels.append(folder)
+            if rand.random() < 0.5:
+                labels.append(rand.choice(PIPELINE_LABELS))
+            mailbox.add_message('%s #%d' % (folder, i),
+                                now - rand.randint(0, 60 * 86400), labels,
+                                in_inbox=folder == fakeimap.INBOX)
+    return mailbox
+
+def archive_folders(port, args):
+    '''Runs archive_folders with the command line args on the mailbox
+    served on port, without the cache. Returns a tuple (messages
+    archived, commands).'''
+    options, _ = autoarchive.setup_option_parser().parse_args(args)
+    options.folders = autoarchive.parse_folders(options.folders)
+    run_metrics = autoarchive.metrics.MergedMetrics('bench@gmail.com')
+    saved = autoarchive.IMAP_HOST, autoarchive.IMAP_PORT, autoarchive.IMAP_SSL
+    autoarchive.IMAP_HOST, autoarchive.IMAP_PORT = 'localhost', port
+    autoarchive.IMAP_SSL = False
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        results = autoarchive.archive_folders(
+            xoauth.OAuthEntity('token', 'secret'), 'bench@gmail.com',
+            options, '', on_connect=lambda s: run_metrics.add(s.metrics))
+    finally:
+        sys.stdout = stdout
+        autoarchive.IMAP_HOST, autoarchive.IMAP_PORT, \
+            autoarchive.IMAP_SSL = saved
+    for result in results:
+        if result.error:
+            raise RuntimeError('%s: %s' % (result.mailbox, result.error))
+    archived = sum(result.archived for result in results)
+    return archived, run_metrics.record(archived)['commands']
+
+@suite
+def bench_folders():
+    print '%s, %dms round trip, %d kB/s per connection' % (', '.join(
+        '%s %d' % folder for folder in FOLDERS_SIZES), FOLDERS_LATENCY * 1000,
+        FOLDERS_BANDWIDTH / 1024)
+    print
+    folders = ','.join(folder for folder, _ in FOLDERS_SIZES)
+    rows = []
+    for engine in ([], ['--server-side']):
+        cases = [('largest alone', ['--folders', FOLDERS_SIZES[0][0],
+                                    '--connections', '1'])]
+        for connections in FOLDERS_CONNECTIONS:
+            cases.append(('%d connection%s' % (
+                              connections, connections > 1 and 's' or ''),
+                          ['--folders', folders, '--connections',
+                           str(connections)]))
+        for name, args in cases:
+            server = fakeimap.FakeGmailServer(make_folders_mailbox(),
+                                              latency=FOLDERS_LATENCY,
+                                              bandwidth=FOLDERS_BANDWIDTH)
+            server.start()
+            (archived, commands), elapsed, peak = run_isolated(
+                archive_folders, server.port, engine + args)
+            server.shutdown()
+            server.server_close()
+            rows.append((' '.join(engine) or '(client side)', name,
+                         '%.2f' % elapsed, commands, archived))
+    print_table(('options', 'folders', 'seconds', 'commands', 'archived'),
+                rows)
+
+## End suites ---------------------------------------------------------
+
+def main(argv):
+    names = argv[1:] or sorted(SUITES)
+    for name in names:
+        if name not in SUITES:
+            print 'Unknown suite %s, choose from: %s' % (
+                name, ', '.join(sorted(SUITES)))
+            return 1
+    failed = False
+    for name in names:
+        print '== %s ==' % name
+        # Suites with a budget return True when they are over it
+        failed = SUITES[name]() or failed
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -26,7 +26,9 @@ specified number of days.
 
 Usage:
     1. Set up filters in gmail matching the pattern 'aa:\d+' where the
-       '\d+' is the age limit in days, e.g. 'aa:3'.
+       '\d+' is the age limit in days, e.g. 'aa:3'. Add h or w for
+       hours or weeks, e.g. 'aa:12h' or 'aa:2w'. Other labels, nested
+       ones like 'archive/30d' too, can set ages with LABEL_RULES.
     2. [Optional] Enter you email address below for the variable
        EMAIL_ADDRESS. If you skip this step, you will be prompted to
        enter your email address interactively when the script runs.
@@ -37,6 +39,118 @@ Usage:
     The script will print the subject line for any emails that are
     auto-archived.
 
+    Note: The Date header and age limit of every labeled message are
+    cached at STATE_PATH, so later runs only fetch headers for messages
+    that arrived since the previous run. With CONDSTORE the cache
+    also keeps HIGHESTMODSEQ, so an unchanged mailbox costs nothing
+    past the SELECT and labels changed on old messages are picked up
+    with FETCH (CHANGEDSINCE). Without it, remove the file to force a
+    full rescan, e.g. after labeling old messages by hand.
+
+Options:
+    --server-side   Let gmail decide which messages are too old with an
+                    X-GM-RAW 'older_than:' search per age limit. No
+                    headers are downloaded and no cache is kept. Ages
+                    in hours are searched with 'before:' instead.
+    -v, --verbose   With --server-side, also fetch and print the
+                    subjects of the archived messages.
+    --fetch-labels  Find new labeled messages with one X-GM-LABELS FETCH
+                    over the inbox instead of one SEARCH per age limit.
+                    Cheaper when there are many distinct limits.
+
+    --internaldate  Age messages from the time gmail received them
+                    (INTERNALDATE) rather than their Date header, which
+                    is set by the sender and can be wrong.
+    --threads WHICH Archive whole threads: fetch the X-GM-THRID of the
+                    labeled messages and the date of only the newest or
+                    oldest (WHICH) message of each thread. Once one of
+                    its messages is past its age limit, the thread goes.
+
+    --pipeline      Send the per age SEARCHes, the FETCH batches and
+                    the STOREs PIPELINE_DEPTH at a time instead of
+                    waiting for each response, so a slow link costs one
+                    round trip per group rather than per command.
+
+    When a message carries several aa: labels the shortest age wins.
+
+    --accounts FILE Archive every account listed in FILE instead of
+                    EMAIL_ADDRESS. Each line holds an email address,
+                    optionally followed by the path of its oauth
+                    identity file (default OAUTH_PATH.<email>). Accounts
+                    without an identity are reported, not set up.
+    --workers N     Number of accounts processed concurrently.
+    --timeout SECS  Give up on an account after SECS seconds.
+    --queue FILE    Split the --accounts with the other processes, on
+                    this machine or others, that use the same job table
+                    FILE, an SQLite database: every account is leased
+                    to one of them and taken over if it dies. Each one
+                    archives the accounts no one archived since it
+                    started, see lib/jobqueue.py.
+    --async         Drive all --accounts connections from a single
+                    thread with lib.asyncimap instead of a thread per
+                    worker, so --workers can be in the hundreds. It
+                    runs the same archiving code, only the connect
+                    phase is missing from --metrics.
+
+    --rate N        Send at most N IMAP commands per second per account.
+    --bandwidth N   Send and receive at most N bytes per second per
+                    account, before compression.
+    --global-rate N, --global-bandwidth N
+                    The same for all --accounts together. Either way an
+                    account halves its rates whenever gmail throttles it
+                    or drops the connection and slowly raises them back,
+                    see lib/ratelimit.py. Not supported with --async.
+
+    --record FILE   Append the IMAP sessions to FILE (FILE.<email> with
+                    --accounts), credentials redacted. Not supported
+                    with --async.
+    --replay FILE   Play the sessions recorded in FILE back instead of
+                    connecting, e.g. to reproduce a run or benchmark
+                    the client. Replays run without the cache.
+    --replay-timing With --replay, let every response take as long as
+                    it did when recorded rather than run flat out.
+
+    --folders LIST  Archive the comma separated mailboxes in LIST, e.g.
+                    INBOX,Receipts, instead of only the inbox. The
+                    labels are listed once, then up to --connections N
+                    (FOLDER_CONNECTIONS) connections per account take
+                    the folders, largest first, so a run lasts about as
+                    long as the largest one. Each folder has its own
+                    cache, STATE_PATH.<folder> for all but the inbox.
+                    Archiving from a folder takes its label off. Not
+                    with --daemon, --async, --record or --replay.
+
+    --daemon        Keep running instead of exiting after one pass.
+                    The connection IDLEs until the next message comes
+                    due, new messages are picked up as they arrive and
+                    the connection is reopened when it drops. Messages
+                    are archived at most BATCH_DELAY seconds late so
+                    ones coming due together share a single STORE.
+
+    --metrics FILE  Append the wall time, IMAP commands, bytes sent and
+                    received and messages handled by every phase of the
+                    run (connect, select, get_autoarchive_labels,
+                    get_message_ids, fetch_emails,
+                    get_messages_to_archive, archive_messages) to FILE
+                    as one JSON line per account.
+    --prometheus FILE
+                    Write the same metrics to FILE in the Prometheus
+                    text format, for node_exporter's textfile collector.
+                    With --daemon both are written after every batch,
+                    counting from the last (re)connect.
+
+    --profile FILE  Run under cProfile, every thread, and write the
+                    pstats to FILE (python -m pstats FILE) and samples
+                    of the stacks to FILE.collapsed, for flamegraph.pl
+                    or speedscope. The slowest functions are printed.
+    --trace-memory  Report how much memory every phase took and which
+                    types of objects grew the most in it.
+
+    Note: Dropped connections and temporary server errors are retried
+    on a new connection, RETRY_ATTEMPTS times with exponential backoff.
+    The cache is checkpointed as the run goes, every CHECKPOINT_SECONDS,
+    so a retried or restarted run resumes instead of starting over.
+
     Note: Once you authorize the oauth token/secret, they are saved to
     disk at OAUTH_PATH. If the token/secret no longer work, simply
     remove the file at OAUTH_PATH. The next time the script is run it
@@ -56,15 +170,11 @@ Hints about GMail:
 
 '''next features
 - oauth instead of pw in file *completed*
-- download all labels and use regex to match instead of autoarchive:*
+- download all labels and use regex to match instead of autoarchive:* *completed*
 - fetch all messages at once instead of using a separate request for each.
 '''
 
-from datetime import datetime, tzinfo, timedelta
 import imaplib
-import email
-from lib import xoauth
-from itertools import chain
 import os.path
 
 ## Config -------------------------------------------------------------
@@ -81,255 +191,71 @@ OAUTH_PATH = os.path.join(os.path.dirname(__file__), '.oauth_identity')
 # This pattern must conform to the IMAP spec listed here:
 #   http://tools.ietf.org/search/rfc3501#section-6.3.8
 # Typically it will be something like 'autoarchive:*'
-# Note that later in the script the labels are expected to contain
-# a color and then an integer reprsenting the number of days after the
-# colon.
+# Only the labels it lists are matched against LABEL_RULES, so it must
+# cover them all, '*' lists every label.
 LABEL_PATTERN = 'aa:*'
 
-## End Config ---------------------------------------------------------
+# Which labels set an age limit: regular expressions with {age} where
+# the limit goes, a number of days or a number followed by h, d or w for
+# hours, days or weeks, e.g. 'aa:12h' or, with r'archive/{age}',
+# 'archive/2w'. Labels matching no rule are ignored, the first rule that
+# matches wins.
+LABEL_RULES = [r'aa:{age}']
+
+# The IMAP server, only worth changing to point at a test server
+IMAP_HOST = 'imap.gmail.com'
+IMAP_PORT = imaplib.IMAP4_SSL_PORT
+IMAP_SSL = True
+# Compress the connection when the server offers COMPRESS=DEFLATE.
+IMAP_COMPRESS = True
+
+# Where the per message label ages and dates are cached between runs.
+# Set to '' to disable the cache and rescan the whole mailbox each run.
+STATE_PATH = os.path.join(os.path.dirname(__file__), '.autoarchive_state')
+
+# Daemon mode (--daemon) timings, all in seconds.
+# How long to IDLE before restarting the command. Gmail drops idle
+# connections after about 30 minutes.
+IDLE_SECONDS = 10 * 60
+# How late a message may be archived, so messages coming due close
+# together are archived with a single STORE.
+BATCH_DELAY = 60
+# How long to wait before reconnecting after the connection dropped or
+# gmail throttled it, plus the backoff of the retries below.
+RECONNECT_DELAY = 30
+
+# A run that fails with a transient error, e.g. a dropped connection, is
+# retried on a new connection after a random delay of up to RETRY_DELAY
+# seconds, doubled after every failure and capped at RETRY_MAX_DELAY. It
+# gives up after RETRY_ATTEMPTS failures in a row without progress.
+RETRY_ATTEMPTS = 5
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 5 * 60
+# How often, in seconds, the cache is saved while a run goes on, so a
+# retried or restarted run picks up from there.
+CHECKPOINT_SECONDS = 10
+
+# Rate limits per second, 0 for none. ACCOUNT_* apply to each account,
+# GLOBAL_* to all --accounts together. Either way an account slows down
+# whenever gmail throttles it, see lib/ratelimit.py.
+ACCOUNT_COMMANDS_PER_SECOND = 0
+ACCOUNT_BYTES_PER_SECOND = 0
+GLOBAL_COMMANDS_PER_SECOND = 0
+GLOBAL_BYTES_PER_SECOND = 0
+
+# How many connections --folders opens per account at most. Gmail allows
+# 15 per account, shared with every other client.
+FOLDER_CONNECTIONS = 4
 
-## First some helpful timezone stuff
-# From http://docs.python.org/library/datetime.html
-ZERO = timedelta(0)
-class FixedOffset(tzinfo):
-    """Fixed offset in minutes east from UTC."""
-
-    def __init__(self, offset, name):
-        self.__offset = timedelta(minutes = offset)
-        self.__name = name
-
-    def utcoffset(self, dt):
-        return self.__offset
-
-    def tzname(self, dt):
-        return self.__name
-
-    def dst(self, dt):
-        return ZERO
-
-utc = FixedOffset(0, 'UTC')
-
-def connect(oauth_entity, email):
-    consumer = xoauth.OAuthEntity('anonymous', 'anonymous')
-    xoauth_string = xoauth.GenerateXOauthString(
-        consumer, oauth_entity, email, 'imap',
-        None, None, None)
-
-    imap_conn = imaplib.IMAP4_SSL('imap.gmail.com')
-    #imap_conn.debug = 4
-    imap_conn.authenticate('XOAUTH', lambda x: xoauth_string)
-    
-    print 'Connected to mailbox successfully.'
-    return imap_conn
-
-def get_autoarchive_labels(s, label_pattern):
-    '''Returns a list of tuples (str labelname, int age_in_days)'''
-    _, list_of_labels = s.list(pattern=label_pattern)
-    # Annoyingly if has no matches it returns a list with one element, None
-    if list_of_labels[0] == None:
-        return []
-
-    # labels looks like: '(\\HasNoChildren) "/" "aa:1"'
-    # we want to extract the 'aa:1' part
-    ret = []
-    #print list_of_labels
-    for item in list_of_labels:
-        label = item.split('"')[-2] # label = 'aa:3'
-        age = int(label.split(':', 1)[-1]) # age = 3
-        ret.append((label, age))
-
-    return ret
-
-def get_message_ids(s, label):
-    '''Takes an imap connection 's', and a label and returns a list
-    of message ids for that label'''
-    _, email_ids_string = s.search(None, 'X-GM-LABELS', label)
-    # e.g. email_ids_string = ['2 3 4 8 11 14 15 17 18']
-    email_ids = email_ids_string[0].split()
-    return email_ids
-
-def build_tz(tzstring):
-    '''Takes a tzstring like '-0500 (EST)' or '-0500' and returns a
-    datetime.tzinfo class''' 
-    # messy :(
-
-    # Using split(), the first item is always the offset, e.g. -0500
-    parts = tzstring.split()
-    offset = parts[0]
-    
-    # If there are 2 parts, the second part will be the tzname 
-    name = 'UNKNOWN'
-    if len(parts) > 1:
-        name = parts[1].strip('()')
-
-    # We need to convert offset into minutes and keep the +/- sign
-    sign = offset[0]
-    hours = int(offset[1:3])
-    minutes = int(offset[3:5])
-    offset_minutes = hours * 60 + minutes
-    if sign == '-':
-        offset_minutes *= -1
-    tz = FixedOffset(offset_minutes, name)
-    return tz
-
-def fetch_emails(s, msg_ids):
-    '''Returns a dict, keys are msg_ids, values are email objects.
-    Currently hardcoded to only fetch the date and subject headers.'''
-    msg_id_str = ','.join(msg_ids)
-    _, messages = s.fetch(msg_id_str, '(body[header.fields (date subject)])')
-
-    # Every 2nd item is a closing ')' so we skip by 2
-    emails = {}
-    for msg in messages[::2]:
-        names, values = msg
-        msg_id, _ = names.split(' ', 1)
-        emails[msg_id] = email.message_from_string(values)
-    return emails
-
-def get_messages_to_archive(ages, emails):
-    '''Returns a list of msg ids to be archived.'''
-    # ages = {msg_id: age, ... }
-    # emails = {msg_id: email, ... }
-    now = datetime.utcnow().replace(tzinfo=utc)
-
-    old_msgs = []
-    for msg_id, mail in emails.items():
-        datestr = mail.get('Date').strip()
-        # e.g. datestr = 'Thu, 7 Apr 2011 08:34:04 -0400 (EDT)'
-        subject = mail.get('Subject').replace('\r\n', ' ')
-
-        # %z doesn't work , must manually build timezone.
-        # We want to remove the offset and sometimes present tzname from 
-        # datestr so we can use strptime() 
-        
-        # sometimes datestr has '(tzname)' at the end and sometimes not, so we
-        # split from left a set amount, guess i could use re
-        parts = datestr.split(' ', 5)
-        datetimestr = ' '.join(parts[:5])
-        tzstring = parts[5]
-
-        # Make dt object and apply the correct tzinfo
-        dt_naive = datetime.strptime(datetimestr, r'%a, %d %b %Y %H:%M:%S')
-        tz = build_tz(tzstring)
-        dt = dt_naive.replace(tzinfo=tz)
-        
-        assert msg_id in ages.keys(), 'No age limit for message %s' % msg_id
-        age_limit = timedelta(days=ages[msg_id])
-
-        # The magical if statement, you knew it was somewhere :)
-        if (now - dt) > age_limit:
-            print 'Preparing message %s to be archived. Subject: %s' % (msg_id, subject)
-            old_msgs.append(msg_id)
-
-    return old_msgs
-
-def archive_messages(s, msg_ids):
-    ''' Simply set the deleted flag and msg will be archived in 
-    gmail. '''
-    print 'Archiving messages.'
-    msg_str = ','.join(msg_ids)
-    s.store(msg_str, '+FLAGS', '"\\\\Deleted"')
-
-
-def ask_for_email():
-    email = raw_input('Email address (name@gmail.com): ')
-    return email.strip()
-
-def write_oauth_identity(fn, oauth_entity):
-    with open(fn, 'w') as f:
-        f.write('%s\n%s' % (oauth_entity.key, oauth_entity.secret))
-
-def read_oauth_identity(fn):
-    '''Returns an xoauth.OAuthEntity from a given fn.
-    Expects the token on line 1 and the secret on line 2.'''
-    try:
-        with open(fn) as f:
-            lines = f.readlines()
-    except IOError:
-        print 'Error reading from %s. Check that it exists.' % fn
-        return None
-    return xoauth.OAuthEntity(lines[0].strip(), lines[1].strip())
-
-def generate_new_oauth_entity(user, fn):
-    '''Generates a new oauth token/secret for a given user. The new
-    pair is written to the given fn. '''
-    scope = 'https://mail.google.com/'
-    consumer = xoauth.OAuthEntity('anonymous', 'anonymous')
-    google_accounts_url_generator = xoauth.GoogleAccountsUrlGenerator(user)
-    request_token = xoauth.GenerateRequestToken(consumer, scope, None, None, google_accounts_url_generator)
-
-    # Wait for user to visit URL and authenticate this application.  After
-    # authenticating this application, they must paste the verification code.
-    oauth_verifier = raw_input('Enter verification code: ').strip()
-
-    # Get the token and token secret to be saved and used going forward for
-    # authentiaction
-    access_token = xoauth.GetAccessToken(consumer, request_token, oauth_verifier,
-                          google_accounts_url_generator)
-
-    if not access_token:
-        print 'There was a problem getting a valid access token.'
-        return None
-
-    # Save the credentials for the future.
-    write_oauth_identity(fn, access_token)
-
-    return access_token
+## End Config ---------------------------------------------------------
 
 def main():
-    # Check if email is stored otherwise we have to ask for it
-    email = EMAIL_ADDRESS
-    if len(email) == 0:
-        email = ask_for_email()
-
-    # First check for oauth credentials
-    oauth_entity = read_oauth_identity(OAUTH_PATH)
-
-    # If not saved credentials, attempt to create new ones
-    if not oauth_entity:
-        print 'No existing OAuth credentials found. Attempting to create a new identity.'
-        oauth_entity = generate_new_oauth_entity(email, OAUTH_PATH)
-
-    # If the user mistypes the verification code, generate_new_oauth_entity
-    # will return None
-    if not oauth_entity:
-        print 'Cannot continue without a valid token.'
-        return
-
-    # Connect to the server using oauth
-    s = connect(oauth_entity, email)
-
-    # Select inbox
-    s.select('INBOX')
-
-    # Get aa:\d+ labels
-    label_ages = get_autoarchive_labels(s, LABEL_PATTERN)
-
-    # Create a dict, keys are msg_ids, values are the age_limit parsed from the
-    # gmail label
-    ages = {}
-    for label, age in label_ages:
-        msg_ids = get_message_ids(s, label)
-        ages.update([(msg_id, age) for msg_id in msg_ids])
-
-
-    # Get the message headers for all messages in question with a single FETCH
-    all_msg_ids = ages.keys()
-    emails = fetch_emails(s, all_msg_ids)
-
-    # Get a message ids for emails to be archived based on email date
-    old_msgs = get_messages_to_archive(ages, emails)
-
-    if len(old_msgs) > 0:
-        archive_messages(s, old_msgs)
-    else:
-        print 'No messages to be archived.'
-
-    # bye
-    s.close()
-    s.logout()
-    
-    
+    # Imported only now, the bulk of the code is in lib/autoarchive.py
+    # so that it loads from its .pyc instead of being compiled every run
+    from lib import autoarchive
+    autoarchive.configure(globals())
+    autoarchive.main()
+
 if __name__ == '__main__':
     main()
     print 'Done.'
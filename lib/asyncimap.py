@@ -0,0 +1,489 @@
+'''
+An event driven IMAP client, for driving many mailboxes from a single
+thread.
+
+imaplib blocks on every command, so talking to several servers at once
+costs a thread per connection. Python 2 has no asyncio, so this is
+built on asyncore/asynchat and generator based coroutines instead. A
+session is a generator that yields IMAP commands and is resumed with
+their untagged responses once the tagged OK arrives, or has an
+IMAPError thrown into it on NO/BAD:
+
+    def session(label):
+        yield xoauth(xoauth_string)
+        yield 'SELECT INBOX'
+        untagged = yield 'UID SEARCH X-GM-LABELS %s' % quote(label)
+        print search_result(untagged)
+        yield 'LOGOUT'
+
+    socket_map = {}
+    run([lambda: IMAPSession('imap.gmail.com', 993, session('aa:3'),
+                             socket_map=socket_map)], socket_map, 10)
+
+Untagged responses are tuples (response, literal) shaped like those of
+lib.imapstream: the response text without the leading '* ' and the
+first string literal it contained, or None.
+
+Sessions are built from smaller ones. A session may yield
+ - another session, which runs as part of it: it is resumed with what
+   that one raised Return with, or None, and gets its exceptions,
+ - a list of commands, sent back to back up to the IMAPSession's
+   pipeline_depth at a time: it is resumed with a list of the untagged
+   responses of each one,
+ - a Fetch, resumed with an iterable of the (response, literal) tuples
+   of its FETCH responses only.
+lib.imapstream.run_session() runs the same sessions on an imaplib
+connection, where the responses to a list or a Fetch are read as the
+session goes through them: it must do so before its next command.
+
+Once a session's 'COMPRESS DEFLATE' succeeds the connection is
+compressed with lib.compress, kept as the session's .deflate. Like a
+lib.metrics.counting() connection, an IMAPSession counts its commands
+and bytes, so it can carry the Metrics of its run.
+'''
+
+import asynchat
+import asyncore
+import base64
+import re
+import socket
+import ssl
+import sys
+import time
+import types
+from collections import deque
+
+from lib.compress import Deflate
+
+# How often run() checks the session timeouts, in seconds
+POLL_SECONDS = 0.5
+
+# A response line announcing a literal, e.g. '... BODY[HEADER] {60}'
+LITERAL_RE = re.compile(r'\{(\d+)\}$')
+
+
+class IMAPError(Exception):
+    '''A NO or BAD response, or a session that failed.'''
+
+
+class Timeout(IMAPError):
+    '''A session ran past its deadline.'''
+
+
+class Command(object):
+    '''A command for a session to send. continuation is sent when the
+    server answers with a '+' continuation request.'''
+
+    def __init__(self, text, continuation=None):
+        self.text = text
+        self.continuation = continuation
+
+
+class Fetch(Command):
+    '''A UID FETCH of items for the messages in msg_set, whose responses
+    a session goes through one at a time.'''
+
+    def __init__(self, msg_set, items):
+        Command.__init__(self, 'UID FETCH %s %s' % (msg_set, items))
+        self.msg_set = msg_set
+        self.items = items
+
+
+class Return(Exception):
+    '''Raised by a session to end with value, Python 2 generators can't
+    return one.'''
+
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Nested(object):
+    '''Runs session along with the sessions it yields, see the module
+    docstring. Has the send, throw and close of a generator, and yields
+    commands only. Once it is done, result is what session raised
+    Return with.'''
+
+    def __init__(self, session):
+        self.stack = [session]
+        self.result = None
+
+    def send(self, value):
+        return self.step(value, None)
+
+    def throw(self, typ, value=None, tb=None):
+        return self.step(None, (typ, value, tb))
+
+    def step(self, value, error):
+        while True:
+            session = self.stack[-1]
+            try:
+                if error:
+                    request = session.throw(*error)
+                else:
+                    request = session.send(value)
+            except Return, e:
+                value, error = e.value, None
+            except StopIteration:
+                value, error = None, None
+            except Exception:
+                value, error = None, sys.exc_info()
+            else:
+                if not isinstance(request, types.GeneratorType):
+                    return request
+                self.stack.append(request)
+                value, error = None, None
+                continue
+
+            # The session is done, back to the one that yielded it
+            self.stack.pop()
+            if not self.stack:
+                if error:
+                    raise error[0], error[1], error[2]
+                self.result = value
+                raise StopIteration
+
+    def close(self):
+        while self.stack:
+            self.stack.pop().close()
+
+
+def xoauth(xoauth_string):
+    '''Returns the AUTHENTICATE XOAUTH command for xoauth_string.'''
+    return Command('AUTHENTICATE XOAUTH', base64.b64encode(xoauth_string))
+
+
+def quote(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def capabilities(untagged):
+    '''Returns the capabilities listed by a CAPABILITY command as a
+    set of upper case strs.'''
+    names = set()
+    for response, _ in untagged:
+        if response.upper().startswith('CAPABILITY '):
+            names.update(response.upper().split()[1:])
+    return names
+
+
+def search_result(untagged):
+    '''Returns the uids of a SEARCH, as strs.'''
+    ids = []
+    for response, _ in untagged:
+        if response.startswith('SEARCH'):
+            ids.extend(response.split()[1:])
+    return ids
+
+
+def fetch_responses(untagged):
+    '''Returns the (response, literal) tuples of a FETCH, leaving out
+    anything unrelated such as '12 EXISTS'.'''
+    return [(response, literal) for response, literal in untagged
+            if ' FETCH ' in response]
+
+
+def response_code(untagged, code):
+    '''Returns the value of a response code like [UIDVALIDITY 3] found
+    in the untagged responses, or None.'''
+    pattern = re.compile(r'\[%s (\S+)\]' % code)
+    for response, _ in untagged:
+        match = pattern.search(response)
+        if match:
+            return match.group(1)
+    return None
+
+
+class IMAPSession(asynchat.async_chat):
+    '''One connection, running the coroutine session, or the one the
+    function session returns when called with the IMAPSession. callback
+    is called with the session once it is done, check .error to see if
+    it failed. A session still running timeout seconds after it was
+    created is failed by run() with a Timeout.'''
+
+    ac_in_buffer_size = 65536
+    # How many commands of a list are in flight at a time
+    pipeline_depth = 1
+    commands = 0
+    bytes_sent = 0
+    bytes_received = 0
+    metrics = None
+
+    def __init__(self, host, port, session, use_ssl=True, socket_map=None,
+                 timeout=None, callback=None):
+        asynchat.async_chat.__init__(self, map=socket_map)
+        if not isinstance(session, types.GeneratorType):
+            session = session(self)
+        self.session = Nested(session)
+        self.use_ssl = use_ssl
+        self.callback = callback
+        self.deadline = timeout and time.time() + timeout
+        self.handshaking = False
+        self.greeted = False
+        self.done = False
+        self.error = None
+        # Set once COMPRESS DEFLATE succeeded, with the compressed bytes
+        # the socket hasn't taken yet
+        self.deflate = None
+        self.wire_out = ''
+
+        # What the session yielded, its commands still to send and
+        # those running as (tag, Command), the untagged responses of the
+        # oldest so far, those of the ones done and the first failure,
+        # and the parts of the response being read
+        self.tagnum = 0
+        self.request = None
+        self.queued = deque()
+        self.running = deque()
+        self.untagged = []
+        self.results = []
+        self.failure = None
+        self.incoming = []
+        self.parts = []
+        self.literal = None
+        self.in_literal = False
+
+        self.set_terminator('\r\n')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((host, port))
+        except socket.error, e:
+            self.fail(e)
+
+    ## Transport --------------------------------------------------------
+
+    def handle_connect(self):
+        if self.use_ssl:
+            self.socket = ssl.wrap_socket(self.socket,
+                                          do_handshake_on_connect=False)
+            self.handshaking = True
+            self.do_handshake()
+
+    def do_handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                             ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        self.handshaking = False
+
+    def writable(self):
+        return (self.handshaking or bool(self.wire_out)
+                or asynchat.async_chat.writable(self))
+
+    def handle_read(self):
+        if self.handshaking:
+            self.do_handshake()
+            return
+        asynchat.async_chat.handle_read(self)
+        # SSL may hold decrypted data that select() doesn't know about
+        while (self.use_ssl and not self.done and self.socket
+               and self.socket.pending()):
+            asynchat.async_chat.handle_read(self)
+
+    def handle_write(self):
+        if self.handshaking:
+            self.do_handshake()
+            return
+        self.send_wire()
+        asynchat.async_chat.handle_write(self)
+
+    def recv(self, size):
+        try:
+            data = asynchat.async_chat.recv(self, size)
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                return ''
+            raise
+        if self.deflate:
+            data = self.deflate.decompress(data)
+        self.bytes_received += len(data)
+        return data
+
+    def send(self, data):
+        if self.deflate:
+            # Take all of data, what the socket doesn't is sent later
+            self.wire_out += self.deflate.compress(data)
+            self.send_wire()
+            sent = len(data)
+        else:
+            sent = self.send_raw(data)
+        self.bytes_sent += sent
+        return sent
+
+    def send_wire(self):
+        if self.wire_out:
+            self.wire_out = self.wire_out[self.send_raw(self.wire_out):]
+
+    def send_raw(self, data):
+        try:
+            return asynchat.async_chat.send(self, data)
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                return 0
+            raise
+
+    def handle_close(self):
+        self.fail(IMAPError('Connection closed by the server'))
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    ## Responses --------------------------------------------------------
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.incoming)
+        self.incoming = []
+        if self.in_literal:
+            self.in_literal = False
+            self.set_terminator('\r\n')
+            if self.literal is None:
+                self.literal = data
+            return
+
+        self.parts.append(data)
+        match = LITERAL_RE.search(data)
+        if match:
+            size = int(match.group(1))
+            if size:
+                self.in_literal = True
+                self.set_terminator(size)
+            elif self.literal is None:
+                self.literal = ''
+            return
+
+        response, literal = ' '.join(self.parts), self.literal
+        self.parts = []
+        self.literal = None
+        self.handle_response(response, literal)
+
+    def handle_response(self, response, literal):
+        if not self.greeted:
+            if not response.startswith('* OK'):
+                self.fail(IMAPError('Unexpected greeting: %s' % response))
+                return
+            self.greeted = True
+            self.resume()
+        elif response.startswith('+'):
+            command = self.running and self.running[0][1]
+            self.push((command and command.continuation or '') + '\r\n')
+        elif response.startswith('* '):
+            self.untagged.append((response[2:], literal))
+        elif self.running and response.startswith(self.running[0][0] + ' '):
+            tag, command = self.running.popleft()
+            status = response[len(tag) + 1:]
+            untagged = self.untagged
+            self.untagged = []
+            if not status.startswith('OK'):
+                # Those already sent are still read, as by
+                # imapstream.pipeline()
+                self.queued.clear()
+                self.failure = self.failure or IMAPError(status)
+            else:
+                # The server compresses everything after this OK
+                if command.text.upper() == 'COMPRESS DEFLATE':
+                    self.deflate = Deflate()
+                self.results.append(untagged)
+            self.send_queued()
+            if not self.running:
+                self.complete()
+
+    ## Session ----------------------------------------------------------
+
+    def resume(self, untagged=None, error=None):
+        '''Runs the session up to its next command and sends it.'''
+        try:
+            if error:
+                request = self.session.throw(error)
+            else:
+                request = self.session.send(untagged)
+        except StopIteration:
+            self.finish()
+            return
+        except Exception, e:
+            self.fail(e)
+            return
+
+        self.request = request
+        if not isinstance(request, list):
+            request = [request]
+        self.queued.extend(isinstance(command, basestring)
+                           and Command(command) or command
+                           for command in request)
+        self.results = []
+        self.failure = None
+        if not self.queued:
+            self.complete()
+            return
+        self.send_queued()
+
+    def send_queued(self):
+        '''Sends the queued commands the pipeline has room for.'''
+        lines = []
+        while self.queued and len(self.running) < max(self.pipeline_depth,
+                                                      1):
+            command = self.queued.popleft()
+            self.tagnum += 1
+            self.commands += 1
+            tag = 'A%d' % self.tagnum
+            self.running.append((tag, command))
+            lines.append('%s %s\r\n' % (tag, command.text))
+        if lines:
+            self.push(''.join(lines))
+
+    def complete(self):
+        '''Resumes the session with the outcome of what it yielded.'''
+        if self.failure:
+            self.resume(error=self.failure)
+        elif isinstance(self.request, list):
+            self.resume(self.results)
+        elif isinstance(self.request, Fetch):
+            self.resume(fetch_responses(self.results[0]))
+        else:
+            self.resume(self.results[0])
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.close()
+            if self.callback:
+                self.callback(self)
+
+    def fail(self, error):
+        '''Stops the session, recording error.'''
+        if self.done:
+            return
+        self.error = error
+        self.session.close()
+        self.finish()
+
+
+def run(starts, socket_map, concurrency):
+    '''Runs sessions until all are done, at most concurrency at a time.
+    starts is an iterable of functions, each creating an IMAPSession in
+    socket_map and returning it, or None if there is nothing to run.'''
+    starts = iter(starts)
+    active = []
+    while True:
+        while len(active) < concurrency:
+            start = next(starts, None)
+            if start is None:
+                break
+            session = start()
+            if session is not None:
+                active.append(session)
+        active = [session for session in active if not session.done]
+        if not active:
+            return
+
+        asyncore.loop(timeout=POLL_SECONDS, use_poll=True, map=socket_map,
+                      count=1)
+        now = time.time()
+        for session in active:
+            if session.deadline and now > session.deadline:
+                session.fail(Timeout('Timed out'))
@@ -0,0 +1,1905 @@
+'''
+The GMail Auto-Archiver, see gmail-autoarchive.py for what it does and
+how to run it.
+
+gmail-autoarchive.py only holds the settings and imports this module
+to run, so that the frequent runs, e.g. from cron, load the compiled
+code rather than compiling it all every time. The settings below are
+the script's defaults, configure() replaces them with its values.
+What only some runs need, --accounts, --record and --replay or setting
+up an oauth identity, is imported where it is used.
+'''
+
+import imaplib
+from lib import asyncimap, metrics, xoauth
+from lib.asyncimap import Fetch, Return
+from lib.compress import compress_imaplib
+from lib.dates import parse_date, parse_internaldate
+from lib.imapstream import PIPELINE_DEPTH, run_session
+from lib.labelrules import DAY, AgeTable, LabelRules
+from lib.msgset import (AdaptiveBatchSize, INITIAL_BATCH_SIZE,
+                        decode_message_set, message_sets)
+from lib.ratelimit import Limiter, THROTTLE_CODES, limited
+from lib.state import MessageState, load_state, save_state
+from contextlib import contextmanager
+from itertools import chain, islice
+from optparse import OptionParser
+import heapq
+import os.path
+import random
+import re
+import select
+import socket
+import sys
+import threading
+import time
+
+## Settings -----------------------------------------------------------
+
+# The config of gmail-autoarchive.py, where they are described, with
+# the same defaults. Paths are relative to the script.
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMAIL_ADDRESS = ''
+OAUTH_PATH = os.path.join(SCRIPT_DIR, '.oauth_identity')
+LABEL_PATTERN = 'aa:*'
+LABEL_RULES = [r'aa:{age}']
+IMAP_HOST = 'imap.gmail.com'
+IMAP_PORT = imaplib.IMAP4_SSL_PORT
+IMAP_SSL = True
+IMAP_COMPRESS = True
+STATE_PATH = os.path.join(SCRIPT_DIR, '.autoarchive_state')
+IDLE_SECONDS = 10 * 60
+BATCH_DELAY = 60
+RECONNECT_DELAY = 30
+RETRY_ATTEMPTS = 5
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 5 * 60
+CHECKPOINT_SECONDS = 10
+ACCOUNT_COMMANDS_PER_SECOND = 0
+ACCOUNT_BYTES_PER_SECOND = 0
+GLOBAL_COMMANDS_PER_SECOND = 0
+GLOBAL_BYTES_PER_SECOND = 0
+FOLDER_CONNECTIONS = 4
+
+def configure(settings):
+    '''Replaces the settings above with those in the dict settings,
+    e.g. the globals of gmail-autoarchive.py. Other names are
+    ignored.'''
+    for name, value in settings.items():
+        if name.isupper() and name in globals():
+            globals()[name] = value
+
+## End Settings -------------------------------------------------------
+
+_label_rules = None
+def label_rules():
+    '''Returns LABEL_RULES compiled into a lib.labelrules.LabelRules,
+    which remembers the labels it has seen. Raises ValueError if a rule
+    is malformed.'''
+    global _label_rules
+    if _label_rules is None or _label_rules.patterns != list(LABEL_RULES):
+        _label_rules = LabelRules(LABEL_RULES)
+    return _label_rules
+
+def make_xoauth_string(oauth_entity, email):
+    consumer = xoauth.OAuthEntity('anonymous', 'anonymous')
+    return xoauth.GenerateXOauthString(
+        consumer, oauth_entity, email, 'imap',
+        None, None, None)
+
+def connect(oauth_entity, email, host=None, port=None, imap_class=None,
+            pipelined=False, compress=None, limiter=None, transcript=None):
+    '''Opens an imap_class connection to host and authenticates with
+    XOAUTH. They default to IMAP_HOST, IMAP_PORT and, depending on
+    IMAP_SSL, imaplib.IMAP4_SSL or plain imaplib.IMAP4 (to talk to
+    lib.fakeimap). The connection counts its commands and bytes and
+    carries the Metrics of the run as .metrics. With pipelined, the
+    searches, fetches and stores that don't depend on each other are
+    sent PIPELINE_DEPTH at a time, see pipeline_depth(). compress
+    defaults to IMAP_COMPRESS, see start_compression(). limiter, a
+    lib.ratelimit.Limiter, paces every command from the login on.
+    transcript is a lib.transcript.Recorder to record the session with,
+    or a Replay to play a recorded one back instead of connecting.'''
+    xoauth_string = make_xoauth_string(oauth_entity, email)
+    if imap_class is None:
+        imap_class = IMAP_SSL and imaplib.IMAP4_SSL or imaplib.IMAP4
+    if compress is None:
+        compress = IMAP_COMPRESS
+
+    extra = {}
+    if transcript:
+        imap_class = transcript.imap_class(imap_class)
+        extra['transcript'] = transcript
+
+    run_metrics = metrics.Metrics(email)
+    with run_metrics.phase('connect'):
+        imap_conn = metrics.counting(limited(imap_class))(
+            host or IMAP_HOST, port or IMAP_PORT, **extra)
+        imap_conn.limiter = limiter
+        run_metrics.attach(imap_conn)
+        #imap_conn.debug = 4
+        imap_conn.authenticate('XOAUTH', lambda x: xoauth_string)
+        imap_conn.deflate = None
+        refresh_capabilities(imap_conn)
+        if compress:
+            start_compression(imap_conn)
+    imap_conn.pipeline_depth = pipelined and PIPELINE_DEPTH or 1
+    
+    print 'Connected to mailbox successfully.'
+    return imap_conn
+
+def refresh_capabilities(s):
+    '''Gmail only lists some capabilities, e.g. COMPRESS=DEFLATE and
+    CONDSTORE, once authenticated. Asks for them again and keeps them
+    as s.capabilities, where imaplib keeps those it got on connect.'''
+    _, data = s.capability()
+    s.capabilities = tuple(data[0].upper().split())
+
+def start_compression(s):
+    '''Turns on COMPRESS=DEFLATE on s if the server offers it and keeps
+    the lib.compress.Deflate, which counts the bytes before and after
+    compression, as s.deflate.'''
+    if 'COMPRESS=DEFLATE' in s.capabilities:
+        s.deflate = compress_imaplib(s)
+
+INBOX = 'INBOX'
+
+# The IMAP work from here to archive_mailbox is written as lib.asyncimap
+# sessions: generators that yield their commands, or the sessions they
+# build on, and raise Return with their result. run_session() runs them
+# on an imaplib connection and asyncimap on its own connections, so the
+# threads and --async take the same decisions.
+
+def select_mailbox(s, mailbox=INBOX, condstore=False):
+    '''Selects mailbox, the inbox by default, and returns the untagged
+    responses, see get_uidvalidity. With condstore, CONDSTORE is enabled
+    if the server supports it, see get_highestmodseq.'''
+    command = 'SELECT %s' % asyncimap.quote(mailbox)
+    if condstore and 'CONDSTORE' in s.capabilities:
+        command += ' (CONDSTORE)'
+    with metrics.phase(s, 'select'):
+        untagged = yield command
+    exists = [int(response.split()[0]) for response, _ in untagged
+              if response.endswith(' EXISTS')]
+    metrics.count(s, 'select', exists and exists[-1] or 0)
+    raise Return(untagged)
+
+def get_autoarchive_labels(s, label_pattern):
+    '''Returns a list of tuples (str labelname, int age_in_seconds) of
+    the labels listed for label_pattern that match a LABEL_RULES rule,
+    shortest age first.'''
+    with metrics.phase(s, 'get_autoarchive_labels'):
+        untagged = yield 'LIST "" %s' % asyncimap.quote(label_pattern)
+    ret = list_labels(untagged)
+    metrics.count(s, 'get_autoarchive_labels', len(ret))
+    raise Return(ret)
+
+def parse_label_list(list_of_labels):
+    '''Takes the LIST responses for the autoarchive labels and returns
+    a list of tuples (str labelname, int age_in_seconds), shortest age
+    first. Labels no rule matches are left out.'''
+    # labels looks like: '(\\HasNoChildren) "/" "aa:1"'
+    # we want to extract the 'aa:1' part, and its age
+    return label_rules().parse_list(list_of_labels)
+
+def list_labels(untagged):
+    '''Returns the (label, age) list from the untagged responses of a
+    LIST.'''
+    return parse_label_list([response[len('LIST '):]
+                             for response, _ in untagged
+                             if response.startswith('LIST ')])
+
+def get_uidvalidity(selected):
+    '''Returns the UIDVALIDITY from the untagged responses selected of
+    a SELECT.'''
+    return int(asyncimap.response_code(selected, 'UIDVALIDITY'))
+
+def get_highestmodseq(selected):
+    '''Returns the HIGHESTMODSEQ of a mailbox selected with CONDSTORE,
+    from the untagged responses of the SELECT, 0 if the server didn't
+    report one.'''
+    return int(asyncimap.response_code(selected, 'HIGHESTMODSEQ') or 0)
+
+def any_of(keys):
+    '''Returns a parenthesized SEARCH key matching the messages that
+    match any of the list of keys.'''
+    return '(%s)' % ' '.join(['OR %s' % key for key in keys[:-1]]
+                             + keys[-1:])
+
+def labels_key(labels):
+    '''Returns a SEARCH key for the messages with any of labels.'''
+    return any_of(['X-GM-LABELS %s' % asyncimap.quote(label)
+                   for label in labels])
+
+def get_message_ids(s, labels, min_uid=1):
+    '''Takes an imap connection 's', and a list of labels and returns a
+    list of message uids for those with any of them. Only uids >=
+    min_uid are returned.'''
+    with metrics.phase(s, 'get_message_ids'):
+        untagged = yield 'UID SEARCH UID %d:* %s' % (min_uid,
+                                                     labels_key(labels))
+    # 'n:*' always matches the highest uid in the mailbox, even when it
+    # is below n, so filter again here.
+    email_ids = [uid for uid in asyncimap.search_result(untagged)
+                 if int(uid) >= min_uid]
+    metrics.count(s, 'get_message_ids', len(email_ids))
+    raise Return(email_ids)
+
+def get_old_message_ids(s, labels, age, now):
+    '''Returns a list of uids for the messages with any of the given
+    labels that gmail considers older than age seconds at now. Messages
+    already flagged \\Deleted, by a run that failed before closing the
+    mailbox, are left out.'''
+    with metrics.phase(s, 'get_message_ids'):
+        untagged = yield 'UID SEARCH %s UNDELETED' % old_key(labels, age,
+                                                             now)
+    email_ids = asyncimap.search_result(untagged)
+    metrics.count(s, 'get_message_ids', len(email_ids))
+    raise Return(email_ids)
+
+def old_query(label, age, now):
+    '''Returns the X-GM-RAW query for the messages with label older than
+    age seconds at now. The label is quoted, gmail would take the words
+    of a name with spaces as separate terms. older_than: only counts
+    whole days, other ages compare the date with before:, which takes
+    seconds since the epoch.'''
+    label = asyncimap.quote(label)
+    if age % DAY == 0:
+        return 'label:%s older_than:%dd' % (label, age / DAY)
+    return 'label:%s before:%d' % (label, now - age)
+
+def old_key(labels, age, now):
+    '''Returns a SEARCH key for the messages with any of labels older
+    than age seconds at now.'''
+    return any_of(['X-GM-RAW %s' % asyncimap.quote(old_query(label, age, now))
+                   for label in labels])
+
+def pipeline_depth(s):
+    '''Returns how many commands may be in flight on s, 1 unless it
+    was connected with pipelined.'''
+    return getattr(s, 'pipeline_depth', 1)
+
+def search_pipelined(s, commands):
+    '''Runs the UID SEARCH commands back to back and returns the uids
+    each one found, as a list of lists.'''
+    found = []
+    with metrics.phase(s, 'get_message_ids'):
+        for untagged in (yield commands):
+            found.append(asyncimap.search_result(untagged))
+    metrics.count(s, 'get_message_ids', sum(len(ids) for ids in found))
+    raise Return(found)
+
+# How many labels a SEARCH asks for at most, so that accounts with
+# hundreds of them don't send commands of many kB
+LABELS_PER_SEARCH = 50
+
+def get_labels_message_ids(s, groups, min_uid=1):
+    '''get_message_ids for each list of labels in groups, returns a
+    list of lists.'''
+    if pipeline_depth(s) == 1:
+        found = []
+        for labels in groups:
+            found.append((yield get_message_ids(s, labels, min_uid)))
+        raise Return(found)
+    found = yield search_pipelined(s, [
+        'UID SEARCH UID %d:* %s' % (min_uid, labels_key(labels))
+        for labels in groups])
+    raise Return([[uid for uid in ids if int(uid) >= min_uid]
+                  for ids in found])
+
+def parse_uid(response):
+    '''Returns the uid from a FETCH response line such as
+    '1 (UID 5 BODY[HEADER.FIELDS (DATE SUBJECT)] {60}' '''
+    return re.search(r'UID (\d+)', response).group(1)
+
+LABEL_TOKEN = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|([^\s()"]+)|(\)))')
+def parse_headers(text):
+    '''Returns a dict of the header fields in text, with lowercased
+    names and folded lines joined. Much cheaper than building an
+    email.message just to read a field or two.'''
+    headers = {}
+    for line in re.sub(r'\r?\n[ \t]+', ' ', text).splitlines():
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+def parse_labels(response):
+    '''Returns the labels from a FETCH response line such as
+    '1 (X-GM-LABELS ("aa:3" "\\\\Important") UID 5)' '''
+    pos = response.index('X-GM-LABELS (') + len('X-GM-LABELS (')
+    labels = []
+    while True:
+        match = LABEL_TOKEN.match(response, pos)
+        quoted, atom, close = match.groups()
+        if close:
+            return labels
+        if atom is None:
+            atom = re.sub(r'\\(.)', r'\1', quoted)
+        labels.append(atom)
+        pos = match.end()
+
+FLAGS_RE = re.compile(r'[( ]FLAGS \(([^)]*)\)')
+def parse_flags(response):
+    '''Returns the flags from a FETCH response line such as
+    '1 (UID 5 FLAGS (\\Seen \\Deleted))' '''
+    match = FLAGS_RE.search(response)
+    return match and match.group(1).split() or []
+
+def current_labels(response):
+    '''Returns the labels from a FETCH response with X-GM-LABELS and
+    FLAGS. Messages flagged \\Deleted, by a run that failed before it
+    could close the mailbox, are on their way out of the inbox and get
+    none.'''
+    if '\\Deleted' in parse_flags(response):
+        return []
+    return parse_labels(response)
+
+def get_message_ages(s, label_ages, min_uid=1):
+    '''Runs one SEARCH per age limit, for all the labels with that
+    limit, and returns a dict, keys are uids >= min_uid, values are the
+    age limits. A message with several labels gets the shortest age.'''
+    ages = {}
+    groups = AgeTable(label_ages).groups(LABELS_PER_SEARCH)
+    found = yield get_labels_message_ids(
+        s, [labels for _, labels in groups], min_uid)
+    # Shortest age first, so the first one found for a message is its
+    # shortest age
+    for (age, _), msg_ids in zip(groups, found):
+        for msg_id in msg_ids:
+            ages.setdefault(msg_id, age)
+    raise Return(ages)
+
+def fetch_message_ages(s, label_ages, min_uid=1):
+    '''Same as get_message_ages but reads the labels of every message
+    in the mailbox with a single X-GM-LABELS FETCH, instead of one
+    SEARCH per age limit.'''
+    table = AgeTable(label_ages)
+    ages = {}
+    with metrics.phase(s, 'get_message_ids'):
+        for response, _ in (yield Fetch('%d:*' % min_uid, '(X-GM-LABELS)')):
+            msg_id = parse_uid(response)
+            if int(msg_id) < min_uid:
+                continue
+            age = table.shortest(parse_labels(response))
+            if age is not None:
+                ages[msg_id] = age
+    metrics.count(s, 'get_message_ids', len(ages))
+    raise Return(ages)
+
+def fetch_responses(s, msg_ids, items, on_response, on_batch=None):
+    '''Runs UID FETCH for msg_ids in batches and calls on_response with
+    the response and literal of each message as soon as it arrives.
+    response is the text of the FETCH response around the literal, e.g.
+    '1 (UID 5 BODY[...] {60} )', literal is None for responses without
+    one. on_batch is called between batches, when the connection is
+    free for other commands, and may return a session to run then, e.g.
+    Archiver.flush. Everything up to on_batch, including the work of
+    on_response, is charged to the fetch_emails phase.
+
+    When pipelining, a batch is pipeline_depth(s) FETCH commands sent
+    back to back.'''
+    depth = pipeline_depth(s)
+    if depth == 1:
+        msg_sets = message_sets(msg_ids)
+    else:
+        # Pipelined responses arrive back to back, their timing says
+        # nothing about the server, so keep the size fixed
+        msg_sets = message_sets(msg_ids, AdaptiveBatchSize(
+            min_size=INITIAL_BATCH_SIZE, max_size=INITIAL_BATCH_SIZE))
+
+    while True:
+        batch = list(islice(msg_sets, depth))
+        if not batch:
+            break
+        with metrics.phase(s, 'fetch_emails'):
+            if depth == 1:
+                responses = yield Fetch(batch[0], items)
+            else:
+                fetched = yield ['UID FETCH %s %s' % (msg_id_str, items)
+                                 for msg_id_str in batch]
+                responses = chain.from_iterable(
+                    asyncimap.fetch_responses(untagged)
+                    for untagged in fetched)
+            fetched = 0
+            for response, literal in responses:
+                fetched += 1
+                on_response(response, literal)
+            metrics.count(s, 'fetch_emails', fetched)
+        if on_batch:
+            session = on_batch()
+            if session is not None:
+                yield session
+
+def fetch_dates(s, msg_ids, on_date, internaldate=False, on_batch=None):
+    '''Calls on_date with the uid and the date, in seconds since the
+    epoch, of every message, taken from the Date header or, with
+    internaldate, from the time gmail received the message. Messages
+    with an unreadable date are skipped. on_batch is passed on to
+    fetch_responses.'''
+    def on_response(response, values):
+        msg_id = parse_uid(response)
+        try:
+            date = parse_fetched_date(response, values, internaldate)
+        except ValueError, e:
+            print 'Skipping message %s: %s' % (msg_id, e)
+            return
+        on_date(msg_id, date)
+    return fetch_responses(s, msg_ids, date_items(internaldate),
+                           on_response, on_batch)
+
+def date_items(internaldate=False):
+    '''Returns the FETCH items fetch_dates asks for.'''
+    if internaldate:
+        return '(INTERNALDATE)'
+    return '(body.peek[header.fields (date)])'
+
+def parse_fetched_date(response, values, internaldate=False):
+    '''Returns the date of a date_items FETCH response in seconds since
+    the epoch. Raises ValueError if it can't be read.'''
+    if internaldate:
+        return parse_internaldate(response)
+    return parse_date(parse_headers(values).get('date', ''))
+
+def fetch_labels(s, msg_ids, on_labels, on_batch=None):
+    '''Calls on_labels with the uid, the list of labels and the subject
+    of every message, see current_labels. uids no longer in the
+    selected mailbox are left out.'''
+    def on_response(response, values):
+        subject = parse_headers(values).get('subject', '')
+        on_labels(parse_uid(response), current_labels(response), subject)
+    return fetch_responses(
+        s, msg_ids, '(X-GM-LABELS FLAGS body.peek[header.fields (subject)])',
+        on_response, on_batch)
+
+# What --threads dates a thread by, see add_thread_messages
+THREAD_DATES = ('newest', 'oldest')
+
+THRID_RE = re.compile(r'X-GM-THRID (\d+)')
+def fetch_thread_ids(s, msg_ids, on_thread, on_batch=None):
+    '''Calls on_thread with the uid and the X-GM-THRID, as an int, of
+    every message.'''
+    def on_response(response, _):
+        on_thread(parse_uid(response),
+                  int(THRID_RE.search(response).group(1)))
+    return fetch_responses(s, msg_ids, '(X-GM-THRID)', on_response,
+                           on_batch)
+
+def fetch_subjects(s, msg_ids, on_subject, on_batch=None):
+    '''Calls on_subject with the uid and the subject of every
+    message.'''
+    def on_response(response, values):
+        on_subject(parse_uid(response),
+                   parse_headers(values).get('subject', ''))
+    return fetch_responses(s, msg_ids,
+                           '(body.peek[header.fields (subject)])',
+                           on_response, on_batch)
+
+def is_old(date, age, now):
+    '''Returns True if a message dated date (seconds since the epoch) is
+    older than age seconds at now.'''
+    # The magical if statement, you knew it was somewhere :)
+    return now - date > age
+
+def get_messages_to_archive(index, now=None):
+    '''Returns a list of msg ids to be archived, those of the
+    MessageIndex index that are older than their age limit at now
+    (default: the current time).'''
+    if now is None:
+        now = time.time()
+    return index.old(now)
+
+def archive_messages(s, msg_ids, on_stored=None, label=None):
+    ''' Simply set the deleted flag and msg will be archived in
+    gmail. The STOREs are sent in batches, on_stored is called with
+    the message set of each one once it succeeded. With label, see
+    folder_label, that label is taken off the messages instead, which
+    archives them from its folder right away. '''
+    print 'Archiving messages.'
+    if label:
+        store = '-X-GM-LABELS (%s)' % label
+    else:
+        store = '+FLAGS (\\Deleted)'
+    with metrics.phase(s, 'archive_messages'):
+        if pipeline_depth(s) == 1:
+            for msg_str in message_sets(msg_ids):
+                yield 'UID STORE %s %s' % (msg_str, store)
+                if on_stored:
+                    on_stored(msg_str)
+        else:
+            msg_strs = list(message_sets(msg_ids))
+            stored = yield ['UID STORE %s %s' % (msg_str, store)
+                            for msg_str in msg_strs]
+            for msg_str, _ in zip(msg_strs, stored):
+                if on_stored:
+                    on_stored(msg_str)
+    metrics.count(s, 'archive_messages', len(msg_ids))
+
+class Archiver(object):
+    '''Collects uids to archive, found() prints and adds one, and
+    archives them whenever the session flush() is run, which must be
+    while no other command is running on s. Once stored they are
+    removed from the MessageState state, if given, and checkpoint, a
+    Checkpoint, is told about the progress. found counts the messages
+    found. label is passed on to archive_messages.'''
+
+    def __init__(self, s, state=None, checkpoint=None, label=None):
+        self.s = s
+        self.state = state
+        self.checkpoint = checkpoint
+        self.label = label
+        self.pending = []
+        self.found = 0
+        self.archived = 0
+
+    def add(self, msg_id):
+        self.pending.append(msg_id)
+
+    def report(self, msg_id, subject):
+        '''Called for every message to archive, subject is None if it
+        wasn't fetched.'''
+        report_message(msg_id, subject)
+        self.add(msg_id)
+        self.found += 1
+
+    def flush(self):
+        if self.pending:
+            yield archive_messages(self.s, self.pending, self.stored,
+                                   self.label)
+            self.pending = []
+        if self.checkpoint:
+            self.checkpoint.batch()
+
+    def stored(self, msg_str):
+        '''Called for every STORE that went through.'''
+        msg_ids = decode_message_set(msg_str)
+        self.archived += len(msg_ids)
+        if self.state:
+            for msg_id in msg_ids:
+                self.state.remove(msg_id)
+        if self.checkpoint:
+            self.checkpoint.archived += len(msg_ids)
+
+class RunCancelled(Exception):
+    '''Raised by a Checkpoint whose run is to stop.'''
+
+class Checkpoint(object):
+    '''Saves the MessageState state to state_path ('' for never) as an
+    archiving run makes progress, at most every CHECKPOINT_SECONDS, so
+    if it fails part way the next attempt resumes from there instead
+    of from the previous run. The same Checkpoint is kept over the
+    attempts of a run, archived counts the messages archived by all of
+    them and batches the FETCH or STORE batches done. cancelled, if
+    given, is called after every batch and before saving, and the run
+    stops with RunCancelled once it returns True, e.g. when another
+    --queue worker took the account over.'''
+
+    def __init__(self, state_path, cancelled=None):
+        self.state_path = state_path
+        self.state = None
+        self.saved = time.time()
+        self.archived = 0
+        self.batches = 0
+        self.cancelled = cancelled
+
+    def check(self):
+        if self.cancelled and self.cancelled():
+            raise RunCancelled('Cancelled after %d batches' % self.batches)
+
+    def batch(self):
+        '''Called after every batch, when state is consistent with
+        what the server has.'''
+        self.batches += 1
+        self.check()
+        if time.time() - self.saved >= CHECKPOINT_SECONDS:
+            self.save()
+
+    def save(self):
+        self.check()
+        if self.state and self.state_path:
+            save_state(self.state_path, self.state)
+        self.saved = time.time()
+
+# Response codes of failures that may go away by themselves (RFC 5530),
+# and gmail's throttling
+TRANSIENT_CODES = ('[UNAVAILABLE]', '[INUSE]') + THROTTLE_CODES
+def is_transient(e):
+    '''Returns True if the exception e is worth retrying on a new
+    connection: the connection dropped or timed out, or the server
+    said it is temporarily unable to serve the request.'''
+    if isinstance(e, (imaplib.IMAP4.abort, socket.error)):
+        return True
+    return (isinstance(e, imaplib.IMAP4.error)
+            and any(code in str(e) for code in TRANSIENT_CODES))
+
+def backoff_delay(failures):
+    '''Returns how many seconds to wait before retrying after failures
+    failures in a row: random up to an exponentially growing limit, so
+    clients that failed together don't all come back together.'''
+    return random.uniform(0, min(RETRY_MAX_DELAY,
+                                 RETRY_DELAY * 2 ** (failures - 1)))
+
+def idle(s, timeout):
+    '''Sends IDLE and waits up to timeout seconds for the server to
+    report new or removed messages. Returns True if it did. imaplib
+    doesn't know about IDLE so the command is driven by hand.'''
+    tag = s._new_tag()
+    s.send('%s IDLE\r\n' % tag)
+    line = s.readline()
+    if not line.startswith('+'):
+        raise s.abort('IDLE not accepted: %s' % line.strip())
+
+    changed = False
+    deadline = time.time() + timeout
+    while not changed:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        # SSL and COMPRESS can hold data select() doesn't know about
+        channel = getattr(s, 'sslobj', None) or s.sock
+        pending = hasattr(channel, 'pending') and channel.pending()
+        if not pending:
+            readable, _, _ = select.select([s.sock], [], [], remaining)
+            if not readable:
+                break
+        line = s.readline()
+        if not line:
+            raise s.abort('Connection closed during IDLE')
+        # e.g. '* 12 EXISTS', anything else is a keepalive
+        changed = re.match(r'\* \d+ (EXISTS|EXPUNGE)', line) is not None
+
+    s.send('DONE\r\n')
+    while True:
+        line = s.readline()
+        if not line:
+            raise s.abort('Connection closed during IDLE')
+        if line.startswith(tag):
+            break
+    return changed
+
+def ask_for_email():
+    email = raw_input('Email address (name@gmail.com): ')
+    return email.strip()
+
+def read_oauth_identity(fn):
+    '''Returns an xoauth.OAuthEntity from a given fn.
+    Expects the token on line 1 and the secret on line 2.'''
+    try:
+        with open(fn) as f:
+            lines = f.readlines()
+    except IOError:
+        print 'Error reading from %s. Check that it exists.' % fn
+        return None
+    return xoauth.OAuthEntity(lines[0].strip(), lines[1].strip())
+
+def sync_messages(s, label_ages, state, fetch_labels=False,
+                  internaldate=False, on_batch=None):
+    '''Adds the labeled messages that arrived since the last sync to
+    state, fetching their dates. Returns the list of new uids. With
+    fetch_labels, new messages are found with a single FETCH instead of
+    a SEARCH per age limit. With internaldate, the time gmail received a
+    message is used instead of its Date header. on_batch is called
+    between FETCH batches, state is then consistent: the dates are
+    fetched in uid order.'''
+    # Create a dict for the messages that arrived since the last run, keys
+    # are uids, values are the age_limit parsed from the gmail label
+    if fetch_labels:
+        ages = yield fetch_message_ages(s, label_ages, state.last_uid + 1)
+    else:
+        ages = yield get_message_ages(s, label_ages, state.last_uid + 1)
+
+    # Get the dates of the new messages, everything older is already in
+    # the cache
+    if len(ages) == 0:
+        raise Return([])
+    raise Return((yield add_messages(s, state, ages, internaldate,
+                                     on_batch)))
+
+def add_messages(s, state, ages, internaldate=False, on_batch=None):
+    '''Fetches the dates of the new messages in the dict ages, uid ->
+    age limit, and adds them to state, see add_thread_messages for
+    thread mode. Returns the list of uids added.'''
+    if state.threads:
+        raise Return((yield add_thread_messages(s, state, ages,
+                                                internaldate, on_batch)))
+    added = []
+    def add(msg_id, date):
+        state.add(msg_id, ages[msg_id], date)
+        added.append(msg_id)
+    yield fetch_dates(s, ages.keys(), add, internaldate, on_batch)
+    raise Return(added)
+
+def add_thread_messages(s, state, ages, internaldate=False, on_batch=None):
+    '''Thread mode of add_messages. Fetches the X-GM-THRID of the new
+    messages and the date of one message per thread: the newest, which
+    becomes the date of the whole thread, or the oldest, unless the
+    thread already has one. Messages of a thread without a readable
+    date are skipped.'''
+    thrids = {}
+    yield fetch_thread_ids(s, ages.keys(), thrids.__setitem__, on_batch)
+    threads = {}
+    for msg_id, thrid in thrids.iteritems():
+        threads.setdefault(thrid, []).append(msg_id)
+
+    # uids only go up, the highest of a thread arrived last
+    newest = state.threads == 'newest'
+    dates = {}
+    if not newest:
+        dates = state.messages.thread_dates(set(threads))
+    dated = dict((max(msg_ids, key=int) if newest else min(msg_ids, key=int),
+                  thrid) for thrid, msg_ids in threads.iteritems()
+                 if thrid not in dates)
+    def add(msg_id, date):
+        dates[dated[msg_id]] = date
+    yield fetch_dates(s, dated.keys(), add, internaldate, on_batch)
+
+    added = []
+    for msg_id in sorted(thrids, key=int):
+        thrid = thrids[msg_id]
+        if thrid in dates:
+            state.add(msg_id, ages[msg_id], dates[thrid], thrid)
+            added.append(msg_id)
+    if newest:
+        state.messages.set_thread_dates(dates)
+    raise Return(added)
+
+def sync_changes(s, label_ages, state, since, internaldate=False,
+                 on_batch=None):
+    '''CONDSTORE version of sync_messages: reads the labels of the
+    messages changed since the modseq since, with a single FETCH
+    CHANGEDSINCE, and updates state, fetching the dates of the ones it
+    didn't know. This also catches cached messages that lost or changed
+    their aa: label. Returns the list of new uids.'''
+    table = AgeTable(label_ages)
+    ages = {}
+    with metrics.phase(s, 'get_message_ids'):
+        for response, _ in (yield Fetch(
+                '1:*', '(X-GM-LABELS FLAGS) (CHANGEDSINCE %d)' % since)):
+            msg_id = parse_uid(response)
+            age = apply_label_change(state, table, msg_id,
+                                     current_labels(response))
+            if age is not None:
+                ages[msg_id] = age
+    metrics.count(s, 'get_message_ids', len(ages))
+    raise Return((yield add_messages(s, state, ages, internaldate,
+                                     on_batch)))
+
+def apply_label_change(state, table, msg_id, labels):
+    '''Takes the current labels of msg_id, which changed since the last
+    sync, and updates state. Returns the age limit of msg_id if it is
+    new to state and its date still to be fetched, otherwise None.
+    table is the AgeTable of the labels.'''
+    age = table.shortest(labels)
+    if age is None:
+        state.remove(msg_id)
+    elif msg_id in state.messages:
+        state.add(msg_id, age, state.messages[msg_id][1])
+    else:
+        return age
+    return None
+
+def sync_mailbox(s, state, modseq, fetch_labels=False, internaldate=False,
+                 on_batch=None, label_ages=None):
+    '''Brings state up to date with the mailbox, selected with
+    CONDSTORE, and returns its list of (label, age). modseq is its
+    HIGHESTMODSEQ, see get_highestmodseq. With CONDSTORE that takes no
+    command at all if the mailbox didn't change since the last sync, and
+    LIST plus a FETCH CHANGEDSINCE if it did. Without, or on the first
+    sync, the labels are listed and sync_messages is run. on_batch is
+    passed on to them. label_ages, if given, are the labels already
+    listed, e.g. for another folder, and no LIST is sent. A sync cut
+    short is finished by the next one: HIGHESTMODSEQ is only updated at
+    the end.'''
+    if modseq and modseq == state.highest_modseq \
+            and state.label_ages is not None:
+        raise Return(state.label_ages)
+
+    if label_ages is None:
+        label_ages = yield get_autoarchive_labels(s, LABEL_PATTERN)
+    if modseq and state.highest_modseq:
+        yield sync_changes(s, label_ages, state, state.highest_modseq,
+                           internaldate, on_batch)
+    else:
+        yield sync_messages(s, label_ages, state, fetch_labels,
+                            internaldate, on_batch)
+    state.highest_modseq = modseq
+    state.label_ages = label_ages
+    raise Return(label_ages)
+
+def confirm_old_messages(s, label_ages, state, old_msgs, on_old,
+                         on_batch=None):
+    '''Cached ages can be stale, the message might have been archived
+    by hand or relabeled since we saw it. Re-reads the labels of the
+    cached old_msgs and calls on_old with the uid and the subject of
+    each one that is still to be archived, as the responses arrive.
+    Those stay in state until they are stored, the others get their
+    current age. on_batch is passed on to fetch_responses.'''
+    table = AgeTable(label_ages)
+    now = time.time()
+    missing = set(old_msgs)
+    def confirm(msg_id, labels, subject):
+        missing.discard(msg_id)
+        if recheck_message(state, table, msg_id, labels, now):
+            on_old(msg_id, subject)
+    yield fetch_labels(s, old_msgs, confirm, on_batch)
+
+    # The server only answers for messages still in the mailbox
+    for msg_id in missing:
+        state.remove(msg_id)
+
+def recheck_message(state, table, msg_id, labels, now):
+    '''Takes the current labels of the cached message msg_id and
+    returns True if it is still to be archived, otherwise it gets its
+    current age or, without an aa: label, is removed from state. In
+    thread mode the message is part of an old thread and goes with it
+    while labeled. table is the AgeTable of the labels.'''
+    _, date = state.messages[msg_id]
+    age = table.shortest(labels)
+    if age is None:
+        state.remove(msg_id)
+        return False
+    if state.threads or is_old(date, age, now):
+        return True
+    state.add(msg_id, age, date)
+    return False
+
+def find_old_messages(s, label_ages, state, on_old, on_batch=None):
+    '''Client side engine. Uses the dates cached in state, which must
+    have been synced, and calls on_old with the uid and the subject of
+    each message to be archived.'''
+    # Get a message ids for emails to be archived based on email date
+    with metrics.phase(s, 'get_messages_to_archive'):
+        old_msgs = get_messages_to_archive(state.messages)
+    metrics.count(s, 'get_messages_to_archive', len(old_msgs))
+    return confirm_old_messages(s, label_ages, state, old_msgs, on_old,
+                                on_batch)
+
+def search_old_messages(s, label_ages, on_old, verbose=False,
+                        on_batch=None):
+    '''Server side engine. Lets gmail compare the dates with one
+    X-GM-RAW search per age limit, so no headers are downloaded.
+    Calls on_old with the uid and the subject of each message to
+    archive, subject is None unless verbose.'''
+    msg_ids = set()
+    groups = AgeTable(label_ages).groups(LABELS_PER_SEARCH)
+    now = time.time()
+    if pipeline_depth(s) == 1:
+        for age, labels in groups:
+            msg_ids.update((yield get_old_message_ids(s, labels, age, now)))
+    else:
+        for ids in (yield search_pipelined(s, [
+                'UID SEARCH %s UNDELETED' % old_key(labels, age, now)
+                for age, labels in groups])):
+            msg_ids.update(ids)
+    msg_ids = sorted(msg_ids, key=int)
+
+    if verbose:
+        yield fetch_subjects(s, msg_ids, on_old, on_batch)
+    else:
+        for msg_id in msg_ids:
+            on_old(msg_id, None)
+
+def report_message(msg_id, subject):
+    if subject is None:
+        print 'Preparing message %s to be archived.' % msg_id
+    else:
+        print 'Preparing message %s to be archived. Subject: %s' % (
+            msg_id, subject)
+
+def archive_mailbox(s, options, state_path, checkpoint=None,
+                    mailbox=INBOX, label_ages=None, by_label=False):
+    '''Archives the old messages in mailbox, the inbox by default, of
+    the connection s and returns how many there were. state_path is
+    where the cache is kept, '' to disable it. checkpoint is the
+    Checkpoint of the run, when it is retried, otherwise one is made
+    for state_path. label_ages are the labels and ages to go by, listed
+    if not given. With by_label, messages are archived by taking the
+    label of mailbox off them rather than by flagging them \\Deleted,
+    see archive_folders.'''
+    if checkpoint is None:
+        checkpoint = Checkpoint(state_path)
+    label = by_label and folder_label(mailbox) or None
+
+    # Select the mailbox
+    selected = yield select_mailbox(s, mailbox,
+                                    condstore=not options.server_side)
+
+    if options.server_side:
+        # Messages are archived between FETCH batches, while later
+        # batches are still to come
+        archiver = Archiver(s, checkpoint=checkpoint, label=label)
+        # Get aa:\d+ labels
+        if label_ages is None:
+            label_ages = yield get_autoarchive_labels(s, LABEL_PATTERN)
+        yield search_old_messages(s, label_ages, archiver.report,
+                                  options.verbose, archiver.flush)
+    else:
+        # Load what we learned about this mailbox on previous runs, the
+        # labels too unless something changed since
+        uidvalidity = get_uidvalidity(selected)
+        if state_path:
+            state = load_state(state_path, uidvalidity, options.threads)
+        else:
+            state = MessageState(uidvalidity, threads=options.threads)
+        checkpoint.state = state
+        label_ages = yield sync_mailbox(
+            s, state, get_highestmodseq(selected), options.fetch_labels,
+            options.internaldate, checkpoint.batch, label_ages)
+        archiver = Archiver(s, state, checkpoint, label)
+        yield find_old_messages(s, label_ages, state, archiver.report,
+                                archiver.flush)
+
+    yield archiver.flush()
+    if archiver.found == 0:
+        print 'No messages to be archived.'
+
+    checkpoint.save()
+    raise Return(archiver.found)
+
+def archive_with_retries(oauth_entity, email, options, state_path,
+                         deadline=None, on_connect=None, limiter=None,
+                         transcript=None, mailbox=INBOX, label_ages=None,
+                         s=None, logout=True, cancelled=None,
+                         by_label=False):
+    '''Connects, archives mailbox (the inbox) of email and closes it,
+    like a plain run. Transient failures (see is_transient) are retried
+    on a new connection after backoff_delay, resuming from the
+    checkpoints saved to state_path, until RETRY_ATTEMPTS of them in a
+    row made no progress or the next attempt would start after deadline
+    (seconds since the epoch). on_connect is called with every new
+    connection, limiter and transcript are passed on to connect,
+    label_ages and by_label to archive_mailbox. The first attempt uses
+    the connection s if given. Without logout, the last connection is
+    left open for the next mailbox. cancelled is passed on to the
+    Checkpoint. Returns a tuple (messages archived by all attempts, last
+    connection).'''
+    checkpoint = Checkpoint(state_path, cancelled)
+    failures = 0
+    while True:
+        batches = checkpoint.batches
+        try:
+            if s is None:
+                s = connect(oauth_entity, email, pipelined=options.pipeline,
+                            limiter=limiter, transcript=transcript)
+                if on_connect:
+                    on_connect(s)
+            run_session(s, archive_mailbox(s, options, state_path,
+                                           checkpoint, mailbox, label_ages,
+                                           by_label))
+            close_mailbox(s)
+            if logout:
+                s.logout()
+            return checkpoint.archived, s
+        except Exception, e:
+            # A bare raise after the shutdown below would raise what
+            # that failed with instead
+            failure = sys.exc_info()
+            if not is_transient(e):
+                raise
+            # What is in state is still true: messages are only dropped
+            # from it once stored and dates are fetched in uid order
+            checkpoint.save()
+            if s:
+                try:
+                    s.shutdown()
+                except Exception:
+                    pass
+                s = None
+            if checkpoint.batches > batches:
+                failures = 0
+            failures += 1
+            delay = backoff_delay(failures)
+            if failures >= RETRY_ATTEMPTS or (
+                    deadline and time.time() + delay >= deadline):
+                raise failure[0], failure[1], failure[2]
+            print 'Run failed (%s), retrying in %.1fs.' % (e, delay)
+            time.sleep(delay)
+
+def close_mailbox(s):
+    '''Closes the selected mailbox, which expunges the messages flagged
+    \\Deleted, i.e. archives them.'''
+    with metrics.phase(s, 'archive_messages'):
+        s.close()
+
+# Folders that are not labels: expunging from them deletes messages
+SYSTEM_FOLDERS = re.compile(r'\[(Gmail|Google Mail)\](/|$)', re.I)
+
+def parse_folders(text):
+    '''Returns the list of mailboxes named in the comma separated text,
+    e.g. 'INBOX,Receipts'. Raises ValueError for gmail's own folders,
+    where expunging deletes rather than archives.'''
+    folders = []
+    for name in text.split(','):
+        name = name.strip()
+        if name.upper() == INBOX:
+            name = INBOX
+        if SYSTEM_FOLDERS.match(name):
+            raise ValueError('%s is not a label, messages expunged from it '
+                             'are deleted' % name)
+        if name and name not in folders:
+            folders.append(name)
+    return folders
+
+def folder_state_path(state_path, mailbox):
+    '''Returns where the cache of mailbox is kept: state_path for the
+    inbox, state_path with the mailbox name appended for the others.'''
+    if not state_path or mailbox == INBOX:
+        return state_path
+    return '%s.%s' % (state_path, re.sub(r'[^\w.-]',
+                                         lambda m: '%%%02X' % ord(m.group()),
+                                         mailbox))
+
+def folder_label(mailbox):
+    '''Returns the label that puts messages in mailbox, the way STORE
+    X-GM-LABELS takes it.'''
+    if mailbox == INBOX:
+        return '\\Inbox'
+    return asyncimap.quote(mailbox)
+
+def get_mailbox_sizes(s, mailboxes):
+    '''Returns a dict mailbox -> number of messages, 0 for those STATUS
+    fails for.'''
+    sizes = {}
+    with metrics.phase(s, 'select'):
+        for mailbox in mailboxes:
+            typ, data = s.status(mailbox, '(MESSAGES)')
+            match = typ == 'OK' and re.search(r'MESSAGES (\d+)', data[0])
+            sizes[mailbox] = match and int(match.group(1)) or 0
+    return sizes
+
+class FolderResult(object):
+    '''The outcome of archiving one mailbox of an account.'''
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        # As STATUS told before the run
+        self.messages = 0
+        self.archived = 0
+        self.error = None
+        self.elapsed = 0.0
+
+    def __str__(self):
+        if self.error:
+            return '%s: error after %.1fs: %s' % (
+                self.mailbox, self.elapsed, self.error)
+        return '%s: archived %d of %d messages in %.1fs' % (
+            self.mailbox, self.archived, self.messages, self.elapsed)
+
+def archive_folders(oauth_entity, email, options, state_path, deadline=None,
+                    on_connect=None, limiter=None, transcript=None,
+                    cancelled=None):
+    '''Archives the mailboxes options.folders of email side by side over
+    up to options.connections connections. The first one lists the
+    labels once for all of them and asks for their sizes, and the
+    biggest are started first, so the run takes about as long as the
+    biggest one rather than all of them together. Every connection then
+    takes the next mailbox left once done with one, each mailbox with
+    the retries of archive_with_retries and its own cache, see
+    folder_state_path. The other arguments are those of
+    archive_with_retries. Returns a list of FolderResults in the order
+    of options.folders.
+
+    Each folder takes its own label off its old messages. \\Deleted is
+    a flag of the message rather than of the folder, so a message in two
+    of them would have one flag for both: the first CLOSE clears it
+    before the other folder expunges the message, and the searches of
+    the other folder skip it while it is set.'''
+    results = [FolderResult(mailbox) for mailbox in options.folders]
+    failures = 0
+    while True:
+        s = None
+        try:
+            s = connect(oauth_entity, email, pipelined=options.pipeline,
+                        limiter=limiter, transcript=transcript)
+            if on_connect:
+                on_connect(s)
+            label_ages = run_session(s, get_autoarchive_labels(
+                s, LABEL_PATTERN))
+            sizes = get_mailbox_sizes(s, options.folders)
+            break
+        except Exception, e:
+            failure = sys.exc_info()
+            if not is_transient(e):
+                raise
+            if s:
+                try:
+                    s.shutdown()
+                except Exception:
+                    pass
+            failures += 1
+            delay = backoff_delay(failures)
+            if failures >= RETRY_ATTEMPTS or (
+                    deadline and time.time() + delay >= deadline):
+                raise failure[0], failure[1], failure[2]
+            print 'Listing failed (%s), retrying in %.1fs.' % (e, delay)
+            time.sleep(delay)
+    for result in results:
+        result.messages = sizes[result.mailbox]
+    pending = sorted(results, key=lambda result: -result.messages)
+    lock = threading.Lock()
+
+    def work(s):
+        while True:
+            with lock:
+                if not pending:
+                    break
+                result = pending.pop(0)
+            if deadline and time.time() >= deadline:
+                result.error = 'Not started before the deadline'
+                continue
+            if cancelled and cancelled():
+                result.error = 'Cancelled before it started'
+                continue
+            start = time.time()
+            try:
+                result.archived, s = archive_with_retries(
+                    oauth_entity, email, options,
+                    folder_state_path(state_path, result.mailbox), deadline,
+                    on_connect, limiter, transcript, result.mailbox,
+                    label_ages, s, logout=False, cancelled=cancelled,
+                    by_label=True)
+            except Exception, e:
+                result.error = '%s: %s' % (e.__class__.__name__, e)
+                # It may have failed halfway, the next mailbox starts over
+                # on a new connection
+                if s:
+                    try:
+                        s.shutdown()
+                    except Exception:
+                        pass
+                s = None
+            result.elapsed = time.time() - start
+        if s:
+            try:
+                s.logout()
+            except Exception:
+                pass
+
+    def work_as(s):
+        with printing_as(email):
+            work(s)
+
+    workers = [threading.Thread(target=work_as,
+                                args=(n == 0 and s or None,))
+               for n in xrange(min(options.connections, len(results)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+def report_folders(results, indent=''):
+    '''Prints the FolderResults of an account, each line starting with
+    indent.'''
+    for result in results:
+        print indent + str(result)
+
+def report_metrics(options, records):
+    '''Writes the metrics.Metrics records of the run to the files given
+    with --metrics and --prometheus.'''
+    if options.metrics:
+        metrics.append_json(options.metrics, records)
+    if options.prometheus:
+        metrics.write_prometheus(options.prometheus, records)
+
+class AccountOutput(object):
+    '''Stands in for sys.stdout while --accounts archives accounts side
+    by side. What is printed as an account, see account(), is written a
+    whole line at a time, each starting with the account, so the lines
+    of different accounts don't run into each other. Everything else is
+    passed on as is.'''
+
+    def __init__(self, out):
+        self.out = out
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # email -> the start of its line, not written yet
+        self.partial = {}
+
+    @contextmanager
+    def account(self, email):
+        '''Prints as the account email, in this thread, in the with
+        block.'''
+        previous = getattr(self.local, 'email', None)
+        self.local.email = email
+        try:
+            yield
+        finally:
+            self.local.email = previous
+
+    def write(self, data):
+        email = getattr(self.local, 'email', None)
+        with self.lock:
+            if email is None:
+                self.out.write(data)
+                return
+            lines = (self.partial.pop(email, '') + data).split('\n')
+            if lines[-1]:
+                self.partial[email] = lines[-1]
+            for line in lines[:-1]:
+                self.out.write('%s: %s\n' % (email, line))
+
+    def flush(self):
+        self.out.flush()
+
+    # Whether the print statement is to write a space before its next
+    # item, per thread like its items
+    softspace = property(lambda self: getattr(self.local, 'softspace', 0),
+                         lambda self, value: setattr(self.local, 'softspace',
+                                                     value))
+
+@contextmanager
+def account_output():
+    '''Makes sys.stdout an AccountOutput in the with block.'''
+    output = AccountOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        yield
+    finally:
+        sys.stdout = output.out
+
+@contextmanager
+def _as_is():
+    yield
+
+def printing_as(email):
+    '''AccountOutput.account for sys.stdout, or nothing when it isn't
+    one.'''
+    if isinstance(sys.stdout, AccountOutput):
+        return sys.stdout.account(email)
+    return _as_is()
+
+def read_accounts(fn):
+    '''Returns a list of tuples (email, oauth identity path) read from
+    fn. Each line holds an email address, optionally followed by the
+    path of its oauth identity file (token and secret, as written by
+    lib.oauthsetup.write_oauth_identity). Relative paths are relative
+    to fn and the default is OAUTH_PATH + '.' + email. Blank lines and
+    lines starting with # are skipped.'''
+    accounts = []
+    with open(fn) as f:
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0].startswith('#'):
+                continue
+            email = parts[0]
+            if len(parts) > 1:
+                path = os.path.join(os.path.dirname(fn), parts[1])
+            else:
+                path = '%s.%s' % (OAUTH_PATH, email)
+            accounts.append((email, path))
+    return accounts
+
+class AccountResult(object):
+    '''The outcome of archiving one account.'''
+
+    def __init__(self, email):
+        self.email = email
+        self.archived = 0
+        self.error = None
+        self.elapsed = 0.0
+        # The open connections, so a run that times out can be aborted
+        self.conns = []
+        # Replaced by that of the connection once there is one
+        self.metrics = metrics.Metrics(email)
+        # The FolderResults with --folders
+        self.folders = None
+
+    def __str__(self):
+        if self.error:
+            return '%s: error after %.1fs: %s' % (
+                self.email, self.elapsed, self.error)
+        return '%s: archived %d messages in %.1fs' % (
+            self.email, self.archived, self.elapsed)
+
+def make_limiter(options, shared=None):
+    '''Returns the lib.ratelimit.Limiter of an account, with the rates
+    given by options. shared is the Limiter of all accounts, if any.'''
+    return Limiter(options.rate, options.bandwidth, shared)
+
+def make_shared_limiter(options):
+    '''Returns the Limiter of all --accounts given by options, or
+    None.'''
+    if options.global_rate or options.global_bandwidth:
+        return Limiter(options.global_rate, options.global_bandwidth)
+    return None
+
+def make_recorder(options, email=None):
+    '''Returns the lib.transcript.Recorder for --record, of the account
+    email with --accounts, or None.'''
+    if not options.record:
+        return None
+    from lib.transcript import Recorder
+    if email:
+        return Recorder('%s.%s' % (options.record, email))
+    return Recorder(options.record)
+
+def _archive_account(result, oauth_path, options, shared_limiter, cancelled):
+    oauth_entity = read_oauth_identity(oauth_path)
+    if not oauth_entity:
+        result.error = 'No OAuth credentials at %s' % oauth_path
+        return
+    state_path = STATE_PATH and '%s.%s' % (STATE_PATH, result.email)
+    deadline = time.time() + options.timeout
+    limiter = make_limiter(options, shared_limiter)
+    if options.folders:
+        result.metrics = metrics.MergedMetrics(result.email)
+    def attach(conn):
+        result.conns.append(conn)
+        if options.folders:
+            result.metrics.add(conn.metrics)
+        else:
+            result.metrics = conn.metrics
+    try:
+        if options.folders:
+            result.folders = archive_folders(
+                oauth_entity, result.email, options, state_path, deadline,
+                attach, limiter, make_recorder(options, result.email),
+                cancelled)
+            result.archived = sum(f.archived for f in result.folders)
+            errors = ['%s: %s' % (f.mailbox, f.error)
+                      for f in result.folders if f.error]
+            if errors:
+                result.error = '; '.join(errors)
+            return
+        result.archived, _ = archive_with_retries(
+            oauth_entity, result.email, options, state_path, deadline,
+            attach, limiter, make_recorder(options, result.email),
+            cancelled=cancelled)
+    except Exception, e:
+        if not result.error:
+            result.error = '%s: %s' % (e.__class__.__name__, e)
+
+def archive_account(email, oauth_path, options, shared_limiter=None,
+                    cancelled=None):
+    '''Archives a single account, giving up after options.timeout
+    seconds. shared_limiter is the Limiter of all accounts, if any.
+    cancelled, if given, stops the run once it returns True, see
+    Checkpoint. Returns an AccountResult.'''
+    result = AccountResult(email)
+    start = time.time()
+    def work():
+        with printing_as(email):
+            _archive_account(result, oauth_path, options, shared_limiter,
+                             cancelled)
+
+    worker = threading.Thread(target=work)
+    worker.daemon = True
+    worker.start()
+    worker.join(options.timeout)
+    if worker.is_alive():
+        result.error = 'Timed out after %ds' % options.timeout
+        # Closing the sockets makes the blocked workers fail and exit
+        for conn in result.conns:
+            try:
+                conn.shutdown()
+            except Exception:
+                pass
+    result.elapsed = time.time() - start
+    return result
+
+def archive_accounts(accounts, options):
+    '''Archives every (email, oauth identity path) in accounts using
+    options.workers concurrent connections, within the global rate
+    limits of options. Returns a list of AccountResults in the same
+    order.'''
+    from multiprocessing.pool import ThreadPool
+    shared_limiter = make_shared_limiter(options)
+
+    def run(account):
+        email, oauth_path = account
+        return archive_account(email, oauth_path, options, shared_limiter)
+
+    pool = ThreadPool(options.workers)
+    try:
+        return pool.map(run, accounts)
+    finally:
+        pool.close()
+
+def archive_queued_accounts(accounts, options):
+    '''Archives the (email, oauth identity path) in accounts together
+    with the other processes sharing the lib.jobqueue.JobQueue at
+    options.queue: each of the options.workers threads claims an account
+    that no one archived since this process started, archives it and
+    releases it, until there is none left. Returns a list of the
+    AccountResults of the accounts this process archived.'''
+    from lib.jobqueue import JobQueue
+    from multiprocessing.pool import ThreadPool
+    started = time.time()
+    queue = JobQueue(options.queue)
+    queue.add(accounts)
+    shared_limiter = make_shared_limiter(options)
+
+    def run(n):
+        worker = '%s:%d:%d' % (socket.gethostname(), os.getpid(), n)
+        results = []
+        while True:
+            job = queue.claim(worker, started)
+            if job is None:
+                return results
+            # Once another worker took the account over, stop at the
+            # next batch rather than archive it side by side
+            result = archive_account(job.email, job.oauth_path, options,
+                                     shared_limiter,
+                                     lambda job=job: job.lost)
+            if not queue.release(job, result.archived, result.error):
+                print 'Lost the lease on %s, another worker took it ' \
+                      'over.' % job.email
+            results.append(result)
+
+    pool = ThreadPool(options.workers)
+    try:
+        return list(chain.from_iterable(pool.map(run,
+                                                 range(options.workers))))
+    finally:
+        pool.close()
+        queue.close()
+
+def async_archive_mailbox(s, result, xoauth_string, options, state_path):
+    '''lib.asyncimap session doing on the IMAPSession s what connect,
+    archive_mailbox and closing the mailbox do, with the same options,
+    for the account of the AccountResult result.'''
+    yield asyncimap.xoauth(xoauth_string)
+    s.capabilities = asyncimap.capabilities((yield 'CAPABILITY'))
+    if IMAP_COMPRESS and 'COMPRESS=DEFLATE' in s.capabilities:
+        yield 'COMPRESS DEFLATE'
+    print 'Connected to mailbox successfully.'
+    checkpoint = Checkpoint(state_path)
+    try:
+        yield archive_mailbox(s, options, state_path, checkpoint)
+    finally:
+        result.archived = checkpoint.archived
+    yield 'CLOSE'
+    yield 'LOGOUT'
+
+class AccountSession(asyncimap.IMAPSession):
+    '''IMAPSession archiving the account email, which its session prints
+    as, see printing_as.'''
+
+    def __init__(self, email, *args):
+        self.email = email
+        asyncimap.IMAPSession.__init__(self, *args)
+
+    def resume(self, untagged=None, error=None):
+        with printing_as(self.email):
+            asyncimap.IMAPSession.resume(self, untagged, error)
+
+def start_async_account(result, oauth_path, options, socket_map):
+    '''Starts archiving the account of result in socket_map. Returns
+    the asyncimap.IMAPSession, or None if the account has no oauth
+    identity.'''
+    with printing_as(result.email):
+        oauth_entity = read_oauth_identity(oauth_path)
+    if not oauth_entity:
+        result.error = 'No OAuth credentials at %s' % oauth_path
+        return None
+
+    start = time.time()
+    def done(session):
+        result.elapsed = time.time() - start
+        if isinstance(session.error, asyncimap.Timeout):
+            result.error = 'Timed out after %ds' % options.timeout
+        elif session.error:
+            result.error = '%s: %s' % (session.error.__class__.__name__,
+                                       session.error)
+
+    xoauth_string = make_xoauth_string(oauth_entity, result.email)
+    state_path = STATE_PATH and '%s.%s' % (STATE_PATH, result.email)
+    session = AccountSession(
+        result.email, IMAP_HOST, IMAP_PORT,
+        lambda s: async_archive_mailbox(s, result, xoauth_string, options,
+                                        state_path),
+        IMAP_SSL, socket_map, options.timeout, done)
+    session.pipeline_depth = options.pipeline and PIPELINE_DEPTH or 1
+    result.metrics.attach(session)
+    return session
+
+def archive_accounts_async(accounts, options):
+    '''Same as archive_accounts, but every connection is driven from
+    this thread by lib.asyncimap, options.workers at a time.'''
+    socket_map = {}
+    results = [AccountResult(email) for email, _ in accounts]
+    def starter(result, oauth_path):
+        return lambda: start_async_account(result, oauth_path, options,
+                                           socket_map)
+
+    asyncimap.run([starter(result, oauth_path)
+                   for result, (_, oauth_path) in zip(results, accounts)],
+                  socket_map, options.workers)
+    return results
+
+def schedule(deadlines, state, msg_id):
+    '''Pushes the time at which msg_id becomes old on the deadlines
+    heap.'''
+    age, date = state.messages[msg_id]
+    heapq.heappush(deadlines, (date + age, msg_id))
+
+def pop_due(deadlines, state, now):
+    '''Pops and returns the uids whose deadline is before now. Entries
+    for messages that were dropped or rescheduled since they were
+    pushed are skipped.'''
+    due = set()
+    while deadlines and deadlines[0][0] < now:
+        deadline, msg_id = heapq.heappop(deadlines)
+        if msg_id not in state.messages:
+            continue
+        age, date = state.messages[msg_id]
+        if deadline == date + age:
+            due.add(msg_id)
+    return list(due)
+
+def watch_mailbox(s, options, state_path):
+    '''Archives messages in the inbox of s as they come due, forever.
+    Between deadlines the connection IDLEs, so new messages are picked
+    up as they arrive.'''
+    selected = run_session(s, select_mailbox(s, condstore=True))
+    if state_path:
+        state = load_state(state_path, get_uidvalidity(selected))
+    else:
+        state = MessageState(get_uidvalidity(selected))
+    label_ages = run_session(s, sync_mailbox(
+        s, state, get_highestmodseq(selected), options.fetch_labels,
+        options.internaldate))
+
+    deadlines = []
+    for msg_id in state.messages:
+        schedule(deadlines, state, msg_id)
+
+    archived = 0
+    while True:
+        # Only archive once the first deadline is BATCH_DELAY seconds
+        # past, everything that came due meanwhile goes in the same batch
+        if deadlines and deadlines[0][0] + BATCH_DELAY <= time.time():
+            due = pop_due(deadlines, state, time.time())
+            archiver = Archiver(s, state)
+            run_session(s, confirm_old_messages(s, label_ages, state, due,
+                                                archiver.report,
+                                                archiver.flush))
+            run_session(s, archiver.flush())
+            if archiver.found > 0:
+                # Expunge so the messages leave the inbox right away
+                with metrics.phase(s, 'archive_messages'):
+                    s.expunge()
+            archived += archiver.found
+            # Messages that were relabeled get a new deadline
+            for msg_id in due:
+                if msg_id in state.messages:
+                    schedule(deadlines, state, msg_id)
+            if state_path:
+                save_state(state_path, state)
+            report_metrics(options, [s.metrics.record(archived)])
+
+        timeout = IDLE_SECONDS
+        if deadlines:
+            timeout = min(timeout,
+                          deadlines[0][0] + BATCH_DELAY - time.time())
+        if idle(s, max(timeout, 0)):
+            label_ages = run_session(s, get_autoarchive_labels(
+                s, LABEL_PATTERN))
+            for msg_id in run_session(s, sync_messages(
+                    s, label_ages, state, options.fetch_labels,
+                    options.internaldate)):
+                schedule(deadlines, state, msg_id)
+            if state_path:
+                save_state(state_path, state)
+
+def run_daemon(oauth_entity, email, options):
+    '''Runs watch_mailbox forever. Whenever it fails with a transient
+    error (see is_transient), e.g. the connection dropped or gmail
+    throttled it, the connection is shut down and a new one made after
+    RECONNECT_DELAY plus backoff_delay for the failures in a row. A
+    connection that lasted IDLE_SECONDS ends the row.'''
+    limiter = make_limiter(options)
+    recorder = make_recorder(options)
+    failures = 0
+    while True:
+        s = None
+        start = time.time()
+        try:
+            s = connect(oauth_entity, email, pipelined=options.pipeline,
+                        limiter=limiter, transcript=recorder)
+            watch_mailbox(s, options, STATE_PATH)
+        except Exception, e:
+            if not is_transient(e):
+                raise
+            if s:
+                try:
+                    s.shutdown()
+                except Exception:
+                    pass
+            if time.time() - start >= IDLE_SECONDS:
+                failures = 0
+            failures += 1
+            delay = RECONNECT_DELAY + backoff_delay(failures)
+            print 'Connection lost (%s), reconnecting in %.1fs.' % (e, delay)
+            time.sleep(delay)
+
+def setup_option_parser():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--server-side',
+                      action='store_true',
+                      dest='server_side',
+                      help='let gmail compare the message dates using '
+                           'X-GM-RAW searches instead of downloading the '
+                           'Date headers')
+    parser.add_option('-v', '--verbose',
+                      action='store_true',
+                      dest='verbose',
+                      help='print the subject of every archived message '
+                           '(always on without --server-side)')
+    parser.add_option('--fetch-labels',
+                      action='store_true',
+                      dest='fetch_labels',
+                      help='find labeled messages with a single X-GM-LABELS '
+                           'FETCH instead of one SEARCH per age limit')
+    parser.add_option('--internaldate',
+                      action='store_true',
+                      help='age messages from the time gmail received them '
+                           'instead of their Date header')
+    parser.add_option('--threads',
+                      choices=THREAD_DATES,
+                      help='archive whole threads, dated by their %s '
+                           'message' % ' or '.join(THREAD_DATES))
+    parser.add_option('--pipeline',
+                      action='store_true',
+                      help='send independent searches, fetches and stores '
+                           'back to back instead of waiting for each '
+                           'response')
+    parser.add_option('--accounts',
+                      metavar='FILE',
+                      help='archive every account listed in FILE, one '
+                           '"email [oauth identity file]" per line')
+    parser.add_option('--workers',
+                      type='int',
+                      default=10,
+                      help='number of accounts processed concurrently '
+                           'with --accounts [default: %default]')
+    parser.add_option('--timeout',
+                      type='int',
+                      default=300,
+                      help='seconds after which an account is given up '
+                           'with --accounts [default: %default]')
+    parser.add_option('--queue',
+                      metavar='FILE',
+                      help='split the --accounts with the other processes '
+                           'using the job table FILE, an SQLite database')
+    parser.add_option('--async',
+                      action='store_true',
+                      dest='use_async',
+                      help='with --accounts, drive every connection from '
+                           'a single thread instead of one thread per '
+                           'worker')
+    parser.add_option('--rate',
+                      type='float',
+                      default=ACCOUNT_COMMANDS_PER_SECOND,
+                      help='most IMAP commands per second per account, 0 '
+                           'for no limit [default: %default]')
+    parser.add_option('--bandwidth',
+                      type='int',
+                      default=ACCOUNT_BYTES_PER_SECOND,
+                      help='most bytes per second per account, sent and '
+                           'received together, 0 for no limit '
+                           '[default: %default]')
+    parser.add_option('--global-rate',
+                      type='float',
+                      default=GLOBAL_COMMANDS_PER_SECOND,
+                      help='most IMAP commands per second of all '
+                           '--accounts together [default: %default]')
+    parser.add_option('--global-bandwidth',
+                      type='int',
+                      default=GLOBAL_BYTES_PER_SECOND,
+                      help='most bytes per second of all --accounts '
+                           'together [default: %default]')
+    parser.add_option('--record',
+                      metavar='FILE',
+                      help='record the IMAP sessions to FILE, '
+                           'FILE.<email> with --accounts, credentials '
+                           'redacted')
+    parser.add_option('--replay',
+                      metavar='FILE',
+                      help='play back the sessions recorded in FILE '
+                           'instead of connecting, without the cache')
+    parser.add_option('--replay-timing',
+                      action='store_true',
+                      help='with --replay, let every response take as '
+                           'long as it did when recorded')
+    parser.add_option('--folders',
+                      metavar='LIST',
+                      help='archive the comma separated mailboxes in LIST, '
+                           'e.g. INBOX,Receipts, side by side instead of '
+                           'only the inbox')
+    parser.add_option('--connections',
+                      type='int',
+                      default=FOLDER_CONNECTIONS,
+                      help='connections per account with --folders '
+                           '[default: %default]')
+    parser.add_option('--daemon',
+                      action='store_true',
+                      help='keep running, archiving messages as soon as '
+                           'they are old enough')
+    parser.add_option('--metrics',
+                      metavar='FILE',
+                      help='append the time, IMAP commands, bytes and '
+                           'messages of every phase to FILE as a JSON line')
+    parser.add_option('--prometheus',
+                      metavar='FILE',
+                      help='write the same metrics to FILE in the '
+                           'Prometheus text format, e.g. for the '
+                           'node_exporter textfile collector')
+    parser.add_option('--profile',
+                      metavar='FILE',
+                      help='profile the run, all threads, writing the '
+                           'pstats to FILE and collapsed stacks for '
+                           'flame graphs to FILE.collapsed')
+    parser.add_option('--trace-memory',
+                      action='store_true',
+                      help='report how much memory every phase took and '
+                           'the types of the objects it was taken by')
+    return parser
+
+def main(argv=None):
+    parser = setup_option_parser()
+    options, _ = parser.parse_args(argv)
+    if options.daemon and (options.server_side or options.accounts):
+        parser.error('--daemon works with a single account and without '
+                     '--server-side')
+    if options.use_async and not options.accounts:
+        parser.error('--async only works with --accounts')
+    if options.queue and (not options.accounts or options.use_async):
+        parser.error('--queue only works with --accounts and without '
+                     '--async')
+    if options.threads and (options.server_side or options.daemon):
+        parser.error('--threads does not work with --server-side or '
+                     '--daemon')
+    if options.use_async and (options.rate or options.bandwidth or
+                              options.global_rate or
+                              options.global_bandwidth):
+        parser.error('--async does not support rate limits')
+    if options.use_async and options.record:
+        parser.error('--async does not support --record')
+    if options.replay and (options.accounts or options.daemon or
+                           options.record):
+        parser.error('--replay works with a single account and without '
+                     '--daemon or --record')
+    if options.folders is not None:
+        if options.daemon or options.use_async or options.replay or \
+                options.record:
+            parser.error('--folders does not work with --daemon, --async, '
+                         '--replay or --record')
+        try:
+            options.folders = parse_folders(options.folders)
+        except ValueError, e:
+            parser.error('--folders: %s' % e)
+        if not options.folders or options.connections < 1:
+            parser.error('--folders needs a mailbox and --connections at '
+                         'least 1')
+    try:
+        label_rules()
+    except ValueError, e:
+        parser.error('LABEL_RULES: %s' % e)
+
+    profiler = tracer = None
+    if options.profile:
+        from lib.profiling import Profiler
+        profiler = Profiler()
+        profiler.start()
+    if options.trace_memory:
+        from lib.profiling import MemoryTracer
+        tracer = MemoryTracer()
+        metrics.observers.append(tracer)
+    try:
+        run(options)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.dump(options.profile)
+        if tracer:
+            metrics.observers.remove(tracer)
+            tracer.report()
+
+def archive_reported(oauth_entity, email, options, state_path, **kwargs):
+    '''Runs archive_with_retries for email, passing kwargs on, and
+    writes the metrics of its last connection with report_metrics. A
+    failed run is reported too, with its error, before it is raised.'''
+    result = AccountResult(email)
+    def attach(conn):
+        result.metrics = conn.metrics
+    try:
+        result.archived, _ = archive_with_retries(
+            oauth_entity, email, options, state_path, on_connect=attach,
+            **kwargs)
+    except BaseException, e:
+        result.error = '%s: %s' % (e.__class__.__name__, e)
+        raise
+    finally:
+        report_metrics(options, [result.metrics.record(result.archived,
+                                                       result.error)])
+
+def run(options):
+    '''Does what the command line options parsed by main() ask for.'''
+    if options.replay:
+        from lib.transcript import Replay
+        # Nothing is sent anywhere, the transcript has no credentials
+        archive_reported(
+            xoauth.OAuthEntity('replay', 'replay'),
+            EMAIL_ADDRESS or 'replay', options, '',
+            transcript=Replay(options.replay, options.replay_timing))
+        return
+
+    if options.accounts:
+        accounts = read_accounts(options.accounts)
+        # The accounts print side by side
+        with account_output():
+            if options.use_async:
+                results = archive_accounts_async(accounts, options)
+            elif options.queue:
+                results = archive_queued_accounts(accounts, options)
+            else:
+                results = archive_accounts(accounts, options)
+        print
+        for result in results:
+            print result
+            if result.folders:
+                report_folders(result.folders, '    ')
+        print '%d accounts, %d messages archived, %d errors.' % (
+            len(results), sum(r.archived for r in results),
+            len([r for r in results if r.error]))
+        report_metrics(options, [result.metrics.record(result.archived,
+                                                       result.error)
+                                 for result in results])
+        return
+
+    # Check if email is stored otherwise we have to ask for it
+    email = EMAIL_ADDRESS
+    if len(email) == 0:
+        email = ask_for_email()
+
+    # First check for oauth credentials
+    oauth_entity = read_oauth_identity(OAUTH_PATH)
+
+    # If not saved credentials, attempt to create new ones
+    if not oauth_entity:
+        from lib.oauthsetup import generate_new_oauth_entity
+        print 'No existing OAuth credentials found. Attempting to create a new identity.'
+        oauth_entity = generate_new_oauth_entity(email, OAUTH_PATH)
+
+    # If the user mistypes the verification code, generate_new_oauth_entity
+    # will return None
+    if not oauth_entity:
+        print 'Cannot continue without a valid token.'
+        return
+
+    if options.daemon:
+        run_daemon(oauth_entity, email, options)
+        return
+
+    if options.folders:
+        run_metrics = metrics.MergedMetrics(email)
+        archived, error = 0, None
+        try:
+            results = archive_folders(
+                oauth_entity, email, options, STATE_PATH,
+                on_connect=lambda s: run_metrics.add(s.metrics),
+                limiter=make_limiter(options),
+                transcript=make_recorder(options))
+            print
+            report_folders(results)
+            archived = sum(r.archived for r in results)
+            errors = len([r for r in results if r.error])
+            print '%d folders, %d messages archived, %d errors.' % (
+                len(results), archived, errors)
+            if errors:
+                error = '%d folders failed' % errors
+        except BaseException, e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+            raise
+        finally:
+            report_metrics(options, [run_metrics.record(archived, error)])
+        return
+
+    # Connect to the server using oauth, archive and say bye, again on a
+    # new connection if it drops
+    archive_reported(oauth_entity, email, options, STATE_PATH,
+                     limiter=make_limiter(options),
+                     transcript=make_recorder(options))
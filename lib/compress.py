@@ -0,0 +1,127 @@
+'''
+IMAP COMPRESS=DEFLATE (RFC 4978).
+
+Once both sides agree with 'COMPRESS DEFLATE', everything after the
+tagged OK is sent as a raw deflate stream, flushed at the end of every
+write so the other side can decode it right away. FETCH responses of
+headers are plain text and shrink to a fraction of their size.
+
+Deflate is the codec and counts the bytes on both sides of it.
+DeflateSocket wraps a blocking socket, or ssl.SSLSocket, in it for
+imaplib; event driven code like lib.asyncimap uses Deflate directly.
+'''
+
+import socket
+import zlib
+
+# zlib compression level, 1 (fastest) to 9 (smallest)
+LEVEL = 6
+
+# How many compressed bytes DeflateSocket reads at a time
+RECV_BYTES = 16 * 1024
+
+
+class Deflate(object):
+    '''One compressed IMAP stream, both directions. raw_* count the
+    uncompressed bytes, wire_* what actually went over the wire.'''
+
+    def __init__(self, level=LEVEL):
+        # Negative window bits: raw deflate, no zlib header
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                           -zlib.MAX_WBITS)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.raw_sent = 0
+        self.wire_sent = 0
+        self.raw_received = 0
+        self.wire_received = 0
+
+    def compress(self, data):
+        '''Returns data compressed, including everything needed to
+        decode it.'''
+        wire = (self.compressor.compress(data)
+                + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.raw_sent += len(data)
+        self.wire_sent += len(wire)
+        return wire
+
+    def decompress(self, wire):
+        '''Returns what can be decoded from wire and whatever came
+        before it, possibly ''.'''
+        data = self.decompressor.decompress(wire)
+        self.raw_received += len(data)
+        self.wire_received += len(wire)
+        return data
+
+
+class DeflateSocket(object):
+    '''Wraps the blocking socket sock so everything sent through it is
+    compressed with deflate and everything received decompressed. Other
+    attributes, e.g. fileno or shutdown, are those of sock.'''
+
+    def __init__(self, sock, deflate=None):
+        self.sock = sock
+        self.deflate = deflate or Deflate()
+        # Decompressed but not yet returned by recv
+        self.buffer = ''
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def recv(self, size):
+        while not self.buffer:
+            wire = self.sock.recv(RECV_BYTES)
+            if not wire:
+                return ''
+            self.buffer = self.deflate.decompress(wire)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    # What ssl.SSLSocket calls recv
+    read = recv
+
+    def sendall(self, data):
+        self.sock.sendall(self.deflate.compress(data))
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    # What ssl.SSLSocket calls send
+    write = send
+
+    def pending(self):
+        '''Returns how many bytes can be read without waiting for the
+        socket, like ssl.SSLSocket.pending.'''
+        pending = getattr(self.sock, 'pending', None)
+        return len(self.buffer) + (pending and pending() or 0)
+
+    def makefile(self, mode='rb', bufsize=-1):
+        return socket._fileobject(self, mode, bufsize)
+
+
+def compress_imaplib(s, level=LEVEL):
+    '''Sends COMPRESS DEFLATE on the imaplib connection s and, if the
+    server agrees, compresses everything from then on. Returns the
+    Deflate, or None if the server refused. imaplib doesn't know the
+    command, so it is driven by hand.'''
+    tag = s._new_tag()
+    s.send('%s COMPRESS DEFLATE\r\n' % tag)
+    while True:
+        line = s.readline()
+        if not line:
+            raise s.abort('Connection closed during COMPRESS')
+        if line.startswith(tag + ' '):
+            break
+    if not line[len(tag) + 1:].startswith('OK'):
+        return None
+
+    # The server sends nothing after the OK until the next command, so
+    # nothing compressed is stuck in the buffer of s.file
+    deflate = Deflate(level)
+    if getattr(s, 'sslobj', None) is not None:
+        s.sslobj = DeflateSocket(s.sslobj, deflate)
+        s.file = s.sslobj.makefile('rb')
+    else:
+        s.sock = DeflateSocket(s.sock, deflate)
+        s.file = s.sock.makefile('rb')
+    return deflate
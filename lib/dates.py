@@ -0,0 +1,175 @@
+'''
+Fast parsing of RFC 5322 Date headers.
+
+parse_date() turns a header like 'Thu, 7 Apr 2011 08:34:04 -0400 (EDT)'
+into seconds since the epoch. The common shapes are handled by one
+compiled regex and a few dict lookups: the seconds offset of every zone
+and the midnight of every day are computed once and cached. Anything
+the regex doesn't accept goes through email.utils.parsedate_tz, which
+knows about the more unusual obsolete forms.
+'''
+
+import re
+
+# The shape nearly every mailer uses, 'Thu, 07 Apr 2011 08:34:04 -0400'
+COMMON_RE = re.compile(
+    r'(?:[A-Za-z]{3}, )?(\d\d? [A-Za-z]{3} \d{4}) '
+    r'(\d\d):(\d\d):(\d\d) ([+-]\d{4})')
+
+# Everything else: optional weekday, then 'day month year', hours,
+# minutes, optional seconds and an optional zone. Trailing comments like
+# '(EDT)' are ignored.
+DATE_RE = re.compile(
+    r'\s*(?:[A-Za-z]+\s*,\s*)?(\d{1,2}\s+[A-Za-z]{3}[a-z]*\s+\d{2,4})'
+    r'\s+(\d{1,2}):(\d{2})(?::(\d{2}))?\s*([+-]\d{4}|[A-Za-z]+)?')
+
+# int() is slow, look the hours, minutes and seconds up instead. Times
+# out of range aren't there, they go the slow way and fail.
+NUMBERS = {None: 0}
+for i in range(60):
+    NUMBERS[str(i)] = NUMBERS['%02d' % i] = i
+HOURS = dict((key, value) for key, value in NUMBERS.items()
+             if key is not None and value < 24)
+
+MONTHS = {}
+for i, name in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul',
+                          'aug', 'sep', 'oct', 'nov', 'dec']):
+    for variant in (name, name.title(), name.upper()):
+        MONTHS[variant] = i + 1
+
+# Obsolete zone names from RFC 5322 section 4.3, in minutes east of UTC
+ZONE_NAMES = {
+    'UT': 0, 'UTC': 0, 'GMT': 0, 'Z': 0,
+    'EST': -5 * 60, 'EDT': -4 * 60,
+    'CST': -6 * 60, 'CDT': -5 * 60,
+    'MST': -7 * 60, 'MDT': -6 * 60,
+    'PST': -8 * 60, 'PDT': -7 * 60,
+}
+
+# zone string -> offset in seconds, and 'day month year' -> seconds
+# since the epoch at midnight UTC. Both are filled as dates are parsed,
+# a mailbox only has a few dozen distinct zones and some thousands of
+# distinct days.
+ZONE_CACHE = {None: 0}
+DAY_CACHE = {}
+MAX_CACHED = 100000
+
+
+def zone_offset(zone):
+    '''Returns the offset in seconds east of UTC for a zone like '-0430'
+    or 'EST'. Unknown names, including military zones, count as UTC as
+    RFC 5322 asks.'''
+    if zone[0] in '+-':
+        seconds = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+        if zone[0] == '-':
+            seconds = -seconds
+        return seconds
+    return ZONE_NAMES.get(zone.upper(), 0) * 60
+
+
+def days_from_civil(year, month, day):
+    '''Returns the number of days from 1970-01-01 to the given date of
+    the proleptic Gregorian calendar.'''
+    if month <= 2:
+        year -= 1
+        month += 9
+    else:
+        month -= 3
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * month + 2) // 5 + day - 1
+    day_of_era = (year_of_era * 365 + year_of_era // 4 - year_of_era // 100
+                  + day_of_year)
+    return era * 146097 + day_of_era - 719468
+
+
+def full_year(year_str):
+    '''Expands obsolete two and three digit years.'''
+    year = int(year_str)
+    if len(year_str) == 2:
+        return year + (2000 if year < 50 else 1900)
+    if len(year_str) == 3:
+        return year + 1900
+    return year
+
+
+def day_seconds(date):
+    '''Takes a date like '7 Apr 2011' and returns the seconds since the
+    epoch at its midnight UTC, or None for an unknown month.'''
+    day, month, year = date.split()
+    month = MONTHS.get(month[:3])
+    if month is None:
+        return None
+    return days_from_civil(full_year(year), month, int(day)) * 86400
+
+
+def parse_date_slow(datestr):
+    '''Parses anything email.utils understands. Raises ValueError if
+    it doesn't, or if the time of day is out of range, which email.utils
+    lets through (a leap second is fine).'''
+    # Rarely needed and the email package is slow to import
+    import email.utils
+    try:
+        parsed = email.utils.parsedate_tz(datestr)
+        if parsed is None:
+            raise ValueError
+        if not (0 <= parsed[3] < 24 and 0 <= parsed[4] < 60
+                and 0 <= parsed[5] <= 60):
+            raise ValueError
+        if parsed[9] is None:
+            parsed = parsed[:9] + (0,)
+        return email.utils.mktime_tz(parsed)
+    except (ValueError, IndexError, TypeError, OverflowError):
+        # parsedate_tz trips over some garbage instead of returning None
+        raise ValueError('Unable to parse date %r' % datestr)
+
+
+# The INTERNALDATE of a FETCH response, e.g.
+# 'INTERNALDATE " 7-Apr-2011 08:34:04 -0400"'
+INTERNALDATE_RE = re.compile(
+    r'INTERNALDATE "\s?(\d\d?)-([A-Za-z]{3})-(\d{4}) '
+    r'(\d\d):(\d\d):(\d\d) ([+-]\d{4})"')
+
+
+def parse_internaldate(response):
+    '''Takes a FETCH response containing an INTERNALDATE and returns
+    the number of seconds since the epoch. Raises ValueError if there
+    is none.'''
+    match = INTERNALDATE_RE.search(response)
+    if match is None:
+        raise ValueError('No INTERNALDATE in %r' % response)
+    # Reshape it as a Date header to share parse_date's caches
+    return parse_date('%s %s %s %s:%s:%s %s' % match.groups())
+
+
+def parse_date(datestr):
+    '''Takes a Date header like 'Thu, 7 Apr 2011 08:34:04 -0400 (EDT)'
+    and returns the number of seconds since the epoch. Raises
+    ValueError if the header can't be understood.'''
+    match = COMMON_RE.match(datestr) or DATE_RE.match(datestr)
+    if match is None:
+        return parse_date_slow(datestr)
+    date, hour, minute, second, zone = match.groups()
+    try:
+        return (DAY_CACHE[date] + HOURS[hour] * 3600 + NUMBERS[minute] * 60
+                + NUMBERS[second] - ZONE_CACHE[zone])
+    except KeyError:
+        pass
+
+    # First time we see this day or zone
+    midnight = DAY_CACHE.get(date)
+    if midnight is None:
+        midnight = day_seconds(date)
+        if midnight is None:
+            return parse_date_slow(datestr)
+        if len(DAY_CACHE) < MAX_CACHED:
+            DAY_CACHE[date] = midnight
+    offset = ZONE_CACHE.get(zone)
+    if offset is None:
+        offset = zone_offset(zone)
+        if len(ZONE_CACHE) < MAX_CACHED:
+            ZONE_CACHE[zone] = offset
+    if hour not in HOURS or minute not in NUMBERS or second not in NUMBERS:
+        return parse_date_slow(datestr)
+    return (midnight + HOURS[hour] * 3600 + NUMBERS[minute] * 60
+            + NUMBERS[second] - offset)
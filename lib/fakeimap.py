@@ -0,0 +1,776 @@
+'''
+A small local stand-in for the GMail IMAP server.
+
+It speaks just enough IMAP4rev1 and GMail extensions for the
+auto-archiver to run against it: XOAUTH authentication, SELECT, LIST,
+SEARCH with X-GM-LABELS and a subset of X-GM-RAW, FETCH, STORE, CLOSE,
+STATUS, CONDSTORE and optionally COMPRESS=DEFLATE. Everything is kept
+in memory and it speaks plain text rather than SSL, so connect with
+imaplib.IMAP4 rather than IMAP4_SSL.
+
+Supported X-GM-RAW terms:
+    label:<name>            message carries the label, written the way
+                            gmail shows it in searches: lower case, spaces
+                            and slashes as hyphens
+    label:"<name>"          message carries the label, named exactly
+    <word>                  the subject contains word, in any case
+    in:inbox                message is in the inbox
+    older_than:<n><d|m|y>   message date is more than n days/months/years ago
+    newer_than:<n><d|m|y>   message date is less than n days/months/years ago
+    before:<seconds>        message date is before the time (seconds since
+                            the epoch)
+    after:<seconds>         message date is at or after the time
+
+Example:
+    mailbox = FakeMailbox()
+    mailbox.add_message('Hello', time.time() - 5 * 86400, ['aa:3'])
+    server = FakeGmailServer(mailbox)
+    server.start()
+    imap_conn = imaplib.IMAP4('localhost', server.port)
+
+make_mailbox() builds synthetic mailboxes of any size, and the server
+can simulate a slow link with a round trip latency and a bandwidth
+limit on what it sends, one that drops every connection after so
+many commands, and one that enforces a quota per account the way gmail
+does: commands beyond it fail with NO [THROTTLED], and a client that
+keeps going is disconnected with BYE [OVERQUOTA].
+'''
+
+import Queue
+import SocketServer
+import base64
+from lib.compress import Deflate, DeflateSocket
+from lib.ratelimit import TokenBucket
+import bisect
+import email.utils
+import fnmatch
+import random
+import re
+import select
+import socket
+import sys
+import threading
+import time
+
+CAPABILITIES = 'IMAP4rev1 UNSELECT IDLE NAMESPACE ID CHILDREN X-GM-EXT-1 UIDPLUS AUTH=XOAUTH'
+
+# The mailbox name GMail uses for the inbox label
+INBOX = 'INBOX'
+INBOX_LABEL = '\\Inbox'
+
+# A term of an X-GM-RAW query, 'name:value', 'name:"quoted value"' or a
+# bare word
+RAW_TERM_RE = re.compile(r'\s*(?:(\w+):)?(?:"((?:[^"\\]|\\.)*)"|(\S+))')
+
+# older_than:/newer_than: units, in days
+RAW_UNITS = {'d': 1, 'm': 30, 'y': 365}
+
+# FETCH responses are sent in chunks of about this many bytes
+SEND_CHUNK = 64 * 1024
+
+# How many sends may wait for the simulated latency per connection
+OUTGOING_CHUNKS = 256
+
+# A connection whose commands have all been throttled for this many
+# seconds is closed
+OVERQUOTA_SECONDS = 2.0
+
+
+class FakeMessage(object):
+    '''A single message, identified by uid.'''
+
+    # Synthetic mailboxes hold up to a million of these
+    __slots__ = ('uid', 'subject', 'date', 'labels', 'flags', 'thrid',
+                 'modseq')
+
+    def __init__(self, uid, subject, date, labels, thrid=None, modseq=0):
+        self.uid = uid
+        self.subject = subject
+        self.date = date
+        self.labels = set(labels)
+        self.flags = set()
+        self.thrid = thrid or uid
+        self.modseq = modseq
+
+    def headers(self, names):
+        '''Returns the raw text of the requested header fields.'''
+        values = {
+            'DATE': email.utils.formatdate(self.date, localtime=False),
+            'SUBJECT': self.subject,
+        }
+        lines = ['%s: %s\r\n' % (name.capitalize(), values[name])
+                 for name in names if name in values]
+        return ''.join(lines) + '\r\n'
+
+
+class FakeMailbox(object):
+    '''All messages of one account. Folders are just labels, the inbox
+    is the \\Inbox label. Every change to a message gives it the next
+    modseq, for CONDSTORE, so change messages through relabel() or
+    call changed().'''
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = {}
+        self.labels = set()
+        self.next_uid = 1
+        self.highest_modseq = 1
+        self.lock = threading.Lock()
+
+    def add_message(self, subject, date, labels=(), in_inbox=True, thrid=None):
+        '''Adds a message dated date (seconds since the epoch) and returns
+        its uid.'''
+        labels = set(labels)
+        if in_inbox:
+            labels.add(INBOX_LABEL)
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.highest_modseq += 1
+            self.messages[uid] = FakeMessage(uid, subject, date, labels, thrid,
+                                             self.highest_modseq)
+            self.labels.update(labels)
+        return uid
+
+    def changed(self, msg):
+        '''Gives msg the next modseq. The caller holds the lock.'''
+        self.highest_modseq += 1
+        msg.modseq = self.highest_modseq
+
+    def relabel(self, uid, add=(), remove=()):
+        '''Adds and removes labels of the message uid.'''
+        with self.lock:
+            msg = self.messages[uid]
+            msg.labels.update(add)
+            msg.labels.difference_update(remove)
+            self.labels.update(add)
+            self.changed(msg)
+
+    def folder(self, name):
+        '''Returns the sorted uids of the messages in a folder.'''
+        label = INBOX_LABEL if name.upper() == INBOX else name
+        return sorted(uid for uid, msg in self.messages.items()
+                      if label in msg.labels)
+
+    def folder_names(self):
+        return [INBOX] + sorted(l for l in self.labels if l != INBOX_LABEL)
+
+
+SUBJECTS = ['Re: weekly report for the %s team', 'Your %s order has shipped',
+            'Fwd: notes from the %s meeting', '[%s] build failed',
+            'Invitation: %s sync']
+TEAMS = ['infra', 'sales', 'design', 'support', 'mobile']
+
+def make_mailbox(count, labels=('aa:1', 'aa:3', 'aa:7', 'aa:30'),
+                 labeled=0.5, days=60, seed=0, thread_length=1):
+    '''Returns a FakeMailbox with count synthetic inbox messages dated
+    over the last days days. A fraction labeled of them carries one of
+    labels, a few of those a second one. With a thread_length above 1,
+    messages are replies to the previous one, with its labels and a
+    later date, so that threads are that long on average. The same
+    arguments always give the same mailbox.'''
+    rand = random.Random(seed)
+    mailbox = FakeMailbox()
+    now = time.time()
+    # (thrid, labels, subject, date) of the last message
+    thread = None
+    for i in xrange(count):
+        if thread_length > 1 and thread \
+                and rand.random() > 1.0 / thread_length:
+            thrid, msg_labels, subject, date = thread
+            date = min(now, date + rand.randint(0, 86400))
+            mailbox.add_message('Re: %s' % subject, date, msg_labels,
+                                thrid=thrid)
+            thread = (thrid, msg_labels, subject, date)
+            continue
+        msg_labels = []
+        if rand.random() < labeled:
+            msg_labels.append(rand.choice(labels))
+            if rand.random() < 0.05:
+                msg_labels.append(rand.choice(labels))
+        subject = '%s #%d' % (rand.choice(SUBJECTS) % rand.choice(TEAMS), i)
+        date = now - rand.randint(0, days * 86400)
+        uid = mailbox.add_message(subject, date, msg_labels)
+        thread = (uid, msg_labels, subject, date)
+    return mailbox
+
+
+class CommandFailed(Exception):
+    '''Raised by a command to answer NO with the message.'''
+
+
+def tokenize(line):
+    '''Splits an IMAP argument string into atoms, quoted strings and
+    parenthesized lists (returned as nested lists).'''
+    stack = [[]]
+    pattern = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()"]+))')
+    pos = 0
+    line = line.strip()
+    while pos < len(line):
+        match = pattern.match(line, pos)
+        if not match:
+            break
+        quoted, open_paren, close_paren, atom = match.groups()
+        if open_paren:
+            stack.append([])
+        elif close_paren:
+            inner = stack.pop()
+            stack[-1].append(inner)
+        elif atom is not None:
+            stack[-1].append(atom)
+        else:
+            stack[-1].append(re.sub(r'\\(.)', r'\1', quoted))
+        pos = match.end()
+    return stack[0]
+
+
+def search_label(label):
+    '''Returns label the way gmail writes it in searches, e.g.
+    'lists-python' for 'Lists/Python'.'''
+    return re.sub(r'[\s/]', '-', label.lower())
+
+
+def quote(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def parse_ranges(set_str, largest):
+    '''Returns the (low, high) pairs of an IMAP sequence set like
+    1:4,7,9:*'''
+    ranges = []
+    for part in set_str.split(','):
+        if ':' in part:
+            lo, hi = part.split(':')
+        else:
+            lo = hi = part
+        lo = largest if lo == '*' else int(lo)
+        hi = largest if hi == '*' else int(hi)
+        ranges.append((min(lo, hi), max(lo, hi)))
+    return ranges
+
+
+def parse_set(set_str, largest):
+    '''Returns a predicate for an IMAP sequence set like 1:4,7,9:*'''
+    ranges = parse_ranges(set_str, largest)
+    return lambda n: any(lo <= n <= hi for lo, hi in ranges)
+
+
+class FakeGmailHandler(SocketServer.StreamRequestHandler):
+    '''Handles one client connection.'''
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # Set by LOGIN or AUTHENTICATE
+        self.mailbox = None
+        self.selected = None
+        # uids of the selected folder in sequence number order
+        self.view = []
+        # When the simulated link is done sending, see write()
+        self.link_free = 0
+        # Set once COMPRESS DEFLATE is active
+        self.deflate = None
+        # Commands answered so far, see FakeGmailServer's drop_after
+        self.commands = 0
+        # The FakeQuota of the account once logged in, and since when
+        # it throttled every command
+        self.quota = None
+        self.throttled_since = None
+        # With a latency, responses wait here for the writer thread
+        self.writer = None
+        if self.server.latency:
+            self.outgoing = Queue.Queue(OUTGOING_CHUNKS)
+            self.writer = threading.Thread(target=self.write_delayed)
+            self.writer.daemon = True
+            self.writer.start()
+
+    def finish(self):
+        if self.writer:
+            self.outgoing.put(None)
+            self.writer.join()
+        SocketServer.StreamRequestHandler.finish(self)
+
+    def send(self, data):
+        '''Sends data to the client, latency seconds from now. The
+        delay is in flight, like on a link with that round trip time,
+        so the responses to pipelined commands overlap.'''
+        if self.deflate:
+            data = self.deflate.compress(data)
+        if self.quota:
+            self.quota.sent(len(data))
+        if self.writer:
+            self.outgoing.put((time.time() + self.server.latency, data))
+        else:
+            self.write(data)
+
+    def write_delayed(self):
+        closed = False
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                return
+            due, data = item
+            # Once the client is gone the rest is dropped, but still
+            # taken off the queue so send() never blocks
+            if closed:
+                continue
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.write(data)
+            except socket.error:
+                closed = True
+
+    def write(self, data):
+        bandwidth = self.server.bandwidth
+        if bandwidth:
+            # Hold data back until the link would have carried
+            # everything sent before it
+            now = time.time()
+            self.link_free = (max(self.link_free, now)
+                              + len(data) / float(bandwidth))
+            if self.link_free - now > 0.001:
+                time.sleep(self.link_free - now)
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def untagged(self, line):
+        self.send('* %s\r\n' % line)
+
+    def handle(self):
+        self.untagged('OK Gimap ready for requests')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            # Hang up without an answer, like a dropped connection
+            if self.server.drop_after and \
+                    self.commands >= self.server.drop_after:
+                return
+            self.commands += 1
+            line = line.rstrip('\r\n')
+            tag, _, rest = line.partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            uid = False
+            if command == 'UID':
+                uid = True
+                command, _, args = args.partition(' ')
+                command = command.upper()
+
+            if self.quota and command != 'LOGOUT':
+                if not self.quota.allow():
+                    now = time.time()
+                    if self.throttled_since is None:
+                        self.throttled_since = now
+                    elif now - self.throttled_since >= OVERQUOTA_SECONDS:
+                        self.untagged('BYE [OVERQUOTA] Account exceeded '
+                                      'command or bandwidth limits')
+                        return
+                    self.send('%s NO [THROTTLED] Request throttled\r\n'
+                              % tag)
+                    continue
+                self.throttled_since = None
+
+            method = getattr(self, 'do_' + command.replace('-', '_'), None)
+            if method is None:
+                self.send('%s BAD Unknown command\r\n' % tag)
+                continue
+            try:
+                result = method(tag, args, uid)
+            except CommandFailed, e:
+                self.send('%s NO %s\r\n' % (tag, e))
+                continue
+            except Exception, e:
+                self.send('%s BAD %s\r\n' % (tag, e))
+                continue
+            if result is False:
+                return
+            self.send('%s OK %s %s\r\n' % (tag, command, result or 'Success'))
+            # Everything after the OK is compressed, both ways
+            if command == 'COMPRESS':
+                self.deflate = Deflate()
+                self.rfile = DeflateSocket(self.request,
+                                           self.deflate).makefile('rb')
+
+    ## Commands ---------------------------------------------------------
+
+    def do_CAPABILITY(self, tag, args, uid):
+        # Like gmail, COMPRESS and CONDSTORE are only offered once
+        # logged in
+        capabilities = CAPABILITIES
+        if self.mailbox is not None:
+            if self.server.compress:
+                capabilities += ' COMPRESS=DEFLATE'
+            if self.server.condstore:
+                capabilities += ' CONDSTORE'
+        self.untagged('CAPABILITY ' + capabilities)
+
+    def do_COMPRESS(self, tag, args, uid):
+        if not self.server.compress or args.upper() != 'DEFLATE':
+            raise ValueError('COMPRESS not supported')
+        if self.deflate:
+            raise ValueError('[COMPRESSIONACTIVE] Already compressing')
+        return 'DEFLATE active'
+
+    def do_NOOP(self, tag, args, uid):
+        pass
+
+    def do_LOGIN(self, tag, args, uid):
+        email = tokenize(args)[0]
+        self.mailbox = self.server.mailbox_for(email)
+        self.quota = self.server.quota_for(email)
+        return 'authenticated (Success)'
+
+    def do_AUTHENTICATE(self, tag, args, uid):
+        self.send('+ \r\n')
+        response = base64.b64decode(self.rfile.readline().strip())
+        # 'GET https://mail.google.com/mail/b/<email>/imap/ oauth_...'
+        match = re.match(r'GET https://mail\.google\.com/mail/b/([^/]+)/',
+                         response)
+        if not match:
+            raise ValueError('Invalid XOAUTH credentials')
+        self.mailbox = self.server.mailbox_for(match.group(1))
+        self.quota = self.server.quota_for(match.group(1))
+        return 'authenticated (Success)'
+
+    def do_LOGOUT(self, tag, args, uid):
+        self.untagged('BYE LOGOUT Requested')
+        self.send('%s OK LOGOUT Success\r\n' % tag)
+        return False
+
+    def do_SELECT(self, tag, args, uid):
+        name = tokenize(args)[0]
+        self.check_folder(name)
+        self.selected = name
+        self.view = self.mailbox.folder(name)
+        self.untagged('FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)')
+        self.untagged('OK [UIDVALIDITY %d]' % self.mailbox.uidvalidity)
+        self.untagged('%d EXISTS' % len(self.view))
+        self.untagged('0 RECENT')
+        self.untagged('OK [UIDNEXT %d]' % self.mailbox.next_uid)
+        if self.server.condstore:
+            self.untagged('OK [HIGHESTMODSEQ %d]'
+                          % self.mailbox.highest_modseq)
+        return '[READ-WRITE] %s selected. (Success)' % name
+
+    do_EXAMINE = do_SELECT
+
+    def check_folder(self, name):
+        if name.upper() != INBOX and name not in self.mailbox.labels:
+            raise CommandFailed('[NONEXISTENT] Unknown Mailbox: %s' % name)
+
+    def do_STATUS(self, tag, args, uid):
+        name, items = tokenize(args)
+        self.check_folder(name)
+        values = {'MESSAGES': len(self.mailbox.folder(name)),
+                  'UIDNEXT': self.mailbox.next_uid,
+                  'UIDVALIDITY': self.mailbox.uidvalidity,
+                  'HIGHESTMODSEQ': self.mailbox.highest_modseq}
+        self.untagged('STATUS %s (%s)' % (quote(name), ' '.join(
+            '%s %d' % (item.upper(), values[item.upper()])
+            for item in items)))
+
+    def do_LIST(self, tag, args, uid):
+        reference, pattern = tokenize(args)
+        regex = fnmatch.translate(pattern.replace('%', '*'))
+        for name in self.mailbox.folder_names():
+            if re.match(regex, name):
+                self.untagged('LIST (\\HasNoChildren) "/" %s' % quote(name))
+
+    def do_CLOSE(self, tag, args, uid):
+        self.expunge()
+        self.selected = None
+        self.view = []
+
+    def do_EXPUNGE(self, tag, args, uid):
+        for seq in reversed(self.expunge()):
+            self.untagged('%d EXPUNGE' % seq)
+
+    def expunge(self):
+        '''Removes \\Deleted messages from the selected folder, which in
+        GMail only removes the folder's label. Returns the expunged
+        sequence numbers.'''
+        label = INBOX_LABEL if self.selected.upper() == INBOX else self.selected
+        expunged = []
+        with self.mailbox.lock:
+            for seq, msg_uid in enumerate(self.view):
+                msg = self.mailbox.messages[msg_uid]
+                if '\\Deleted' in msg.flags:
+                    msg.flags.discard('\\Deleted')
+                    msg.labels.discard(label)
+                    self.mailbox.changed(msg)
+                    expunged.append(seq + 1)
+            self.view = [u for u in self.view
+                         if label in self.mailbox.messages[u].labels]
+        return expunged
+
+    def do_IDLE(self, tag, args, uid):
+        self.send('+ idling\r\n')
+        while True:
+            readable, _, _ = select.select([self.request], [], [], 0.05)
+            if readable:
+                self.rfile.readline()
+                return 'IDLE terminated (Success)'
+            uids = self.mailbox.folder(self.selected)
+            if uids != self.view:
+                self.view = uids
+                self.untagged('%d EXISTS' % len(uids))
+
+    def do_SEARCH(self, tag, args, uid):
+        criteria = tokenize(args)
+        if criteria and str(criteria[0]).upper() == 'CHARSET':
+            criteria = criteria[2:]
+        matched = []
+        self.set_cache = {}
+        for seq, msg_uid in enumerate(self.view):
+            msg = self.mailbox.messages[msg_uid]
+            if self.matches(list(criteria), seq + 1, msg):
+                matched.append(msg_uid if uid else seq + 1)
+        self.untagged(' '.join(['SEARCH'] + [str(n) for n in matched]))
+
+    def matches(self, criteria, seq, msg):
+        '''Returns True when msg matches every search key in criteria.'''
+        while criteria:
+            if not self.match_key(criteria, seq, msg):
+                return False
+        return True
+
+    def match_key(self, criteria, seq, msg):
+        '''Consumes one search key from the front of criteria and
+        returns whether msg matches it.'''
+        key = criteria.pop(0)
+        if isinstance(key, list):
+            return self.matches(list(key), seq, msg)
+        upper = key.upper()
+        if upper == 'ALL':
+            return True
+        if upper == 'OR':
+            first = self.match_key(criteria, seq, msg)
+            second = self.match_key(criteria, seq, msg)
+            return first or second
+        if upper == 'NOT':
+            return not self.match_key(criteria, seq, msg)
+        if upper == 'UID':
+            largest = self.view[-1] if self.view else 0
+            return self.cached_set(criteria.pop(0), largest)(msg.uid)
+        if upper == 'X-GM-LABELS':
+            return criteria.pop(0) in msg.labels
+        if upper == 'X-GM-RAW':
+            return self.match_raw(criteria.pop(0), msg)
+        if upper == 'DELETED':
+            return '\\Deleted' in msg.flags
+        if upper == 'UNDELETED':
+            return '\\Deleted' not in msg.flags
+        if re.match(r'^[\d:*,]+$', key):
+            return self.cached_set(key, len(self.view))(seq)
+        raise ValueError('Unsupported search key %s' % key)
+
+    def cached_set(self, set_str, largest):
+        '''parse_set, but the criteria are evaluated once per message so
+        only parse each set once per SEARCH.'''
+        key = (set_str, largest)
+        if key not in self.set_cache:
+            self.set_cache[key] = parse_set(set_str, largest)
+        return self.set_cache[key]
+
+    def match_raw(self, query, msg):
+        '''Evaluates the supported subset of GMail's search syntax.'''
+        for match in RAW_TERM_RE.finditer(query.strip()):
+            name, quoted, value = match.groups()
+            term = match.group(0).strip()
+            if quoted is not None:
+                value = re.sub(r'\\(.)', r'\1', quoted)
+            name = (name or '').lower()
+            if not name:
+                if value.lower() not in msg.subject.lower():
+                    return False
+            elif name == 'label':
+                if quoted is not None:
+                    found = value.lower() in [l.lower() for l in msg.labels]
+                else:
+                    found = value.lower() in [search_label(l)
+                                              for l in msg.labels]
+                if not found:
+                    return False
+            elif name == 'in' and value.lower() == 'inbox':
+                if INBOX_LABEL not in msg.labels:
+                    return False
+            elif name in ('older_than', 'newer_than'):
+                days = int(value[:-1]) * RAW_UNITS[value[-1].lower()]
+                older = time.time() - msg.date > days * 86400
+                if older != (name == 'older_than'):
+                    return False
+            elif name in ('before', 'after'):
+                if (msg.date < int(value)) != (name == 'before'):
+                    return False
+            else:
+                raise ValueError('Unsupported X-GM-RAW term %s' % term)
+        return True
+
+    def selected_messages(self, set_str, uid):
+        '''Yields (seq, message) for a sequence or uid set.'''
+        if uid:
+            largest = self.view[-1] if self.view else 0
+        else:
+            largest = len(self.view)
+        # Look every range up in the sorted view rather than testing
+        # each message, sets cover a small part of large mailboxes
+        positions = set()
+        for lo, hi in parse_ranges(set_str, largest):
+            if uid:
+                start = bisect.bisect_left(self.view, lo)
+                end = bisect.bisect_right(self.view, hi)
+            else:
+                start, end = max(lo, 1) - 1, min(hi, largest)
+            positions.update(xrange(start, end))
+        for pos in sorted(positions):
+            yield pos + 1, self.mailbox.messages[self.view[pos]]
+
+    def do_FETCH(self, tag, args, uid):
+        set_str, _, items = args.partition(' ')
+        items = items.upper()
+        # CONDSTORE: only messages changed since, with their MODSEQ
+        since = None
+        match = re.search(r'\s*\(CHANGEDSINCE (\d+)\)$', items)
+        if match:
+            if not self.server.condstore:
+                raise ValueError('CHANGEDSINCE not supported')
+            since = int(match.group(1))
+            items = items[:match.start()] + ' MODSEQ'
+        # One write per response is a syscall per message, send them
+        # in chunks instead
+        chunk, size = [], 0
+        for seq, msg in self.selected_messages(set_str, uid):
+            if since is not None and msg.modseq <= since:
+                continue
+            response = self.fetch_response(seq, msg, items, uid)
+            chunk.append(response)
+            size += len(response)
+            if size >= SEND_CHUNK:
+                self.send(''.join(chunk))
+                chunk, size = [], 0
+        self.send(''.join(chunk))
+
+    def fetch_response(self, seq, msg, items, uid):
+        parts = []
+        if uid or re.search(r'\bUID\b', items):
+            parts.append('UID %d' % msg.uid)
+        if 'FLAGS' in items.replace('X-GM-LABELS', ''):
+            parts.append('FLAGS (%s)' % ' '.join(sorted(msg.flags)))
+        if 'X-GM-THRID' in items:
+            parts.append('X-GM-THRID %d' % msg.thrid)
+        if re.search(r'\bMODSEQ\b', items):
+            parts.append('MODSEQ (%d)' % msg.modseq)
+        if 'INTERNALDATE' in items:
+            parts.append('INTERNALDATE "%s"' % time.strftime(
+                '%d-%b-%Y %H:%M:%S +0000', time.gmtime(msg.date)))
+        if 'X-GM-LABELS' in items:
+            parts.append('X-GM-LABELS (%s)' % ' '.join(
+                quote(l) for l in sorted(msg.labels)))
+        literal = ''
+        match = re.search(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]', items)
+        if match:
+            literal = msg.headers(match.group(1).split())
+            parts.append('BODY[HEADER.FIELDS (%s)] {%d}\r\n%s' % (
+                match.group(1), len(literal), literal))
+            if 'PEEK' not in match.group(0) and '\\Seen' not in msg.flags:
+                msg.flags.add('\\Seen')
+                self.mailbox.changed(msg)
+        return '* %d FETCH (%s)\r\n' % (seq, ' '.join(parts))
+
+    def do_STORE(self, tag, args, uid):
+        set_str, item, value = args.split(' ', 2)
+        item = item.upper()
+        values = tokenize(value)
+        if values and isinstance(values[0], list):
+            values = values[0]
+        attr = 'labels' if item.lstrip('+-').startswith('X-GM-LABELS') else 'flags'
+        with self.mailbox.lock:
+            for seq, msg in self.selected_messages(set_str, uid):
+                current = getattr(msg, attr)
+                if item.startswith('+'):
+                    current.update(values)
+                elif item.startswith('-'):
+                    current.difference_update(values)
+                else:
+                    setattr(msg, attr, set(values))
+                self.mailbox.changed(msg)
+                if not item.endswith('.SILENT'):
+                    self.send(self.fetch_response(seq, msg, item, uid))
+
+
+class FakeQuota(object):
+    '''The commands and bytes per second one account may use, 0 for no
+    limit. Shared by all the connections of the account.'''
+
+    def __init__(self, commands=0, bytes=0):
+        self.commands = TokenBucket(commands)
+        self.bytes = TokenBucket(bytes)
+
+    def allow(self):
+        '''Returns True if one more command is within the quota.'''
+        return self.bytes.take(0) == 0 and self.commands.try_take(1)
+
+    def sent(self, count):
+        self.bytes.take(count)
+
+
+class FakeGmailServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''Serves a FakeMailbox on localhost, or several given as a dict
+    {email: FakeMailbox}, picked by the user clients log in as. latency
+    is the number of seconds every response takes to reach the client,
+    bandwidth the number of bytes per second sent to each client, 0
+    for no limit. With compress, COMPRESS=DEFLATE is offered, with
+    condstore CONDSTORE. With drop_after, every connection is closed
+    when it sends a command after drop_after of them. quota is a tuple
+    (commands per second, bytes per second sent) every account gets,
+    see FakeQuota.'''
+
+    allow_reuse_address = True
+    daemon_threads = True
+    # Benchmarks open hundreds of connections at once
+    request_queue_size = 1024
+
+    def __init__(self, mailbox, port=0, latency=0, bandwidth=0,
+                 compress=False, condstore=True, drop_after=0, quota=None):
+        SocketServer.TCPServer.__init__(self, ('localhost', port),
+                                        FakeGmailHandler)
+        self.mailbox = mailbox
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.compress = compress
+        self.condstore = condstore
+        self.drop_after = drop_after
+        self.quota = quota
+        self.quotas = {}
+        self.quotas_lock = threading.Lock()
+        self.port = self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response, e.g. on a timeout, are normal
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.TCPServer.handle_error(self, request,
+                                                client_address)
+
+    def mailbox_for(self, email):
+        if isinstance(self.mailbox, dict):
+            if email not in self.mailbox:
+                raise ValueError('Unknown user %s' % email)
+            return self.mailbox[email]
+        return self.mailbox
+
+    def quota_for(self, email):
+        if not self.quota:
+            return None
+        with self.quotas_lock:
+            if email not in self.quotas:
+                self.quotas[email] = FakeQuota(*self.quota)
+            return self.quotas[email]
+
+    def start(self):
+        '''Serves requests from a background thread.'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
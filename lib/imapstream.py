@@ -0,0 +1,208 @@
+'''
+Streaming FETCH and pipelined commands for imaplib connections.
+
+imaplib reads every response to a command into a list before handing
+any of it back, so memory grows with the size of the FETCH and nothing
+can be done with the first message until the last one has arrived.
+stream_fetch() sends the command itself and yields each FETCH response
+as soon as it has been read.
+
+imaplib also waits for the tagged response to a command before it
+sends the next one, so every command costs a round trip. pipeline()
+sends a run of independent commands back to back and matches the
+tagged responses as they come in, the round trips overlap.
+
+On a connection with a lib.ratelimit limiter, both send commands the
+server throttled again, once the limiter has backed off, and pipeline()
+keeps no more commands in flight than the limiter's window.
+
+run_session() drives a lib.asyncimap session with them, so the same
+code can talk to the server from a thread on imaplib or from
+asyncimap's event loop.
+'''
+
+from collections import deque
+import re
+import sys
+
+from lib.asyncimap import Fetch, Nested
+from lib.ratelimit import THROTTLED_RETRIES, is_throttled
+
+# A response line announcing a literal, e.g. '... BODY[HEADER] {60}\r\n'
+LITERAL_RE = re.compile(r'\{(\d+)\}\r\n$')
+
+# How many commands pipeline() keeps in flight by default
+PIPELINE_DEPTH = 16
+
+
+def read_response(s):
+    '''Reads one response from the imaplib connection s, including any
+    literals in it. Returns a tuple (text, literal): text is the
+    response with the literals left out, e.g.
+    '* 1 (UID 5 BODY[...] {60} )', literal the first literal or None.'''
+    line = s.readline()
+    if not line:
+        raise s.abort('Connection closed by the server')
+    parts = [line.rstrip('\r\n')]
+    literal = None
+    match = LITERAL_RE.search(line)
+    while match:
+        data = s.read(int(match.group(1)))
+        if literal is None:
+            literal = data
+        line = s.readline()
+        parts.append(line.rstrip('\r\n'))
+        match = LITERAL_RE.search(line)
+    return ' '.join(parts), literal
+
+
+def send_again(s, status, tries):
+    '''Returns True if a command of s that failed with status after
+    tries retries should be sent again: the server throttled it and s
+    has a limiter to slow down with.'''
+    return (getattr(s, 'limiter', None) is not None
+            and tries < THROTTLED_RETRIES and is_throttled(status))
+
+
+def stream_fetch(s, msg_set, items, uid=True):
+    '''Sends a (UID) FETCH on the imaplib connection s and yields a
+    tuple (response, literal) per message, in the shape imaplib would
+    have returned them: response is the text of the response without
+    the leading '* ', e.g. '1 (UID 5 BODY[...] {60} )', and literal the
+    string literal it contained or None. The generator must be run to
+    the end before s is used for anything else.'''
+    command = uid and 'UID FETCH' or 'FETCH'
+    tries = 0
+    while True:
+        tag = s._new_tag()
+        s.send('%s %s %s %s\r\n' % (tag, command, msg_set, items))
+
+        while True:
+            response, literal = read_response(s)
+            if response.startswith(tag + ' '):
+                break
+            # Skip anything unrelated, e.g. '* 12 EXISTS'
+            if ' FETCH ' in response:
+                yield response[2:], literal
+
+        status = response[len(tag) + 1:]
+        if status.startswith('OK'):
+            return
+        # A throttled command fails before it fetches anything
+        if not send_again(s, status, tries):
+            raise s.error('%s failed: %s' % (command, status))
+        tries += 1
+
+
+def pipeline(s, commands, depth=PIPELINE_DEPTH):
+    '''Sends commands, e.g. 'UID SEARCH X-GM-LABELS "aa:3"', on the
+    imaplib connection s with up to depth of them in flight, and yields
+    the untagged responses of each one as a list of (response, literal)
+    tuples shaped like those of stream_fetch, in the order of commands.
+
+    The server must answer commands in the order they were sent,
+    untagged responses are taken to belong to the oldest command still
+    running. gmail does, but only send commands that don't depend on
+    each other. If one fails, the ones already sent are still read
+    before s.error is raised, so s stays usable. A throttled command
+    is sent again along with all those sent after it, whatever their
+    outcome, so the order holds; commands must be safe to repeat. The
+    generator must be run to the end before s is used for anything
+    else.'''
+    limiter = getattr(s, 'limiter', None)
+    commands = iter(commands)
+    # (command, tries) to send before the rest of commands
+    again = deque()
+    # Once a command is throttled, it and those sent after it
+    throttled = None
+    running = deque()
+    untagged = []
+    error = None
+    while True:
+        if throttled is not None and not running:
+            again.extendleft(reversed(throttled))
+            throttled = None
+
+        # Send the next commands in one go, separate small writes would
+        # wait for each other's ACKs
+        lines = []
+        window = limiter and limiter.window(depth) or depth
+        while error is None and throttled is None \
+                and len(running) + len(lines) < window:
+            if again:
+                command, tries = again.popleft()
+            else:
+                command, tries = next(commands, None), 0
+            if command is None:
+                break
+            tag = s._new_tag()
+            running.append((tag, command, tries))
+            lines.append('%s %s\r\n' % (tag, command))
+        if lines:
+            s.send(''.join(lines))
+        if not running:
+            break
+
+        tag, command, tries = running[0]
+        response, literal = read_response(s)
+        if response.startswith('* '):
+            untagged.append((response[2:], literal))
+        elif response.startswith(tag + ' '):
+            running.popleft()
+            status = response[len(tag) + 1:]
+            if throttled is not None:
+                throttled.append((command, tries))
+            elif not status.startswith('OK'):
+                if error is None and send_again(s, status, tries):
+                    throttled = [(command, tries + 1)]
+                else:
+                    error = error or '%s failed: %s' % (command, status)
+            elif error is None:
+                yield untagged
+            untagged = []
+        else:
+            raise s.abort('Unexpected response: %s' % response)
+
+    if error:
+        raise s.error(error)
+
+
+def run_session(s, session):
+    '''Runs the lib.asyncimap session on the imaplib connection s and
+    returns what it raised Return with. Lists of commands are sent with
+    pipeline(), s.pipeline_depth of them in flight, and Fetches with
+    stream_fetch(). Errors are those of imaplib, e.g. s.error for a NO.
+    imaplib's own methods still work in between: s.state follows the
+    SELECTs and CLOSEs of the session.'''
+    session = Nested(session)
+    untagged, error = None, None
+    while True:
+        try:
+            if error:
+                request = session.throw(*error)
+            else:
+                request = session.send(untagged)
+        except StopIteration:
+            return session.result
+        try:
+            untagged, error = execute(s, request), None
+        except Exception:
+            untagged, error = None, sys.exc_info()
+
+
+def execute(s, request):
+    '''Sends what a session yielded on s and returns its responses.'''
+    if isinstance(request, list):
+        return pipeline(s, [getattr(command, 'text', command)
+                            for command in request],
+                        getattr(s, 'pipeline_depth', PIPELINE_DEPTH))
+    if isinstance(request, Fetch):
+        return stream_fetch(s, request.msg_set, request.items)
+    command = getattr(request, 'text', request)
+    untagged = list(pipeline(s, [command], 1))[0]
+    name = command.split(' ', 1)[0].upper()
+    if name in ('SELECT', 'EXAMINE'):
+        s.state = 'SELECTED'
+    elif name == 'CLOSE':
+        s.state = 'AUTH'
+    return untagged
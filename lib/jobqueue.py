@@ -0,0 +1,212 @@
+'''
+A job table that lets several processes split a list of accounts, on
+one machine or on several sharing a filesystem whose locks work (not
+every network filesystem's do).
+
+The table is an SQLite database with a row per account. A worker claims
+an account by taking a lease on it, which expires LEASE_SECONDS later
+unless the worker renews it. A JobQueue renews the leases of the jobs
+it holds every HEARTBEAT_SECONDS while they run, and releases each one
+when its run is over, recording the outcome. When a worker crashes its
+leases run out, and the next claim by any worker takes the account
+over. A worker that is only slow can find its lease taken over too:
+the renewal marks the Job lost, and its run must stop there rather
+than go on next to the new holder.
+
+Claims run in BEGIN IMMEDIATE transactions, which SQLite serializes, so
+two workers never hold the same account. A worker only claims accounts
+that were last finished before the given time, usually when it started,
+so an account is archived once per pass however many workers share it.
+When the only accounts left are held by others, it waits for them to
+be released or taken over, so the pass ends with every account done.
+'''
+
+from contextlib import contextmanager
+import sqlite3
+import threading
+import time
+
+# How long to wait for the transaction of another worker to finish
+BUSY_TIMEOUT = 30
+
+# How often the leases held are renewed
+HEARTBEAT_SECONDS = 15
+
+# How long a lease lasts without being renewed, i.e. how long the
+# accounts of a crashed worker wait to be taken over. A renewal that
+# waits out BUSY_TIMEOUT and fails still leaves time for the next one.
+LEASE_SECONDS = 2 * (HEARTBEAT_SECONDS + BUSY_TIMEOUT)
+
+# How often a worker waiting for the accounts held by others looks again
+POLL_SECONDS = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (
+    email TEXT PRIMARY KEY,
+    oauth_path TEXT NOT NULL,
+    worker TEXT,
+    expires REAL,
+    runs INTEGER NOT NULL DEFAULT 0,
+    finished REAL NOT NULL DEFAULT 0,
+    archived INTEGER,
+    error TEXT
+)'''
+
+
+class Job(object):
+    '''The account email, whose oauth identity is at oauth_path, leased
+    to worker until expires (seconds since the epoch). lost is set once
+    another worker took it over.'''
+
+    def __init__(self, email, oauth_path, worker, expires):
+        self.email = email
+        self.oauth_path = oauth_path
+        self.worker = worker
+        self.expires = expires
+        self.lost = False
+
+
+class JobQueue(object):
+    '''The job table in the SQLite database at path, created if needed.
+    Thread safe, every call uses a connection of its own.'''
+
+    def __init__(self, path, lease_seconds=None, heartbeat_seconds=None):
+        self.path = path
+        self.lease_seconds = lease_seconds or LEASE_SECONDS
+        self.heartbeat_seconds = heartbeat_seconds or HEARTBEAT_SECONDS
+        self.lock = threading.Lock()
+        # email -> Job, the jobs this JobQueue holds
+        self.held = {}
+        self.heartbeat = None
+        self.stopped = threading.Event()
+        with self.transaction() as db:
+            db.execute(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        '''Yields a connection in a write transaction, committed unless
+        an exception escapes.'''
+        db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                             isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def add(self, accounts):
+        '''Adds the (email, oauth identity path) tuples in accounts that
+        aren't in the table yet and updates the paths of those that
+        are.'''
+        with self.transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO accounts (email, '
+                           'oauth_path) VALUES (?, ?)', accounts)
+            db.executemany('UPDATE accounts SET oauth_path = ? '
+                           'WHERE email = ?',
+                           [(path, email) for email, path in accounts])
+
+    def claim(self, worker, before):
+        '''Leases the account last finished before before (seconds since
+        the epoch) the longest ago, which no one holds or whose lease
+        ran out, to worker. While all such accounts are held, waits for
+        one to come free. Returns its Job, or None once every account
+        was finished since before.'''
+        while True:
+            now = time.time()
+            with self.transaction() as db:
+                row = db.execute(
+                    'SELECT email, oauth_path FROM accounts WHERE '
+                    'finished < ? AND (expires IS NULL OR expires < ?) '
+                    'ORDER BY finished LIMIT 1', (before, now)).fetchone()
+                if row is None:
+                    held = db.execute(
+                        'SELECT COUNT(*) FROM accounts WHERE finished < ?',
+                        (before,)).fetchone()[0]
+                else:
+                    job = Job(row[0], row[1], worker,
+                              now + self.lease_seconds)
+                    db.execute('UPDATE accounts SET worker = ?, '
+                               'expires = ? WHERE email = ?',
+                               (worker, job.expires, job.email))
+            if row is not None:
+                break
+            if not held:
+                return None
+            time.sleep(POLL_SECONDS)
+        with self.lock:
+            self.held[job.email] = job
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self.beat)
+                self.heartbeat.daemon = True
+                self.heartbeat.start()
+        return job
+
+    def renew(self, jobs):
+        '''Extends the leases of jobs. Those another worker took over
+        are marked lost and dropped.'''
+        expires = time.time() + self.lease_seconds
+        with self.transaction() as db:
+            for job in jobs:
+                renewed = db.execute(
+                    'UPDATE accounts SET expires = ? '
+                    'WHERE email = ? AND worker = ?',
+                    (expires, job.email, job.worker)).rowcount
+                if renewed:
+                    job.expires = expires
+                else:
+                    job.lost = True
+        with self.lock:
+            for job in jobs:
+                if job.lost:
+                    self.held.pop(job.email, None)
+
+    def beat(self):
+        '''Renews the leases held every heartbeat_seconds, until
+        close().'''
+        while not self.stopped.wait(self.heartbeat_seconds):
+            with self.lock:
+                jobs = self.held.values()
+            if not jobs:
+                continue
+            try:
+                self.renew(jobs)
+            except sqlite3.Error, e:
+                # Try again next time, the leases last a few beats
+                print 'Could not renew the leases: %s' % e
+
+    def release(self, job, archived=0, error=None):
+        '''Ends the lease of job, recording that the run archived
+        archived messages or failed with error. Returns False, recording
+        nothing, if another worker took the account over.'''
+        with self.lock:
+            self.held.pop(job.email, None)
+        with self.transaction() as db:
+            released = db.execute(
+                'UPDATE accounts SET worker = NULL, expires = NULL, '
+                'runs = runs + 1, finished = ?, archived = ?, error = ? '
+                'WHERE email = ? AND worker = ?',
+                (time.time(), archived, error, job.email,
+                 job.worker)).rowcount
+        if not released:
+            job.lost = True
+        return not job.lost
+
+    def accounts(self):
+        '''Returns a list of dicts, one per row of the table, ordered by
+        email.'''
+        db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        try:
+            db.row_factory = sqlite3.Row
+            return [dict(zip(row.keys(), row)) for row in db.execute(
+                'SELECT * FROM accounts ORDER BY email')]
+        finally:
+            db.close()
+
+    def close(self):
+        '''Stops the heartbeat, the leases still held run out.'''
+        self.stopped.set()
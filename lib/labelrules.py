@@ -0,0 +1,179 @@
+'''
+Which labels set an age limit, and how long it is.
+
+A rule is a regular expression for label names with {age} where the
+age limit goes, e.g. 'aa:{age}' or 'archive/{age}'. An age is a number
+with an optional unit, h, d or w for hours, days or weeks, days when
+there is none: 'aa:3', 'aa:12h', 'archive/2w'. LabelRules compiles all
+the rules into one regular expression, anchored at both ends, so every
+label takes a single match however many rules there are, the first
+rule that matches winning. What every label and LIST response matched is
+remembered, so the later LISTs of an account with hundreds of labels
+cost a dict lookup per label.
+
+The labels of a mailbox found by the rules make an AgeTable, their age
+limits in seconds. Its thresholds, the distinct limits, are sorted once
+with the labels of each, so that a message with several labels gets
+the shortest limit from the first search that finds it, and one search
+per threshold covers all its labels rather than one per label.
+'''
+
+import re
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+# Seconds per unit, '' is days
+UNITS = {'h': HOUR, 'd': DAY, 'w': WEEK, '': DAY}
+
+AGE = r'(\d+)([hdw]?)'
+# The longest age limit in seconds, what lib.msgindex keeps them in
+# holds: a signed 32 bit int, some 68 years. Messages that old predate
+# email, so longer limits are cut to it.
+MAX_AGE = 2 ** 31 - 1
+AGE_PLACEHOLDER = '{age}'
+
+# Python 2's re handles at most 100 groups per expression, the rules
+# are compiled into as many as it takes
+MAX_GROUPS = 99
+
+# A LIST response such as '(\\HasNoChildren) "/" "aa:1"', the name
+# quoted or not
+LIST_RE = re.compile(r'\([^)]*\) (?:"(?:[^"\\]|\\.)*"|NIL) '
+                     r'(?:"((?:[^"\\]|\\.)*)"|(\S+))')
+
+
+def parse_age(number, unit=''):
+    '''Returns the age number unit, e.g. ('12', 'h'), in seconds, at
+    most MAX_AGE.'''
+    return min(int(number) * UNITS[unit.lower()], MAX_AGE)
+
+
+class LabelRules(object):
+    '''The rules in the list patterns, compiled. Raises ValueError if a
+    pattern isn't a regular expression with {age} once in it.'''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        # [(compiled expression, [(outer group, age group)])]
+        self.expressions = []
+        parts, groups, offsets = [], 0, []
+        for pattern in self.patterns:
+            if pattern.count(AGE_PLACEHOLDER) != 1:
+                raise ValueError('Label rule %r must have %s once' % (
+                    pattern, AGE_PLACEHOLDER))
+            before, after = pattern.split(AGE_PLACEHOLDER)
+            # So that a | in the rule stays on its side of {age}
+            part = '((?:%s)%s(?:%s))' % (before, AGE, after)
+            try:
+                count = re.compile(part).groups
+                # {age} inside a group of the rule leaves this unbalanced
+                skipped = re.compile(before).groups
+            except re.error, e:
+                raise ValueError('Bad label rule %r: %s' % (pattern, e))
+            if groups + count > MAX_GROUPS:
+                self.add_expression(parts, offsets)
+                parts, groups, offsets = [], 0, []
+            # The age groups come right after the groups of before
+            offsets.append((groups + 1, groups + 2 + skipped))
+            parts.append(part)
+            groups += count
+        if parts:
+            self.add_expression(parts, offsets)
+        # label -> age in seconds, None if no rule matches it
+        self.seen = {}
+        # LIST response -> (label, age) or None, the same
+        self.listed = {}
+
+    def add_expression(self, parts, offsets):
+        self.expressions.append((re.compile('(?:%s)\\Z' % '|'.join(parts)),
+                                 dict(offsets)))
+
+    def age(self, label):
+        '''Returns the age limit label sets in seconds, None if it
+        matches no rule.'''
+        if label in self.seen:
+            return self.seen[label]
+        age = None
+        for expression, offsets in self.expressions:
+            match = expression.match(label)
+            if match:
+                # The rule's outer group closes last
+                number = offsets[match.lastindex]
+                age = parse_age(match.group(number), match.group(number + 1))
+                break
+        self.seen[label] = age
+        return age
+
+    def label_ages(self, labels):
+        '''Returns a list of tuples (label, age in seconds) of the labels
+        that match a rule, shortest age first.'''
+        found = []
+        for label in labels:
+            age = self.age(label)
+            if age is not None:
+                found.append((label, age))
+        return sorted(found, key=lambda (label, age): (age, label))
+
+    def parse_list(self, list_of_labels):
+        '''label_ages for the names in the LIST responses
+        list_of_labels.'''
+        listed = self.listed
+        found = []
+        for item in list_of_labels:
+            if item in listed:
+                label_age = listed[item]
+            else:
+                label_age = listed[item] = self.parse_item(item)
+            if label_age is not None:
+                found.append(label_age)
+        return sorted(found, key=lambda (label, age): (age, label))
+
+    def parse_item(self, item):
+        '''Returns (label, age) for the LIST response item, None if it
+        sets no age.'''
+        match = LIST_RE.match(item)
+        if not match:
+            return None
+        quoted, label = match.groups()
+        if label is None:
+            label = quoted
+            if '\\' in label:
+                label = re.sub(r'\\(.)', r'\1', label)
+        age = self.age(label)
+        if age is None:
+            return None
+        return label, age
+
+
+class AgeTable(object):
+    '''The age limits of the labels of one mailbox, label_ages a list of
+    tuples (label, age in seconds).'''
+
+    def __init__(self, label_ages):
+        self.ages = dict(label_ages)
+        # The distinct ages, ascending, and the labels of each
+        self.thresholds = sorted(set(self.ages.values()))
+        labels = dict((age, []) for age in self.thresholds)
+        for label, age in sorted(self.ages.items()):
+            labels[age].append(label)
+        self.labels = [labels[age] for age in self.thresholds]
+
+    def shortest(self, labels):
+        '''Returns the shortest age limit among labels, None if none of
+        them sets one.'''
+        ages = self.ages
+        found = [ages[label] for label in labels if label in ages]
+        if not found:
+            return None
+        return min(found)
+
+    def groups(self, size):
+        '''Returns a list of tuples (age, labels), shortest age first,
+        with at most size labels in each.'''
+        groups = []
+        for age, labels in zip(self.thresholds, self.labels):
+            for start in xrange(0, len(labels), size):
+                groups.append((age, labels[start:start + size]))
+        return groups
@@ -0,0 +1,312 @@
+'''
+Per phase metrics for an archiving run.
+
+A run is split into phases named after the functions doing the work:
+connect, select, get_autoarchive_labels, get_message_ids, fetch_emails,
+get_messages_to_archive and archive_messages. For each one we record
+the wall time, the number of IMAP commands, the bytes sent and received
+and the number of messages it dealt with.
+
+Phases nest, e.g. archive_messages runs between the FETCH batches of
+fetch_emails, and every second and byte is charged to the innermost
+phase open at the time, so nothing is counted twice.
+
+The connection returned by connect() is an instance of counting(), it
+carries its Metrics as s.metrics. Code that only has the connection
+uses the phase() and count() helpers, which do nothing for connections
+without metrics, e.g. plain imaplib ones.
+
+Bytes are counted before compression. When the connection uses
+COMPRESS=DEFLATE (lib.compress), records also tell how many went over
+the wire. When it is rate limited (lib.ratelimit), they tell how often
+the server throttled the account and how long the run waited for the
+limiter.
+
+The connections of one run side by side, e.g. one per folder with
+--folders, are recorded as one by MergedMetrics: their commands, bytes
+and phases add up, so a phase can take more seconds than the run.
+
+Functions in observers are called at every phase boundary, with the
+account, the name of the phase and 'start' or 'end', e.g. by
+lib.profiling.MemoryTracer.
+'''
+
+from contextlib import contextmanager
+import json
+import os
+import time
+
+# The order phases are reported in
+PHASES = ['connect', 'select', 'get_autoarchive_labels', 'get_message_ids',
+          'fetch_emails', 'get_messages_to_archive', 'archive_messages']
+
+FIELDS = ['seconds', 'commands', 'bytes_sent', 'bytes_received', 'messages']
+
+# Called at every phase boundary, see the module docstring
+observers = []
+
+_counting_classes = {}
+
+
+def counting(imap_class):
+    '''Returns a subclass of imap_class (imaplib.IMAP4 or IMAP4_SSL) that
+    counts the commands it sends and the bytes it sends and receives.'''
+    if imap_class in _counting_classes:
+        return _counting_classes[imap_class]
+
+    # imaplib's classes are old style, so no super()
+    class CountingIMAP4(imap_class):
+        commands = 0
+        bytes_sent = 0
+        bytes_received = 0
+        metrics = None
+
+        def _new_tag(self):
+            self.commands += 1
+            return imap_class._new_tag(self)
+
+        def send(self, data):
+            self.bytes_sent += len(data)
+            imap_class.send(self, data)
+
+        def read(self, size):
+            data = imap_class.read(self, size)
+            self.bytes_received += len(data)
+            return data
+
+        def readline(self):
+            line = imap_class.readline(self)
+            self.bytes_received += len(line)
+            return line
+
+    CountingIMAP4.__name__ = 'Counting' + imap_class.__name__
+    _counting_classes[imap_class] = CountingIMAP4
+    return CountingIMAP4
+
+
+class Metrics(object):
+    '''The phases of one run on one connection to account.'''
+
+    def __init__(self, account):
+        self.account = account
+        self.started = time.time()
+        self.conn = None
+        # name -> {field: value}
+        self.phases = {}
+        # [name, since, counters since] of the open phases, innermost last
+        self.stack = []
+
+    def attach(self, conn):
+        '''Starts counting the commands and bytes of conn, a counting()
+        connection.'''
+        self.conn = conn
+        conn.metrics = self
+
+    def counters(self):
+        if self.conn is None:
+            return 0, 0, 0
+        return (self.conn.commands, self.conn.bytes_sent,
+                self.conn.bytes_received)
+
+    def totals(self, name):
+        if name not in self.phases:
+            self.phases[name] = dict.fromkeys(FIELDS, 0)
+        return self.phases[name]
+
+    def charge(self, entry, now, counters):
+        '''Charges what happened since entry was last charged to its
+        phase, and restarts its clock.'''
+        name, since, before = entry
+        totals = self.totals(name)
+        totals['seconds'] += now - since
+        totals['commands'] += counters[0] - before[0]
+        totals['bytes_sent'] += counters[1] - before[1]
+        totals['bytes_received'] += counters[2] - before[2]
+        entry[1], entry[2] = now, counters
+
+    @contextmanager
+    def phase(self, name):
+        '''Charges everything in the with block to the phase name,
+        except what is charged to phases nested in it.'''
+        now, counters = time.time(), self.counters()
+        if self.stack:
+            self.charge(self.stack[-1], now, counters)
+        entry = [name, now, counters]
+        self.stack.append(entry)
+        for observer in observers:
+            observer(self.account, name, 'start')
+        try:
+            yield
+        finally:
+            for observer in observers:
+                observer(self.account, name, 'end')
+            now, counters = time.time(), self.counters()
+            self.charge(entry, now, counters)
+            self.stack = [e for e in self.stack if e is not entry]
+            if self.stack:
+                self.stack[-1][1:] = [now, counters]
+
+    def count(self, name, messages):
+        self.totals(name)['messages'] += messages
+
+    def record(self, archived, error=None):
+        '''Returns the run so far as a dict, ready for append_json and
+        write_prometheus.'''
+        names = [n for n in PHASES if n in self.phases]
+        names += sorted(n for n in self.phases if n not in PHASES)
+        commands, sent, received = self.counters()
+        # Everything before COMPRESS went over the wire as is
+        wire_sent, wire_received = sent, received
+        deflate = getattr(self.conn, 'deflate', None)
+        if deflate is not None:
+            wire_sent += deflate.wire_sent - deflate.raw_sent
+            wire_received += deflate.wire_received - deflate.raw_received
+        limiter = getattr(self.conn, 'limiter', None)
+        return {
+            'time': int(time.time()),
+            'account': self.account,
+            'archived': archived,
+            'error': error,
+            'seconds': time.time() - self.started,
+            'commands': commands,
+            'bytes_sent': sent,
+            'bytes_received': received,
+            'wire_bytes_sent': wire_sent,
+            'wire_bytes_received': wire_received,
+            'throttled': limiter and limiter.throttles or 0,
+            'rate_limited_seconds': limiter and limiter.waited or 0.0,
+            'phases': [dict(self.phases[n], phase=n) for n in names],
+        }
+
+
+# What adds up over the connections of MergedMetrics
+SUMMED = ['commands', 'bytes_sent', 'bytes_received', 'wire_bytes_sent',
+          'wire_bytes_received']
+
+
+class MergedMetrics(object):
+    '''The Metrics of the connections of one run to account, recorded as
+    one.'''
+
+    def __init__(self, account):
+        self.account = account
+        self.started = time.time()
+        self.members = []
+
+    def add(self, metrics):
+        self.members.append(metrics)
+
+    def record(self, archived, error=None):
+        '''Metrics.record for all the connections together. The seconds
+        are those of the run, the throttles and waits those of the
+        connection that saw the most, they share their limiter.'''
+        merged = Metrics(self.account).record(archived, error)
+        merged['seconds'] = time.time() - self.started
+        # name -> {field: value}
+        phases = {}
+        for member in self.members:
+            record = member.record(archived)
+            for field in SUMMED:
+                merged[field] += record[field]
+            for field in ('throttled', 'rate_limited_seconds'):
+                merged[field] = max(merged[field], record[field])
+            for totals in record['phases']:
+                if totals['phase'] not in phases:
+                    phases[totals['phase']] = dict.fromkeys(FIELDS, 0)
+                for field in FIELDS:
+                    phases[totals['phase']][field] += totals[field]
+        names = [n for n in PHASES if n in phases]
+        names += sorted(n for n in phases if n not in PHASES)
+        merged['phases'] = [dict(phases[n], phase=n) for n in names]
+        return merged
+
+
+@contextmanager
+def _no_phase():
+    yield
+
+
+def phase(s, name):
+    '''Metrics.phase for the connection s.'''
+    metrics = getattr(s, 'metrics', None)
+    if metrics is None:
+        return _no_phase()
+    return metrics.phase(name)
+
+
+def count(s, name, messages):
+    '''Metrics.count for the connection s.'''
+    metrics = getattr(s, 'metrics', None)
+    if metrics is not None:
+        metrics.count(name, messages)
+
+
+def append_json(fn, records):
+    '''Appends records to fn, one JSON object per line.'''
+    with open(fn, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in sorted(labels.items()))
+
+
+PROMETHEUS_RUN = [
+    ('seconds', 'autoarchive_run_seconds', 'Wall time of the last run.'),
+    ('commands', 'autoarchive_run_commands',
+     'IMAP commands sent in the last run.'),
+    ('bytes_sent', 'autoarchive_run_bytes_sent',
+     'Bytes sent in the last run.'),
+    ('bytes_received', 'autoarchive_run_bytes_received',
+     'Bytes received in the last run.'),
+    ('wire_bytes_sent', 'autoarchive_run_wire_bytes_sent',
+     'Bytes sent in the last run after compression.'),
+    ('wire_bytes_received', 'autoarchive_run_wire_bytes_received',
+     'Bytes received in the last run before decompression.'),
+    ('throttled', 'autoarchive_run_throttled',
+     'Times the server throttled the account, over the retries of the '
+     'last run.'),
+    ('rate_limited_seconds', 'autoarchive_run_rate_limited_seconds',
+     'Seconds the last run waited for the rate limiter.'),
+    ('archived', 'autoarchive_archived_messages',
+     'Messages archived in the last run.'),
+    ('time', 'autoarchive_last_run_timestamp_seconds',
+     'When the last run finished.'),
+]
+
+
+def write_prometheus(fn, records):
+    '''Writes records to fn in the Prometheus text format, for the
+    textfile collector of node_exporter. The file is replaced
+    atomically so the collector never reads half of it.'''
+    lines = []
+    for key, metric, description in PROMETHEUS_RUN:
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s gauge' % metric)
+        for record in records:
+            lines.append('%s{%s} %s' % (
+                metric, _labels(account=record['account']), record[key]))
+    lines.append('# HELP autoarchive_run_failed 1 if the last run failed.')
+    lines.append('# TYPE autoarchive_run_failed gauge')
+    for record in records:
+        lines.append('autoarchive_run_failed{%s} %d' % (
+            _labels(account=record['account']), bool(record['error'])))
+
+    for field in FIELDS:
+        metric = 'autoarchive_phase_%s' % field
+        lines.append('# HELP %s %s per phase of the last run.' % (
+            metric, field.replace('_', ' ').capitalize()))
+        lines.append('# TYPE %s gauge' % metric)
+        for record in records:
+            for totals in record['phases']:
+                lines.append('%s{%s} %s' % (metric, _labels(
+                    account=record['account'], phase=totals['phase']),
+                    totals[field]))
+
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp_fn, fn)
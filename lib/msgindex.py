@@ -0,0 +1,287 @@
+'''
+Compact index of the labeled messages of a mailbox.
+
+A dict of uid strings to (age, date) tuples costs a couple of hundred
+bytes per message, hundreds of MB for a million. MessageIndex keeps the
+uids, age limits and dates in three parallel arrays sorted by uid
+instead, 16 bytes per message, and finds the old messages with a scan
+that runs in C: one cutoff date per distinct age limit, then
+itertools.compress over the columns.
+
+Removed messages are only marked as such, the arrays are compacted
+once they make up half of them, or when the index is saved.
+
+In thread mode a fourth column holds the X-GM-THRID of every message.
+The messages of a thread then share one date, and old() returns whole
+threads. X-GM-THRIDs are 64 bit, which array 'L' only is on LP64 builds;
+elsewhere ThreadColumn keeps them as two 'I' arrays.
+'''
+
+from array import array
+from bisect import bisect_left
+from itertools import compress, count, imap, izip, repeat
+from operator import and_, lt, ne
+import base64
+import sys
+
+from lib.labelrules import MAX_AGE
+
+# Age of a removed message
+REMOVED = -1
+
+# Whether array 'L' holds 64 bit X-GM-THRIDs. It is 32 bit on Windows
+# and other non-LP64 builds, where ThreadColumn is used instead.
+THRID_TYPECODE = 'L'
+WIDE_LONG = array(THRID_TYPECODE).itemsize >= 8
+
+
+class ThreadColumn(object):
+    '''Column of 64 bit X-GM-THRIDs for builds whose array 'L' is 32 bit:
+    the high and the low words in two 'I' arrays. Its bytes are those of
+    a 64 bit array in the native byte order, so caches don't depend on
+    which one wrote them.'''
+
+    itemsize = 8
+
+    def __init__(self, thrids=()):
+        self.high = array('I')
+        self.low = array('I')
+        for thrid in thrids:
+            self.append(thrid)
+
+    def __len__(self):
+        return len(self.low)
+
+    def __getitem__(self, pos):
+        return self.high[pos] << 32 | self.low[pos]
+
+    def __setitem__(self, pos, thrid):
+        self.high[pos] = thrid >> 32
+        self.low[pos] = thrid & 0xffffffff
+
+    def __iter__(self):
+        return (high << 32 | low for high, low in izip(self.high, self.low))
+
+    def append(self, thrid):
+        self.high.append(thrid >> 32)
+        self.low.append(thrid & 0xffffffff)
+
+    def insert(self, pos, thrid):
+        self.high.insert(pos, thrid >> 32)
+        self.low.insert(pos, thrid & 0xffffffff)
+
+    def words(self):
+        '''Returns the (first, second) word arrays of each thrid in
+        memory order.'''
+        if sys.byteorder == 'little':
+            return self.low, self.high
+        return self.high, self.low
+
+    def tostring(self):
+        words = array('I', [0]) * (2 * len(self))
+        words[0::2], words[1::2] = self.words()
+        return words.tostring()
+
+    def fromstring(self, data):
+        if len(data) % self.itemsize:
+            raise ValueError('string length not a multiple of item size')
+        words = array('I')
+        words.fromstring(data)
+        first, second = self.words()
+        first.extend(words[0::2])
+        second.extend(words[1::2])
+
+    def byteswap(self):
+        '''Swaps the bytes of every thrid: those of the words and the
+        words themselves.'''
+        self.high.byteswap()
+        self.low.byteswap()
+        self.high, self.low = self.low, self.high
+
+
+def thread_column(thrids=()):
+    '''Returns a column of the 64 bit X-GM-THRIDs thrids.'''
+    if WIDE_LONG:
+        return array(THRID_TYPECODE, thrids)
+    return ThreadColumn(thrids)
+
+
+class MessageIndex(object):
+    '''uid -> (age in seconds, date in seconds since the epoch) for the
+    labeled messages of one mailbox. uids are passed and returned as
+    strs, like everywhere else, but stored as ints. With threaded, the
+    thread of every message is kept too.'''
+
+    def __init__(self, items=(), threaded=False):
+        self.uids = array('I')
+        self.ages = array('i')
+        self.dates = array('d')
+        # X-GM-THRID per message, None unless threaded
+        self.thrids = None
+        if threaded:
+            self.thrids = thread_column()
+        self.removed = 0
+        for uid, (age, date) in sorted(items, key=lambda item: int(item[0])):
+            self.add(uid, age, date)
+
+    def find(self, uid):
+        '''Returns the position of uid in the columns, or None.'''
+        pos = bisect_left(self.uids, uid)
+        if pos < len(self.uids) and self.uids[pos] == uid \
+                and self.ages[pos] != REMOVED:
+            return pos
+        return None
+
+    def __len__(self):
+        return len(self.uids) - self.removed
+
+    def __contains__(self, uid):
+        return self.find(int(uid)) is not None
+
+    def __getitem__(self, uid):
+        pos = self.find(int(uid))
+        if pos is None:
+            raise KeyError(uid)
+        return self.ages[pos], self.dates[pos]
+
+    def __iter__(self):
+        return (str(uid) for uid in compress(
+            self.uids, (age != REMOVED for age in self.ages)))
+
+    def items(self):
+        '''Returns a list of (uid, (age, date)) tuples.'''
+        return [(str(uid), (age, date)) for uid, age, date
+                in zip(self.uids, self.ages, self.dates) if age != REMOVED]
+
+    def add(self, uid, age, date, thrid=None):
+        '''Adds or updates uid. thrid is its thread in thread mode, an
+        update without one keeps the thread it had.'''
+        uid = int(uid)
+        # New messages have the highest uids, so this is the usual case
+        if not self.uids or uid > self.uids[-1]:
+            self.uids.append(uid)
+            self.ages.append(age)
+            self.dates.append(date)
+            if self.thrids is not None:
+                self.thrids.append(thrid or 0)
+            return
+
+        pos = bisect_left(self.uids, uid)
+        if pos < len(self.uids) and self.uids[pos] == uid:
+            if self.ages[pos] == REMOVED:
+                self.removed -= 1
+            self.ages[pos] = age
+            self.dates[pos] = date
+            if self.thrids is not None and thrid is not None:
+                self.thrids[pos] = thrid
+        else:
+            self.uids.insert(pos, uid)
+            self.ages.insert(pos, age)
+            self.dates.insert(pos, date)
+            if self.thrids is not None:
+                self.thrids.insert(pos, thrid or 0)
+
+    def remove(self, uid):
+        pos = self.find(int(uid))
+        if pos is None:
+            return
+        self.ages[pos] = REMOVED
+        self.removed += 1
+        if self.removed > len(self.uids) / 2:
+            self.compact()
+
+    def compact(self):
+        '''Drops the removed messages from the columns.'''
+        if not self.removed:
+            return
+        live = [age != REMOVED for age in self.ages]
+        self.uids = array('I', compress(self.uids, live))
+        self.ages = array('i', compress(self.ages, live))
+        self.dates = array('d', compress(self.dates, live))
+        if self.thrids is not None:
+            self.thrids = thread_column(compress(self.thrids, live))
+        self.removed = 0
+
+    def thread_positions(self, thrids):
+        '''Returns the positions of the messages of the threads in the
+        set thrids.'''
+        return [pos for pos in compress(count(),
+                                        imap(thrids.__contains__,
+                                             self.thrids))
+                if self.ages[pos] != REMOVED]
+
+    def thread_dates(self, thrids):
+        '''Returns a dict thrid -> date for those of the set thrids
+        that have messages in the index.'''
+        return dict((self.thrids[pos], self.dates[pos])
+                    for pos in self.thread_positions(thrids))
+
+    def set_thread_dates(self, dates):
+        '''Gives all the messages of the threads in the dict dates,
+        thrid -> date, the date of their thread.'''
+        for pos in self.thread_positions(dates):
+            self.dates[pos] = dates[self.thrids[pos]]
+
+    def old(self, now):
+        '''Returns the uids of the messages older than their age limit
+        at now, in uid order. In thread mode, those of every thread
+        with such a message.'''
+        cutoffs = dict((age, now - age) for age in set(self.ages))
+        # Never old
+        cutoffs[REMOVED] = float('-inf')
+        old = imap(lt, self.dates, imap(cutoffs.__getitem__, self.ages))
+        if self.thrids is not None:
+            threads = set(compress(self.thrids, old))
+            old = imap(and_, imap(threads.__contains__, self.thrids),
+                       imap(ne, self.ages, repeat(REMOVED)))
+        return [str(uid) for uid in compress(self.uids, old)]
+
+    def to_dict(self):
+        '''Returns the index as a dict that json can write, the columns
+        as base64 of their bytes.'''
+        self.compact()
+        data = {
+            'byteorder': sys.byteorder,
+            'uids': base64.b64encode(self.uids.tostring()),
+            'ages': base64.b64encode(self.ages.tostring()),
+            'dates': base64.b64encode(self.dates.tostring()),
+        }
+        if self.thrids is not None:
+            data['thrids'] = base64.b64encode(self.thrids.tostring())
+            data['thrid_itemsize'] = self.thrids.itemsize
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Returns the MessageIndex to_dict returned data for. Raises
+        ValueError if the columns don't line up.'''
+        index = cls(threaded='thrids' in data)
+        if index.thrids is not None:
+            # Caches without it were written with array 'L'
+            itemsize = data.get('thrid_itemsize',
+                                array(THRID_TYPECODE).itemsize)
+            if itemsize != index.thrids.itemsize:
+                raise ValueError('Thread ids of %s bytes' % itemsize)
+        names = ['uids', 'ages', 'dates']
+        if index.thrids is not None:
+            names.append('thrids')
+        for name in names:
+            column = getattr(index, name)
+            try:
+                column.fromstring(base64.b64decode(data[name]))
+            except (KeyError, TypeError, ValueError), e:
+                raise ValueError('Bad %s column: %s' % (name, e))
+            if data.get('byteorder', sys.byteorder) != sys.byteorder:
+                column.byteswap()
+        if not len(index.uids) == len(index.ages) == len(index.dates) \
+                == len(index.thrids if index.thrids is not None
+                       else index.uids):
+            raise ValueError('Columns of different lengths')
+        return index
+
+    def scale_ages(self, factor):
+        '''Multiplies every age by factor, e.g. to turn days into
+        seconds, up to MAX_AGE.'''
+        self.ages = array('i', (age if age == REMOVED
+                                else min(age * factor, MAX_AGE)
+                                for age in self.ages))
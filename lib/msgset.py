@@ -0,0 +1,122 @@
+'''
+Helpers for sending large message sets to the server.
+
+Joining every id with ',' produces command lines that grow without
+bound and responses that imaplib has to buffer in full. Instead ids
+are collapsed into ranges, e.g. '1:4,7,9:12', and split into batches
+whose command stays below MAX_SET_BYTES. The number of ids per batch
+follows the observed response time, growing while the server answers
+quickly and shrinking when it slows down.
+'''
+
+import time
+
+# Upper bound on the length of an encoded message set. Servers limit
+# the length of a command line, gmail at around 10k bytes.
+MAX_SET_BYTES = 8000
+
+# Bounds and starting point for the number of ids per batch
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 20000
+INITIAL_BATCH_SIZE = 1000
+
+# Response time in seconds we aim for per batch
+TARGET_SECONDS = 2.0
+
+
+def encode_message_set(msg_ids):
+    '''Takes a list of message ids (ints or strs) and returns an IMAP
+    message set with contiguous ids collapsed into ranges.'''
+    return encode_sorted(sorted(int(msg_id) for msg_id in msg_ids))
+
+
+def encode_sorted(ids):
+    '''Same as encode_message_set but expects a sorted list of ints.'''
+    if not ids:
+        return ''
+    ranges = []
+    start = prev = ids[0]
+    for msg_id in ids[1:]:
+        if msg_id == prev:
+            continue
+        if msg_id != prev + 1:
+            ranges.append((start, prev))
+            start = msg_id
+        prev = msg_id
+    ranges.append((start, prev))
+    return ','.join(str(lo) if lo == hi else '%d:%d' % (lo, hi)
+                    for lo, hi in ranges)
+
+
+def decode_message_set(msg_set):
+    '''Returns the list of ids, as ints, in a message set such as
+    encode_message_set returns. Ranges are expanded in full, so only
+    use it on sets made from the ids themselves, not ones like 1:*.'''
+    ids = []
+    for part in msg_set.split(','):
+        lo, _, hi = part.partition(':')
+        ids.extend(xrange(int(lo), int(hi or lo) + 1))
+    return ids
+
+
+class AdaptiveBatchSize(object):
+    '''Keeps track of how many ids to send per batch. Call record()
+    with the number of ids and the elapsed time of every batch.'''
+
+    def __init__(self, size=INITIAL_BATCH_SIZE, target=TARGET_SECONDS,
+                 min_size=MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE):
+        self.size = size
+        self.target = target
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def record(self, count, elapsed):
+        # Only a full batch tells us anything about the current size
+        if count < self.size:
+            return
+        if elapsed < self.target / 2:
+            self.size = min(self.size * 2, self.max_size)
+        elif elapsed > self.target:
+            self.size = max(self.size / 2, self.min_size)
+
+
+def message_sets(msg_ids, batch_size=None, max_bytes=MAX_SET_BYTES):
+    '''Yields encoded message sets covering msg_ids. The time spent by
+    the caller between two items is taken as the response time of the
+    batch and fed to batch_size, an AdaptiveBatchSize.'''
+    if batch_size is None:
+        batch_size = AdaptiveBatchSize()
+    ids = sorted(int(msg_id) for msg_id in msg_ids)
+
+    pos = 0
+    while pos < len(ids):
+        msg_set, end = take_set(ids, pos, batch_size.size, max_bytes)
+        start = time.time()
+        yield msg_set
+        batch_size.record(end - pos, time.time() - start)
+        pos = end
+
+
+def take_set(ids, pos, size, max_bytes):
+    '''Encodes up to size ids from the sorted list ids, starting at
+    pos, without going over max_bytes. Returns a tuple (message set,
+    position of the first id left out).'''
+    end = min(pos + size, len(ids))
+    parts = []
+    length = -1
+    start = prev = ids[pos]
+    i = pos + 1
+    while i < end:
+        msg_id = ids[i]
+        if msg_id > prev + 1:
+            part = str(start) if start == prev else '%d:%d' % (start, prev)
+            # leave room for the last range, at most two more numbers
+            if length + len(part) + 1 + 2 * len(str(msg_id)) + 2 > max_bytes:
+                break
+            parts.append(part)
+            length += len(part) + 1
+            start = msg_id
+        prev = msg_id
+        i += 1
+    parts.append(str(start) if start == prev else '%d:%d' % (start, prev))
+    return ','.join(parts), i
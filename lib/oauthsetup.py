@@ -0,0 +1,38 @@
+'''
+Setting up the oauth identity of an account: asking gmail for a token
+and secret and saving them for the later runs. Only needed once, so
+lib.autoarchive imports it when it finds no identity.
+'''
+
+from lib import xoauth
+
+
+def write_oauth_identity(fn, oauth_entity):
+    with open(fn, 'w') as f:
+        f.write('%s\n%s' % (oauth_entity.key, oauth_entity.secret))
+
+def generate_new_oauth_entity(user, fn):
+    '''Generates a new oauth token/secret for a given user. The new
+    pair is written to the given fn. '''
+    scope = 'https://mail.google.com/'
+    consumer = xoauth.OAuthEntity('anonymous', 'anonymous')
+    google_accounts_url_generator = xoauth.GoogleAccountsUrlGenerator(user)
+    request_token = xoauth.GenerateRequestToken(consumer, scope, None, None, google_accounts_url_generator)
+
+    # Wait for user to visit URL and authenticate this application.  After
+    # authenticating this application, they must paste the verification code.
+    oauth_verifier = raw_input('Enter verification code: ').strip()
+
+    # Get the token and token secret to be saved and used going forward for
+    # authentiaction
+    access_token = xoauth.GetAccessToken(consumer, request_token, oauth_verifier,
+                          google_accounts_url_generator)
+
+    if not access_token:
+        print 'There was a problem getting a valid access token.'
+        return None
+
+    # Save the credentials for the future.
+    write_oauth_identity(fn, access_token)
+
+    return access_token
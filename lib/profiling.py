@@ -0,0 +1,214 @@
+'''
+Profiling of whole runs, for --profile and --trace-memory.
+
+Profiler runs cProfile in every thread, the one that starts it and
+every thread started after, e.g. the workers of --accounts, and merges
+their stats into one pstats file. A second thread samples the stacks
+of all the others every SAMPLE_SECONDS and counts them in the collapsed
+format flamegraph.pl, speedscope and the like read: one line per
+distinct stack, 'outermost;...;innermost count'. The samples are of
+wall time, so a run waiting on the server shows up in socket reads,
+where cProfile spreads it over the callers.
+
+Python 2 has no tracemalloc. MemoryTracer makes do with what the
+interpreter tells: at every phase boundary (see lib.metrics) it takes
+the resident memory of the process and the number and size of the
+objects the garbage collector tracks, per type, and charges the growth
+since the previous boundary to the innermost phase open for that
+account. Objects gc doesn't track, strs and numbers, only show in the
+resident memory. With several accounts at once, the phases of the
+others run in between and get mixed in.
+'''
+
+from collections import defaultdict
+import cProfile
+import gc
+import os
+import pstats
+import sys
+import threading
+import time
+
+# How often the stacks are sampled
+SAMPLE_SECONDS = 0.005
+
+# How many functions and types the reports list
+PROFILE_TOP = 25
+TRACE_TOP = 5
+
+# Where growth between boundaries outside any phase is charged
+NO_PHASE = '(no phase)'
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class Profiler(object):
+    '''cProfile and stack samples of every thread between start() and
+    stop().'''
+
+    def __init__(self, interval=SAMPLE_SECONDS):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.profiles = []
+        # 'outermost;...;innermost' -> samples
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        threading.setprofile(self.start_thread)
+        self.add_profile()
+        self.sampler = threading.Thread(target=self.sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def add_profile(self):
+        '''Profiles the calling thread.'''
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start_thread(self, frame, event, arg):
+        '''threading's profile function, called in every new thread:
+        replaces itself with a cProfile.Profile of the thread.'''
+        sys.setprofile(None)
+        if not self.stopped.is_set() \
+                and threading.current_thread() is not self.sampler:
+            self.add_profile()
+
+    def sample(self):
+        own = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        '''Stops profiling. Threads still running keep their profiler
+        until they end, what they do from now on is left out.'''
+        self.stopped.set()
+        threading.setprofile(None)
+        with self.lock:
+            # This thread's, disabling the others' would turn profiling
+            # off for this thread again
+            self.profiles[0].disable()
+        self.sampler.join()
+
+    def stats(self):
+        '''Returns the pstats.Stats of all the threads.'''
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            # create_stats() disables the calling thread's profiler,
+            # which is off by now
+            profile.create_stats()
+            stats.add(profile)
+        return stats
+
+    def dump(self, fn):
+        '''Writes the pstats of the run to fn and its stack samples to
+        fn.collapsed, and prints the PROFILE_TOP functions that took the
+        most time, their callees included.'''
+        stats = self.stats()
+        stats.dump_stats(fn)
+        with open(fn + '.collapsed', 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+        print
+        print 'Profile of %d threads written to %s, %d stack samples ' \
+            'to %s.collapsed.' % (len(self.profiles), fn, self.samples, fn)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+
+def resident_kb():
+    '''Returns the resident memory of the process in kB, or 0 where
+    /proc isn't there.'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+
+def object_sizes():
+    '''Returns a dict type name -> [objects, bytes] of the objects the
+    garbage collector tracks.'''
+    sizes = defaultdict(lambda: [0, 0])
+    for obj in gc.get_objects():
+        entry = sizes[type(obj).__name__]
+        entry[0] += 1
+        entry[1] += sys.getsizeof(obj, 0)
+    return sizes
+
+
+class MemoryTracer(object):
+    '''Memory growth per phase, see the module docstring. An instance is
+    a lib.metrics phase observer.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rss = resident_kb()
+        self.peak = self.rss
+        self.sizes = object_sizes()
+        # account -> names of its open phases, innermost last
+        self.open = defaultdict(list)
+        # phase -> [boundaries, kB resident, {type: [objects, bytes]}]
+        self.phases = defaultdict(lambda: [0, 0, defaultdict(
+            lambda: [0, 0])])
+        self.seconds = 0.0
+
+    def __call__(self, account, name, event):
+        with self.lock:
+            start = time.time()
+            rss, sizes = resident_kb(), object_sizes()
+            stack = self.open[account]
+            charged = self.phases[stack and stack[-1] or NO_PHASE]
+            charged[0] += 1
+            charged[1] += rss - self.rss
+            for type_name, (objects, size) in sizes.iteritems():
+                before = self.sizes.get(type_name, (0, 0))
+                growth = charged[2][type_name]
+                growth[0] += objects - before[0]
+                growth[1] += size - before[1]
+            for type_name, before in self.sizes.iteritems():
+                if type_name not in sizes:
+                    charged[2][type_name][0] -= before[0]
+                    charged[2][type_name][1] -= before[1]
+            if event == 'start':
+                stack.append(name)
+            elif name in stack:
+                del stack[len(stack) - 1 - stack[::-1].index(name)]
+            self.rss, self.sizes = rss, sizes
+            self.peak = max(self.peak, rss)
+            self.seconds += time.time() - start
+
+    def report(self):
+        '''Prints the growth charged to every phase and the TRACE_TOP
+        types that grew most in it.'''
+        print
+        print 'Memory per phase, peak %d kB resident (tracing took ' \
+            '%.1fs):' % (self.peak, self.seconds)
+        for name, (boundaries, rss, types) in sorted(
+                self.phases.items(), key=lambda item: -item[1][1]):
+            grown = sorted(types.items(), key=lambda item: -item[1][1])
+            print '  %-28s %+8d kB resident over %d boundaries' % (
+                name, rss, boundaries)
+            for type_name, (objects, size) in grown[:TRACE_TOP]:
+                if size <= 0:
+                    break
+                print '    %-26s %+9d objects %+10d bytes' % (
+                    type_name, objects, size)
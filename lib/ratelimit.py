@@ -0,0 +1,292 @@
+'''
+Rate limiting for imaplib connections.
+
+Gmail throttles accounts that ask too much of it: commands fail with
+NO [THROTTLED] and, if the client keeps going, the connection is closed
+with BYE [OVERQUOTA]. Going flat out and getting cut off ends up slower
+than staying just under the limit.
+
+A connection of a limited() class passes every command and every byte
+through its Limiter: token buckets for commands and bytes per second,
+one pair per account and optionally one shared by all the accounts of
+a run. Buckets refill at a steady rate. A command waits for a token,
+bytes are paid for as they are sent or received and may leave the
+bucket in debt, which the next command waits out.
+
+The per account rates adapt the way TCP's congestion window does: they
+are halved whenever the server throttles the account or drops the
+connection, then raised by RECOVERY of their original value every
+RECOVERY_SECONDS, up to the configured rate. Without a configured rate,
+the first throttling sets one from the rate measured so far. So does
+the number of pipelined commands in flight, see Limiter.window(): the
+bytes of responses already on their way can't be waited for.
+'''
+
+import socket
+import threading
+import time
+
+# Response codes gmail throttles with
+THROTTLE_CODES = ('[THROTTLED]', '[OVERQUOTA]')
+
+# How many seconds worth of tokens a bucket holds when full
+BURST_SECONDS = 1.0
+
+# Rates are measured over windows of this many seconds
+WINDOW_SECONDS = 5.0
+
+# When throttled, rates are multiplied by BACKOFF and nothing is sent
+# for HOLD_SECONDS, further throttling within that time is ignored
+BACKOFF = 0.5
+HOLD_SECONDS = 1.0
+
+# Then they grow back by RECOVERY of their rate before the first
+# throttling every RECOVERY_SECONDS
+RECOVERY = 0.1
+RECOVERY_SECONDS = 5.0
+
+# Rates never go below these
+MIN_COMMANDS_PER_SECOND = 0.5
+MIN_BYTES_PER_SECOND = 16 * 1024
+
+# How many times a throttled plain imaplib command is sent again
+THROTTLED_RETRIES = 5
+
+
+class TokenBucket(object):
+    '''Holds up to burst tokens and gains rate of them per second. rate
+    0 means unlimited, tokens are then only counted. Thread safe.'''
+
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.updated = time.time()
+        # Tokens taken in the current window and the rate of the last
+        self.window_start = self.updated
+        self.window_taken = 0
+        self.last_rate = 0.0
+        self.rate = self.tokens = 0
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now - self.window_start >= WINDOW_SECONDS:
+            self.last_rate = self.window_taken / (now - self.window_start)
+            self.window_start = now
+            self.window_taken = 0
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self._refill(time.time())
+            self.rate = rate
+            self.burst = burst or max(rate * BURST_SECONDS, 1)
+            self.tokens = min(self.tokens, self.burst)
+
+    def take(self, count=1):
+        '''Takes count tokens, going into debt if there aren't enough.
+        Returns how many seconds it takes to pay off the debt, 0 if
+        there is none.'''
+        with self.lock:
+            self._refill(time.time())
+            self.window_taken += count
+            if not self.rate:
+                return 0
+            self.tokens -= count
+            return max(0, -self.tokens / self.rate)
+
+    def try_take(self, count=1):
+        '''Takes count tokens and returns True if there are that many,
+        otherwise returns False.'''
+        with self.lock:
+            self._refill(time.time())
+            if self.rate and self.tokens < count:
+                return False
+            if self.rate:
+                self.tokens -= count
+            self.window_taken += count
+            return True
+
+    def hold(self, seconds):
+        '''Empties the bucket so that nothing can be taken for
+        seconds.'''
+        with self.lock:
+            self._refill(time.time())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def measured(self):
+        '''Returns how many tokens per second were taken lately.'''
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            elapsed = now - self.window_start
+            current = elapsed >= 1 and self.window_taken / elapsed or 0
+            return max(self.last_rate, current)
+
+
+class Limiter(object):
+    '''The budget of one account: commands and bytes per second, 0 for
+    unlimited. shared is a Limiter for all accounts, which is charged
+    too but doesn't adapt. throttles counts the times the server
+    throttled the account, waited the seconds spent waiting.'''
+
+    def __init__(self, commands=0, bytes=0, shared=None):
+        self.commands = TokenBucket(commands)
+        self.bytes = TokenBucket(bytes)
+        self.shared = shared
+        self.lock = threading.Lock()
+        # bucket -> (configured rate, minimum rate)
+        self.limits = {self.commands: (commands, MIN_COMMANDS_PER_SECOND),
+                       self.bytes: (bytes, MIN_BYTES_PER_SECOND)}
+        # bucket -> rate added every RECOVERY_SECONDS, once throttled
+        self.steps = {}
+        self.throttled_at = None
+        self.recovered_at = None
+        # Most commands in flight once throttled, and the most asked for
+        self.max_window = None
+        self.depth = 1
+        self.throttles = 0
+        self.waited = 0.0
+
+    def command(self):
+        '''Waits until one more command may be sent.'''
+        self.recover()
+        wait = max(self.commands.take(1), self.bytes.take(0))
+        if self.shared:
+            wait = max(wait, self.shared.commands.take(1),
+                       self.shared.bytes.take(0))
+        if wait > 0:
+            self.waited += wait
+            time.sleep(wait)
+
+    def window(self, depth):
+        '''Returns how many of depth pipelined commands may be in
+        flight.'''
+        self.depth = max(self.depth, depth)
+        if self.max_window is None:
+            return depth
+        return min(depth, self.max_window)
+
+    def transferred(self, count):
+        '''Charges count bytes sent or received.'''
+        self.bytes.take(count)
+        if self.shared:
+            self.shared.bytes.take(count)
+
+    def response(self, line):
+        '''Looks for throttling in the response line.'''
+        if '[' in line and any(code in line for code in THROTTLE_CODES):
+            self.throttled()
+
+    def throttled(self):
+        '''Backs off: halves the rates and holds everything for
+        HOLD_SECONDS.'''
+        with self.lock:
+            now = time.time()
+            if self.throttled_at and now - self.throttled_at < HOLD_SECONDS:
+                return
+            self.throttles += 1
+            self.throttled_at = self.recovered_at = now
+            self.max_window = max(1, int((self.max_window or self.depth)
+                                         * BACKOFF))
+            for bucket, (configured, minimum) in self.limits.items():
+                rate = bucket.rate or bucket.measured()
+                if bucket not in self.steps:
+                    self.steps[bucket] = max(configured or rate,
+                                             minimum) * RECOVERY
+                bucket.set_rate(max(rate * BACKOFF, minimum))
+                bucket.hold(HOLD_SECONDS)
+
+    def recover(self):
+        '''Raises the rates back up after throttling, see RECOVERY.'''
+        with self.lock:
+            if self.throttled_at is None:
+                return
+            steps = int((time.time() - self.recovered_at) / RECOVERY_SECONDS)
+            if steps <= 0:
+                return
+            self.recovered_at += steps * RECOVERY_SECONDS
+            self.max_window += steps
+            for bucket, (configured, _) in self.limits.items():
+                rate = bucket.rate + steps * self.steps[bucket]
+                if configured:
+                    rate = min(rate, configured)
+                bucket.set_rate(rate)
+
+
+def is_throttled(e):
+    '''Returns True if the exception e is the server throttling.'''
+    return any(code in str(e) for code in THROTTLE_CODES)
+
+
+_limited_classes = {}
+
+
+def limited(imap_class):
+    '''Returns a subclass of imap_class (imaplib.IMAP4 or IMAP4_SSL)
+    whose commands and bytes go through the Limiter set as its limiter
+    attribute, if any. Plain imaplib commands that are throttled are
+    sent again, up to THROTTLED_RETRIES times, and then raise
+    imap_class.error rather than return 'NO'.'''
+    if imap_class in _limited_classes:
+        return _limited_classes[imap_class]
+
+    # imaplib's classes are old style, so no super()
+    class LimitedIMAP4(imap_class):
+        limiter = None
+
+        def _new_tag(self):
+            if self.limiter:
+                self.limiter.command()
+            return imap_class._new_tag(self)
+
+        def _simple_command(self, name, *args):
+            retries = 0
+            while True:
+                try:
+                    typ, data = imap_class._simple_command(self, name, *args)
+                except self.abort:
+                    raise
+                except self.error, e:
+                    if not self.limiter or not is_throttled(e) \
+                            or retries >= THROTTLED_RETRIES:
+                        raise
+                else:
+                    # Callers rarely look at the status, a throttled
+                    # command must not pass for one that found nothing
+                    if typ != 'NO' or not is_throttled(data):
+                        return typ, data
+                    if not self.limiter or retries >= THROTTLED_RETRIES:
+                        raise self.error('%s failed: %s' % (name, data))
+                retries += 1
+
+        def send(self, data):
+            if self.limiter:
+                self.limiter.transferred(len(data))
+            imap_class.send(self, data)
+
+        def read(self, size):
+            data = imap_class.read(self, size)
+            if self.limiter:
+                self.limiter.transferred(len(data))
+            return data
+
+        def readline(self):
+            if not self.limiter:
+                return imap_class.readline(self)
+            try:
+                line = imap_class.readline(self)
+            except socket.error:
+                self.limiter.throttled()
+                raise
+            if not line:
+                self.limiter.throttled()
+            self.limiter.transferred(len(line))
+            self.limiter.response(line)
+            return line
+
+    LimitedIMAP4.__name__ = 'Limited' + imap_class.__name__
+    _limited_classes[imap_class] = LimitedIMAP4
+    return LimitedIMAP4
@@ -0,0 +1,121 @@
+'''
+Persistent local state for the auto-archiver.
+
+Between runs we remember, per message UID, the age limit of the aa:
+label it carried (in seconds) and the parsed Date header (as seconds
+since the epoch), along with the highest UID seen so far. On the next run only
+UIDs above that mark need their headers fetched. They are kept in a
+lib.msgindex.MessageIndex, written as base64 columns.
+
+With CONDSTORE we also keep the HIGHESTMODSEQ of the mailbox and the
+aa: labels it had: while the mailbox reports the same HIGHESTMODSEQ
+nothing in it changed, and otherwise the server can list the messages
+changed since.
+
+In thread mode the X-GM-THRID of every message is kept as well, and
+its date is that of its thread.
+
+UIDs are only meaningful for a given UIDVALIDITY, so the whole cache
+is thrown away whenever the server reports a different value, or when
+the thread mode changed.
+
+Caches written before ages could be in hours kept them in days, they
+are converted when loaded.
+'''
+
+import json
+import os
+
+from lib.labelrules import DAY, MAX_AGE
+from lib.msgindex import MessageIndex
+
+# Seconds per unit of the ages saved, caches without one are in days
+AGE_UNIT = 1
+
+
+class MessageState(object):
+    '''What we know about the labeled messages of one mailbox.'''
+
+    def __init__(self, uidvalidity, last_uid=0, messages=None,
+                 highest_modseq=0, label_ages=None, threads=None):
+        self.uidvalidity = uidvalidity
+        self.last_uid = last_uid
+        # 'newest' or 'oldest': messages are dated by the newest or
+        # oldest message of their thread. None to date them one by one.
+        self.threads = threads
+        # uid -> (age_in_seconds, date_in_epoch_seconds), a MessageIndex
+        if messages is None:
+            messages = MessageIndex(threaded=threads is not None)
+        self.messages = messages
+        # As of the last sync, 0 without CONDSTORE
+        self.highest_modseq = highest_modseq
+        # [(label, age_in_seconds), ...] as of the last sync, None if
+        # unknown
+        self.label_ages = label_ages
+
+    def add(self, uid, age, date, thrid=None):
+        self.messages.add(uid, age, date, thrid)
+        self.last_uid = max(self.last_uid, int(uid))
+
+    def remove(self, uid):
+        self.messages.remove(uid)
+
+    def to_dict(self):
+        return {
+            'uidvalidity': self.uidvalidity,
+            'last_uid': self.last_uid,
+            'index': self.messages.to_dict(),
+            'highest_modseq': self.highest_modseq,
+            'label_ages': self.label_ages,
+            'threads': self.threads,
+            'age_unit': AGE_UNIT,
+        }
+
+
+def load_state(fn, uidvalidity, threads=None):
+    '''Returns the MessageState saved at fn. If the file is missing,
+    unreadable or was written for a different uidvalidity or thread
+    mode, an empty MessageState is returned instead.'''
+    try:
+        with open(fn) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return MessageState(uidvalidity, threads=threads)
+
+    if data.get('uidvalidity') != uidvalidity:
+        print 'UIDVALIDITY changed, discarding cached state.'
+        return MessageState(uidvalidity, threads=threads)
+    if data.get('threads') != threads:
+        print 'Thread mode changed, discarding cached state.'
+        return MessageState(uidvalidity, threads=threads)
+
+    try:
+        if 'index' in data:
+            messages = MessageIndex.from_dict(data['index'])
+        else:
+            # Written before MessageIndex
+            messages = MessageIndex((uid, tuple(v)) for uid, v
+                                    in data.get('messages', {}).items())
+        if (messages.thrids is None) != (threads is None):
+            raise ValueError('Thread column does not match the mode')
+        unit = int(data.get('age_unit', DAY))
+    except ValueError, e:
+        print 'Unreadable cached state (%s), discarding it.' % e
+        return MessageState(uidvalidity, threads=threads)
+    if unit != AGE_UNIT:
+        messages.scale_ages(unit / AGE_UNIT)
+    label_ages = data.get('label_ages')
+    if label_ages is not None:
+        label_ages = [(str(label), min(age * unit / AGE_UNIT, MAX_AGE))
+                      for label, age in label_ages]
+    return MessageState(uidvalidity, data.get('last_uid', 0), messages,
+                        data.get('highest_modseq', 0), label_ages, threads)
+
+
+def save_state(fn, state):
+    '''Writes state to fn. The file is replaced atomically so an
+    interrupted run never leaves a truncated cache behind.'''
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        json.dump(state.to_dict(), f)
+    os.rename(tmp_fn, fn)
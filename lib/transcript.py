@@ -0,0 +1,405 @@
+'''
+Recording and replay of IMAP sessions.
+
+A connection of a recording() class given a Recorder writes everything
+it sends and receives to a transcript file, as imaplib sees it, i.e.
+before compression. Every connection appends one session: a line
+{"session": "<host>:<port>", "start": <seconds since the epoch>} and
+then one line per send or receive, {"t": <seconds since the start>,
+"send": <data>} or {"t": ..., "recv": <data>}. Data is decoded as
+latin-1 so that any byte survives JSON.
+
+Credentials are redacted: the arguments of LOGIN and whatever the
+client sends in answer to the continuation requests of AUTHENTICATE
+are replaced by REDACTED. Transcripts still hold the labels and
+headers of the messages fetched, treat them like the mailbox.
+
+A Replay plays the sessions of a transcript back to ReplayIMAP4
+connections, one session per connection in the order they were
+recorded, without a server. Commands are matched by their text, tags
+aside, and get the responses recorded for them. Batch sizes depend on
+timing, so a UID FETCH or STORE of a message set that wasn't recorded
+is answered with the responses recorded for each of its messages
+instead. Anything else the session doesn't have fails with BAD. Replays
+run at full speed, or timed, each response taking as long as it took
+when recorded.
+'''
+
+from collections import deque
+import imaplib
+import json
+import re
+import threading
+import time
+
+from lib.imapstream import LITERAL_RE
+from lib.msgset import decode_message_set
+
+# What credentials are replaced with
+REDACTED = 'REDACTED'
+
+# A command line sent by imaplib, whose tags are letters then a number
+COMMAND_RE = re.compile(r'([A-P]+\d+) (.*)$', re.S)
+CREDENTIALS_RE = re.compile(r'(LOGIN|AUTHENTICATE)\b', re.I)
+# UID FETCH/STORE <message set> <the rest>
+MESSAGES_RE = re.compile(r'UID (FETCH|STORE) (\S+) (.*)$', re.I)
+UID_RE = re.compile(r'\bUID (\d+)')
+
+
+class Recorder(object):
+    '''Appends the sessions of the connections it is given to the
+    transcript fn.'''
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def imap_class(self, imap_class):
+        return recording(imap_class)
+
+    def session(self, host, port):
+        '''Starts a new session, returns its RecordedSession.'''
+        return RecordedSession(open(self.fn, 'a'), host, port)
+
+
+class RecordedSession(object):
+    '''Writes the events of one connection to the file f.'''
+
+    def __init__(self, f, host, port):
+        self.file = f
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # Set between AUTHENTICATE and the next command
+        self.authenticating = False
+        self.write({'session': '%s:%s' % (host, port), 'start': self.start})
+
+    def write(self, event):
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(json.dumps(event) + '\n')
+
+    def event(self, kind, data):
+        self.write({'t': round(time.time() - self.start, 6),
+                    kind: data.decode('latin-1')})
+
+    def sent(self, data, tagpre):
+        if data.startswith(tagpre):
+            match = COMMAND_RE.match(data)
+            command = match and match.group(2) or ''
+            credentials = CREDENTIALS_RE.match(command)
+            self.authenticating = False
+            if credentials and credentials.group(1).upper() == 'LOGIN':
+                data = '%s LOGIN %s %s\r\n' % (match.group(1), REDACTED,
+                                               REDACTED)
+            elif credentials:
+                self.authenticating = True
+        elif self.authenticating and data.strip():
+            data = REDACTED
+        self.event('send', data)
+
+    def received(self, data):
+        if data:
+            self.event('recv', data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+_recording_classes = {}
+
+
+def recording(imap_class):
+    '''Returns a subclass of imap_class (imaplib.IMAP4 or IMAP4_SSL)
+    that takes a Recorder as the keyword argument transcript and
+    records its session with it.'''
+    if imap_class in _recording_classes:
+        return _recording_classes[imap_class]
+
+    # imaplib's classes are old style, so no super()
+    class RecordingIMAP4(imap_class):
+
+        def __init__(self, *args, **kwargs):
+            self.recorder = kwargs.pop('transcript', None)
+            self.session = None
+            imap_class.__init__(self, *args, **kwargs)
+
+        def open(self, *args):
+            imap_class.open(self, *args)
+            if self.recorder:
+                self.session = self.recorder.session(self.host, self.port)
+
+        def send(self, data):
+            if self.session:
+                self.session.sent(data, self.tagpre)
+            imap_class.send(self, data)
+
+        def read(self, size):
+            data = imap_class.read(self, size)
+            if self.session:
+                self.session.received(data)
+            return data
+
+        def readline(self):
+            line = imap_class.readline(self)
+            if self.session:
+                self.session.received(line)
+            return line
+
+        def shutdown(self):
+            try:
+                imap_class.shutdown(self)
+            finally:
+                if self.session:
+                    self.session.close()
+
+    RecordingIMAP4.__name__ = 'Recording' + imap_class.__name__
+    _recording_classes[imap_class] = RecordingIMAP4
+    return RecordingIMAP4
+
+
+class ReplayedCommand(object):
+    '''The recorded answer to a command sent at sent (seconds since the
+    start): responses is a list of (seconds after sent, response), uids
+    the uid in each of them or None, status the tagged response without
+    the tag, None if the connection dropped before it.'''
+
+    def __init__(self, sent):
+        self.sent = sent
+        self.responses = []
+        self.uids = []
+        self.status = None
+
+
+class Session(object):
+    '''One recorded session, parsed: the greeting and, by their text,
+    the commands and what they got back.'''
+
+    def __init__(self, events):
+        # [(seconds since the start, response)]
+        self.greeting = []
+        # command text -> [ReplayedCommand], in the order they were sent
+        self.commands = {}
+        # ('FETCH' or 'STORE', the items) -> [uid -> (response,
+        # seconds), tagged status]
+        self.messages = {}
+        self.parse(events)
+        self.index()
+
+    def parse(self, events):
+        running = deque()
+        last = None
+        client = server = ''
+        # The response being read as sent and its text without literals
+        response, text = '', []
+        literal = 0
+        for event in events:
+            now = event['t']
+            if 'send' in event:
+                client += event['send'].encode('latin-1')
+                lines = client.split('\r\n')
+                client = lines.pop()
+                for line in lines:
+                    match = COMMAND_RE.match(line)
+                    if match:
+                        command = ReplayedCommand(now)
+                        running.append((match.group(1), command))
+                        self.commands.setdefault(match.group(2),
+                                                 []).append(command)
+                continue
+
+            server += event['recv'].encode('latin-1')
+            while server:
+                if literal:
+                    part = server[:literal]
+                    response += part
+                    server = server[len(part):]
+                    literal -= len(part)
+                    continue
+                line, sep, server = server.partition('\r\n')
+                if not sep:
+                    server = line
+                    break
+                response += line + sep
+                text.append(line)
+                match = LITERAL_RE.search(line + sep)
+                if match:
+                    literal = int(match.group(1))
+                    continue
+
+                tag, command = running and running[0] or (None, None)
+                if tag and line.startswith(tag + ' '):
+                    running.popleft()
+                    command.status = line[len(tag) + 1:]
+                    command.responses.append((now - command.sent, None))
+                    last = command
+                elif command or last:
+                    command = command or last
+                    match = UID_RE.search(' '.join(text))
+                    command.responses.append((now - command.sent, response))
+                    command.uids.append(match and int(match.group(1)))
+                else:
+                    self.greeting.append((now, response))
+                response, text = '', []
+
+    def index(self):
+        '''Files the responses of UID FETCH and STORE by message, with
+        an even share of the time the command took.'''
+        for text, commands in self.commands.items():
+            match = MESSAGES_RE.match(text)
+            if not match:
+                continue
+            group = self.messages.setdefault(
+                (match.group(1).upper(), match.group(3)), [{}, None])
+            for command in commands:
+                if command.status is None:
+                    continue
+                group[1] = command.status
+                share = command.responses[-1][0] / max(len(command.uids), 1)
+                for (_, response), uid in zip(command.responses,
+                                              command.uids):
+                    if uid is not None:
+                        group[0][uid] = (response, share)
+
+    def answer(self, text, played):
+        '''Returns the answer to the command text as a list of
+        (seconds after it was sent, response), None standing for the
+        tagged response, and its status, None if the connection dropped
+        there. Returns None if there is no answer. played counts how
+        many times each command was answered.'''
+        commands = self.commands.get(text)
+        if commands:
+            count = played.get(text, 0)
+            played[text] = count + 1
+            command = commands[min(count, len(commands) - 1)]
+            return command.responses, command.status
+
+        match = MESSAGES_RE.match(text)
+        if not match:
+            return None
+        group = self.messages.get((match.group(1).upper(), match.group(3)))
+        if group is None or group[1] is None:
+            return None
+        try:
+            wanted = decode_message_set(match.group(2))
+        except ValueError:
+            return None
+        uids, status = group
+        responses = []
+        elapsed = 0
+        for uid in wanted:
+            if uid in uids:
+                response, seconds = uids[uid]
+                elapsed += seconds
+                responses.append((elapsed, response))
+        responses.append((elapsed, None))
+        return responses, status
+
+
+class Replay(object):
+    '''The sessions of the transcript fn, played back to ReplayIMAP4
+    connections one after the other. With timed, responses take as
+    long as they did when recorded.'''
+
+    def __init__(self, fn, timed=False):
+        self.timed = timed
+        self.lock = threading.Lock()
+        self.sessions = deque()
+        events = None
+        with open(fn) as f:
+            for line in f:
+                event = json.loads(line)
+                if 'session' in event:
+                    events = []
+                    self.sessions.append(events)
+                elif events is not None:
+                    events.append(event)
+        self.sessions = deque(Session(events) for events in self.sessions)
+
+    def imap_class(self, imap_class):
+        return ReplayIMAP4
+
+    def next_session(self):
+        with self.lock:
+            if not self.sessions:
+                return None
+            return self.sessions.popleft()
+
+
+class ReplayIMAP4(imaplib.IMAP4):
+    '''An imaplib.IMAP4 that plays back the next session of the Replay
+    given as transcript instead of connecting to host.'''
+
+    def __init__(self, host='', port=imaplib.IMAP4_PORT, transcript=None):
+        self.replay = transcript
+        self.session = transcript.next_session()
+        if self.session is None:
+            raise self.error('No more sessions in the transcript')
+        imaplib.IMAP4.__init__(self, host, port)
+
+    def open(self, host='', port=imaplib.IMAP4_PORT):
+        self.host = host
+        self.port = port
+        self.sock = self.file = None
+        self.started = time.time()
+        # (when it is due, data) to be read
+        self.pending = deque()
+        self.buffer = ''
+        self.outgoing = ''
+        self.played = {}
+        # Set once the recorded connection dropped
+        self.dropped = False
+        for seconds, response in self.session.greeting:
+            self.pending.append((self.started + seconds, response))
+
+    def send(self, data):
+        self.outgoing += data
+        lines = self.outgoing.split('\r\n')
+        self.outgoing = lines.pop()
+        now = time.time()
+        for line in lines:
+            if self.dropped or not line.startswith(self.tagpre):
+                # A continuation, e.g. the (redacted) AUTHENTICATE data
+                continue
+            tag, _, text = line.partition(' ')
+            answer = self.session.answer(text, self.played)
+            if answer is None:
+                self.pending.append((now, '%s BAD Not in the transcript: '
+                                          '%s\r\n' % (tag, text[:100])))
+                continue
+            responses, status = answer
+            for seconds, response in responses:
+                if response is None:
+                    response = '%s %s\r\n' % (tag, status)
+                self.pending.append((now + seconds, response))
+            self.dropped = status is None
+
+    def fill(self):
+        '''Moves the next response into the buffer, once it is due if
+        timed. Returns False at the end of the session.'''
+        if not self.pending:
+            return False
+        due, data = self.pending.popleft()
+        wait = due - time.time()
+        if self.replay.timed and wait > 0:
+            time.sleep(wait)
+        self.buffer += data
+        return True
+
+    def read(self, size):
+        while len(self.buffer) < size and self.fill():
+            pass
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        while '\n' not in self.buffer and self.fill():
+            pass
+        line, sep, self.buffer = self.buffer.partition('\n')
+        return line + sep
+
+    def shutdown(self):
+        self.pending.clear()
+        self.buffer = ''
+
+    def socket(self):
+        return None
@@ -18,6 +18,8 @@
 #
 # * Replaced used of the sha module with the hashlib module
 # * Commented out some of the print statements
+# * Import optparse and smtplib where they are used, importing the
+#   module just to make an XOAUTH string doesn't need them
 
 
 """Utilities for XOAUTH authentication.
@@ -74,9 +76,7 @@ server to connect to.
 import base64
 import hmac
 import imaplib
-from optparse import OptionParser
 import random
-import smtplib
 import sys
 import time
 import urllib
@@ -84,6 +84,7 @@ import hashlib
 
 
 def SetupOptionParser():
+  from optparse import OptionParser
   # Usage message is the module's docstring.
   parser = OptionParser(usage=__doc__)
   parser.add_option('--generate_oauth_token',
@@ -434,6 +435,7 @@ def TestSmtpAuthentication(smtp_hostname, user, xoauth_string):
     xoauth_string: A valid XOAUTH string, as returned by GenerateXOauthString.
         Must not be base64-encoded, since IMAPLIB does its own base64-encoding.
   """
+  import smtplib
   print
   smtp_conn = smtplib.SMTP(smtp_hostname, 587)
   smtp_conn.set_debuglevel(True)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+Checks that the engines of the GMail Auto-Archiver agree, against
+lib.fakeimap.
+
+Usage:
+    python test_engines.py
+
+The client side engine compares the Date headers it fetched, the
+--server-side one lets gmail compare the dates with X-GM-RAW searches,
+which lib.fakeimap implements. Each one runs with its options on a copy
+of the same mailbox, and every run must archive exactly the messages
+that are older than the shortest age limit of their labels.
+'''
+
+import imaplib
+import os
+import random
+import sys
+import time
+import unittest
+
+from lib import autoarchive, fakeimap, xoauth
+from lib.imapstream import run_session
+from lib.labelrules import DAY, HOUR, WEEK
+
+# Ages in hours and weeks too: X-GM-RAW compares whole days with
+# older_than: and anything else with before:
+AGES = {'aa:1': DAY, 'aa:3': 3 * DAY, 'aa:12h': 12 * HOUR,
+        'aa:2w': 2 * WEEK, 'aa:30': 30 * DAY}
+LABELS = sorted(AGES) + ['Receipts']
+MESSAGES = 2000
+DAYS = 45
+
+CLIENT_SIDE = [[], ['--pipeline'], ['--fetch-labels'], ['--internaldate'],
+               ['--threads', 'newest']]
+SERVER_SIDE = [['--server-side'], ['--server-side', '-v'],
+               ['--server-side', '--pipeline']]
+
+
+def make_mailbox(now):
+    '''Returns a FakeMailbox of MESSAGES messages, the same one for the
+    same now. Messages are dated half past an hour, so none is within
+    half an hour of its age limit while the engines run.'''
+    rand = random.Random(0)
+    mailbox = fakeimap.FakeMailbox()
+    for i in xrange(MESSAGES):
+        labels = rand.sample(LABELS, rand.choice((0, 1, 1, 1, 2)))
+        date = now - rand.randint(0, DAYS * 24) * HOUR - HOUR / 2
+        mailbox.add_message('Message #%d' % i, date, labels)
+    return mailbox
+
+
+def old_messages(mailbox, now):
+    '''Returns the set of uids in the inbox of mailbox due at now.'''
+    old = set()
+    for uid in mailbox.folder('INBOX'):
+        msg = mailbox.messages[uid]
+        ages = [AGES[label] for label in msg.labels if label in AGES]
+        if ages and now - msg.date > min(ages):
+            old.add(uid)
+    return old
+
+
+def archive(mailbox, args):
+    '''Runs archive_mailbox with the command line args, without the
+    cache, on mailbox. Returns the set of uids it took out of the
+    inbox.'''
+    server = fakeimap.FakeGmailServer(mailbox)
+    server.start()
+    options, _ = autoarchive.setup_option_parser().parse_args(args)
+    before = set(mailbox.folder('INBOX'))
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        s = autoarchive.connect(xoauth.OAuthEntity('token', 'secret'),
+                                'test@gmail.com', 'localhost', server.port,
+                                imaplib.IMAP4, options.pipeline)
+        run_session(s, autoarchive.archive_mailbox(s, options, ''))
+        autoarchive.close_mailbox(s)
+        s.logout()
+    finally:
+        sys.stdout = stdout
+        server.shutdown()
+        server.server_close()
+    return before - set(mailbox.folder('INBOX'))
+
+
+class EnginesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = time.time()
+        self.expected = old_messages(make_mailbox(self.now), self.now)
+
+    def check(self, args):
+        archived = archive(make_mailbox(self.now), args)
+        self.assertEqual(archived, self.expected,
+                         '%s: %d archived, %d missing, %d too many' % (
+                             ' '.join(args), len(archived),
+                             len(self.expected - archived),
+                             len(archived - self.expected)))
+
+    def test_mailbox(self):
+        # Something to archive and something to keep
+        self.assertTrue(0 < len(self.expected) < MESSAGES)
+
+    def test_client_side(self):
+        for args in CLIENT_SIDE:
+            self.check(args)
+
+    def test_server_side(self):
+        for args in SERVER_SIDE:
+            self.check(args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+Checks the age limits lib.labelrules reads from label names.
+
+Usage:
+    python test_labelrules.py
+'''
+
+import unittest
+
+from lib.labelrules import DAY, HOUR, MAX_AGE, WEEK, LabelRules
+from lib.msgindex import MessageIndex
+
+
+class LabelRulesTest(unittest.TestCase):
+
+    def test_units(self):
+        rules = LabelRules([r'aa:{age}'])
+        self.assertEqual(rules.age('aa:3'), 3 * DAY)
+        self.assertEqual(rules.age('aa:12h'), 12 * HOUR)
+        self.assertEqual(rules.age('aa:2w'), 2 * WEEK)
+        self.assertEqual(rules.age('aa:x'), None)
+
+    def test_alternation(self):
+        # Each side of {age} is a regular expression of its own
+        rules = LabelRules([r'aa|bb:{age}', r'{age}d|x'])
+        self.assertEqual(rules.age('aa'), None)
+        self.assertEqual(rules.age('aa3'), 3 * DAY)
+        self.assertEqual(rules.age('bb:3'), 3 * DAY)
+        self.assertEqual(rules.age('2x'), 2 * DAY)
+        self.assertEqual(rules.age('2d'), 2 * DAY)
+        self.assertEqual(rules.age('x'), None)
+
+    def test_longest_age(self):
+        # Longer than the age column of MessageIndex holds
+        rules = LabelRules([r'aa:{age}'])
+        for label in ('aa:30000', 'aa:5000w', 'aa:99999999999999999999'):
+            age = rules.age(label)
+            self.assertEqual(age, MAX_AGE)
+            index = MessageIndex()
+            index.add('5', age, 1e9)
+            self.assertEqual(index['5'], (MAX_AGE, 1e9))
+
+    def test_longest_age_in_days(self):
+        # Caches written before ages were in seconds kept them in days
+        index = MessageIndex([('5', (30000, 1e9)), ('6', (3, 1e9))])
+        index.scale_ages(DAY)
+        self.assertEqual(index['5'], (MAX_AGE, 1e9))
+        self.assertEqual(index['6'], (3 * DAY, 1e9))
+
+
+if __name__ == '__main__':
+    unittest.main()